@@ -0,0 +1,4 @@
+"""Benchmarks of the convert pipeline on synthetic rasters against an in-process S3
+
+Run from the ``convert`` directory with ``python -m benchmarks``, see the README.
+"""
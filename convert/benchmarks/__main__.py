@@ -0,0 +1,86 @@
+import argparse
+import logging
+import os
+import sys
+
+from benchmarks.harness import (
+    DEFAULT_TOLERANCE,
+    OPERATIONS,
+    best_profiles,
+    compare,
+    load_results,
+    run_suite,
+    save_results,
+)
+from benchmarks.suites import SUITES
+from convert.runtime import PROFILES
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the convert pipeline on synthetic rasters against an in-process S3 (moto)"
+    )
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick", help="Set of rasters (default: quick)")
+    parser.add_argument(
+        "--operations",
+        nargs="+",
+        choices=list(OPERATIONS),
+        default=list(OPERATIONS),
+        help="Operations to benchmark (default: all)",
+    )
+    parser.add_argument("--match", help="Only run cases whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each case, the fastest is kept (default: 1)")
+    parser.add_argument(
+        "--runtime-profiles",
+        nargs="+",
+        choices=list(PROFILES),
+        help="Run each operation with each of these GDAL runtime profiles and report the fastest",
+    )
+    parser.add_argument("--scratch-dir", help="Directory for synthetic rasters and scratch files")
+    parser.add_argument(
+        "--output",
+        default=os.path.join("benchmarks", "results", "latest.json"),
+        help="JSON file to write results to (default: benchmarks/results/latest.json)",
+    )
+    parser.add_argument("--baseline", help="JSON results of an earlier run, exit with 1 on any regression")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"Allowed relative increase of each metric over the baseline (default: {DEFAULT_TOLERANCE})",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s.%(funcName)s:L%(lineno)d - %(message)s",
+        datefmt="%y/%m/%d %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    # the conversion itself is very chatty at info level
+    logging.getLogger("convert").setLevel(logging.WARNING)
+    logging.getLogger("botocore").setLevel(logging.WARNING)
+    log = logging.getLogger(__file__)
+
+    cases = [case for case in SUITES[args.suite] if not args.match or args.match in case.name]
+    results = run_suite(
+        cases,
+        args.operations,
+        repeat=args.repeat,
+        scratch_dir=args.scratch_dir,
+        runtime_profiles=args.runtime_profiles,
+    )
+    save_results(args.output, results)
+
+    for key, profile in best_profiles(results).items():
+        log.info(f"{key} : fastest runtime profile is {profile}")
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), tolerance=args.tolerance)
+        for regression in regressions:
+            log.error(regression)
+        sys.exit(1 if regressions else 0)
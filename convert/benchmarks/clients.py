@@ -0,0 +1,153 @@
+"""Micro-benchmark of S3 helpers with shared clients against a new client per helper
+
+Measures the time to create an ``S3Helper`` and to make small transfers with a
+new helper each time, as each conversion does. The transfers go over HTTP to a
+local S3 compatible server (moto's threaded server), so connections that are
+kept open by the shared clients are counted too.
+
+Run with ``python -m benchmarks.clients``.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Sequence
+
+import boto3
+
+from convert import clients
+from convert.s3 import S3Helper
+
+log = logging.getLogger(__name__)
+
+BUCKET = "client-benchmark"
+KEY = "small.bin"
+
+# Size of the object read and written by the transfer benchmarks
+SMALL_OBJECT_BYTES = 64 * 1024
+
+
+@dataclass
+class ClientBenchResult:
+    """Time per call of an operation with a new client per helper and with the shared clients"""
+
+    operation: str
+    calls: int
+    fresh_seconds: float
+    shared_seconds: float
+
+    @property
+    def speedup(self) -> float:
+        return self.fresh_seconds / self.shared_seconds if self.shared_seconds else 0.0
+
+
+def fresh_helper(bucket: str) -> S3Helper:
+    """A helper with a client from a new session, as every helper had before the client registry"""
+    helper = S3Helper(bucket)
+    helper.client = boto3.Session().resource("s3").Bucket(bucket).meta.client
+    return helper
+
+
+@contextmanager
+def local_s3_server() -> Iterator[str]:
+    """Point boto3, and processes started meanwhile, at a local S3 compatible server, yielding its endpoint"""
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    environ = dict(os.environ)
+    os.environ.update(
+        AWS_ENDPOINT_URL_S3=f"http://{host}:{port}",
+        AWS_ACCESS_KEY_ID="testing",
+        AWS_SECRET_ACCESS_KEY="testing",
+        AWS_DEFAULT_REGION="us-east-1",
+    )
+    os.environ.pop("AWS_SESSION_TOKEN", None)
+    clients.reset()
+    try:
+        yield os.environ["AWS_ENDPOINT_URL_S3"]
+    finally:
+        clients.reset()
+        os.environ.clear()
+        os.environ.update(environ)
+        server.stop()
+
+
+@contextmanager
+def local_s3() -> Iterator[str]:
+    """Point boto3 at a local S3 compatible server with a bucket holding a small object"""
+    with local_s3_server():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        client.put_object(Bucket=BUCKET, Key=KEY, Body=os.urandom(SMALL_OBJECT_BYTES))
+        yield BUCKET
+
+
+def _time(operation: Callable[[], None], calls: int) -> float:
+    """Seconds per call of ``operation``, after one untimed call to warm up"""
+    operation()
+    start = time.perf_counter()
+    for _ in range(calls):
+        operation()
+    return (time.perf_counter() - start) / calls
+
+
+def run(calls: int = 50) -> List[ClientBenchResult]:
+    """Run each operation ``calls`` times with fresh and shared clients
+
+    Parameters
+    ----------
+    calls : int, optional
+        Timed calls of each operation
+
+    Returns
+    -------
+    List[ClientBenchResult]
+        Time per call of each operation
+    """
+    payload = os.urandom(SMALL_OBJECT_BYTES)
+    with local_s3() as bucket:
+        operations = {
+            "construct": lambda make: make(bucket),
+            "get_bytes": lambda make: make(bucket).get_bytes(KEY),
+            "write_bytes": lambda make: make(bucket).write_bytes(payload, "written.bin"),
+            "head": lambda make: make(bucket).head(KEY),
+        }
+        results = []
+        for name, operation in operations.items():
+            fresh = _time(lambda: operation(fresh_helper), calls)
+            shared = _time(lambda: operation(S3Helper), calls)
+            results.append(ClientBenchResult(name, calls, fresh, shared))
+    return results
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark S3 helpers with shared and fresh boto3 clients")
+    parser.add_argument("--calls", type=int, default=50, help="Timed calls of each operation (default: 50)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s.%(funcName)s:L%(lineno)d - %(message)s",
+        datefmt="%y/%m/%d %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    # every helper logs each transfer at info level
+    logging.getLogger("convert").setLevel(logging.WARNING)
+    logging.getLogger("botocore").setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    log = logging.getLogger(__file__)
+
+    for result in run(args.calls):
+        log.info(
+            f"{result.operation} : {result.fresh_seconds * 1000:.3f} ms with a new client, "
+            f"{result.shared_seconds * 1000:.3f} ms shared ({result.speedup:.1f}x)"
+        )
@@ -0,0 +1,174 @@
+"""Benchmark of footprint index queries against the size of the index
+
+Builds indexes of synthetic footprints, UTM scenes scattered over the globe,
+and measures the time to load the index from its shards and to answer bounding
+box and attribute queries, as ``FootprintIndex.query`` does once the shards
+have been read. Everything runs in memory, so the time to fetch the shards
+from S3 is not included.
+
+Run with ``python -m benchmarks.footprints``.
+"""
+import argparse
+import logging
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from convert.footprints import Footprint, FootprintTable
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+# Footprints per shard written by conversions, before shards are merged
+SHARD_RECORDS = 1_000
+
+# Size of a scene in degrees, and of the boxes queried
+SCENE_DEGREES = 1.0
+QUERY_DEGREES = 2.0
+
+
+@dataclass
+class IndexBenchResult:
+    """Size of an index and the time to load and query it"""
+
+    records: int
+    shard_bytes: int
+    # Seconds to join and deduplicate unmerged shards, and to read a merged shard
+    load_sharded_seconds: float
+    load_merged_seconds: float
+    # Mean seconds per query, and mean footprints found
+    bbox_seconds: float
+    bbox_matches: float
+    attribute_seconds: float
+    attribute_matches: float
+
+
+def synthetic_footprints(records: int, seed: int = 0) -> List[Footprint]:
+    """Footprints of scenes at random places, in the UTM zone of each, written over a year"""
+    rng = np.random.default_rng(seed)
+    west = rng.uniform(-180, 180 - SCENE_DEGREES, records)
+    south = rng.uniform(-80, 80 - SCENE_DEGREES, records)
+    zones = ((west + 180) // 6 + 1).astype(int)
+    res = rng.choice([10.0, 20.0, 30.0, 60.0], records)
+    counts = rng.choice([1, 3, 4, 13], records)
+    written = 1.7e9 + rng.uniform(0, 3.15e7, records)
+    return [
+        Footprint(
+            key=f"scenes/{zones[ix]:02d}/{ix:08d}-cog.tif",
+            crs=f"EPSG:{32600 + zones[ix] if south[ix] >= 0 else 32700 + zones[ix]}",
+            west=west[ix],
+            south=south[ix],
+            east=west[ix] + SCENE_DEGREES,
+            north=south[ix] + SCENE_DEGREES,
+            minx=500000.0,
+            miny=0.0,
+            maxx=500000.0 + 110000,
+            maxy=110000.0,
+            res_x=res[ix],
+            res_y=res[ix],
+            width=int(110000 // res[ix]),
+            height=int(110000 // res[ix]),
+            count=int(counts[ix]),
+            dtype="uint16",
+            profile="deflate",
+            compression="deflate",
+            size=int(rng.integers(1, 500)) * 1024 * 1024,
+            written=written[ix],
+        )
+        for ix in range(records)
+    ]
+
+
+def _time_queries(query: Callable[[], int], calls: int) -> Tuple[float, float]:
+    """Mean seconds per call of ``query`` and mean footprints it found"""
+    found = 0
+    start = time.perf_counter()
+    for _ in range(calls):
+        found += query()
+    return (time.perf_counter() - start) / calls, found / calls
+
+
+def run(sizes: Sequence[int] = DEFAULT_SIZES, queries: int = 20, seed: int = 0) -> List[IndexBenchResult]:
+    """Build an index of each size and time loading and querying it
+
+    Parameters
+    ----------
+    sizes : Sequence[int], optional
+        Footprints in each index
+    queries : int, optional
+        Queries of each kind to average over
+    seed : int, optional
+        Seed of the footprints and queries
+
+    Returns
+    -------
+    List[IndexBenchResult]
+        Result for each size
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for records in sizes:
+        footprints = synthetic_footprints(records, seed)
+        shards = [
+            FootprintTable.from_footprints(footprints[start : start + SHARD_RECORDS]).dumps()
+            for start in range(0, records, SHARD_RECORDS)
+        ]
+        merged = FootprintTable.concat([FootprintTable.loads(shard)[0] for shard in shards]).latest().dumps()
+
+        start = time.perf_counter()
+        FootprintTable.concat([FootprintTable.loads(shard)[0] for shard in shards]).latest()
+        load_sharded = time.perf_counter() - start
+        start = time.perf_counter()
+        table, _ = FootprintTable.loads(merged)
+        load_merged = time.perf_counter() - start
+
+        boxes = iter(
+            [
+                (west, south, west + QUERY_DEGREES, south + QUERY_DEGREES)
+                for west, south in zip(rng.uniform(-180, 178, queries), rng.uniform(-80, 78, queries))
+            ]
+        )
+        bbox, bbox_matches = _time_queries(lambda: len(table.select(bbox=next(boxes))), queries)
+        where = {"crs": "EPSG:32630", "res_x": (None, 20.0), "count": [3, 4]}
+        attribute, attribute_matches = _time_queries(lambda: len(table.select(where=where)), queries)
+
+        results.append(
+            IndexBenchResult(
+                records, len(merged), load_sharded, load_merged, bbox, bbox_matches, attribute, attribute_matches
+            )
+        )
+    return results
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark footprint index queries against the size of the index")
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES), help="Footprints in each index to benchmark"
+    )
+    parser.add_argument("--queries", type=int, default=20, help="Queries of each kind to average over (default: 20)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s.%(funcName)s:L%(lineno)d - %(message)s",
+        datefmt="%y/%m/%d %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    log = logging.getLogger(__file__)
+
+    for result in run(args.sizes, args.queries):
+        log.info(
+            f"{result.records} footprints ({result.shard_bytes / 1024 / 1024:.2f} MiB merged) : "
+            f"load {result.load_sharded_seconds * 1000:.1f} ms from {SHARD_RECORDS} per shard, "
+            f"{result.load_merged_seconds * 1000:.2f} ms merged, "
+            f"bbox query {result.bbox_seconds * 1000:.2f} ms ({result.bbox_matches:.1f} found), "
+            f"attribute query {result.attribute_seconds * 1000:.2f} ms ({result.attribute_matches:.1f} found)"
+        )
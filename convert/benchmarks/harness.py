@@ -0,0 +1,335 @@
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import rasterio
+from moto import mock_aws
+
+from benchmarks.synthetic import RasterCase, write_synthetic
+from convert import footprints, runtime
+from convert.clients import get_session
+from convert.cog import to_cog
+from convert.metrics import peak_rss_mib
+from convert.s3 import S3Helper
+
+log = logging.getLogger(__name__)
+
+BUCKET = "benchmark-bucket"
+SOURCE_KEY = "source.tif"
+OUTPUT_KEY = "output.tif"
+
+# Relative increase of a metric over the baseline that counts as a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Timings shorter than this (in seconds) are too noisy to compare
+MIN_COMPARABLE_SECONDS = 0.05
+
+# Metrics compared against a baseline, larger is worse for all of them
+COMPARED_METRICS = ("seconds", "peak_rss_mib", "output_size")
+
+
+@dataclass
+class BenchResult:
+    """Measurements of one operation on one synthetic raster"""
+
+    case: str
+    operation: str
+    params: Dict[str, Any]
+    seconds: float
+    peak_rss_mib: float
+    input_size: int
+    output_size: int
+    bytes_down: int
+    bytes_up: int
+    requests: int
+    # GDAL runtime profile forced for the run, empty when it was selected
+    runtime_profile: str = ""
+
+    @property
+    def id(self) -> str:
+        if self.runtime_profile:
+            return f"{self.operation}/{self.case}/{self.runtime_profile}"
+        return f"{self.operation}/{self.case}"
+
+
+@dataclass
+class TransferCounter:
+    """Count the bytes and requests sent to and received from S3
+
+    Hooks into the botocore events of a boto3 session, so every client made
+    from that session (including those of ``S3Helper``) is counted.
+    """
+
+    bytes_down: int = 0
+    bytes_up: int = 0
+    requests: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def _before_call(self, params: Dict[str, Any], **kwargs) -> None:
+        body = params.get("body")
+        if isinstance(body, (bytes, bytearray)):
+            size = len(body)
+        elif hasattr(body, "seek"):
+            position = body.tell()
+            size = body.seek(0, os.SEEK_END) - position
+            body.seek(position)
+        else:
+            size = 0
+
+        with self._lock:
+            self.bytes_up += size
+            self.requests += 1
+
+    def _after_get(self, parsed: Dict[str, Any], **kwargs) -> None:
+        with self._lock:
+            self.bytes_down += parsed.get("ContentLength", 0)
+
+    def register(self, session: Any) -> None:
+        session.events.register("before-call.s3", self._before_call)
+        session.events.register("after-call.s3.GetObject", self._after_get)
+
+    def unregister(self, session: Any) -> None:
+        session.events.unregister("before-call.s3", self._before_call)
+        session.events.unregister("after-call.s3.GetObject", self._after_get)
+
+
+def _reset_peak_rss() -> None:
+    """Reset the peak RSS of this process, where the kernel allows it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+def _current_peak_rss_mib() -> float:
+    """Peak RSS since the last reset, or of the process if it cannot be reset"""
+    try:
+        with open("/proc/self/status", "r") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mib()
+
+
+def _to_cog(source_path: str, tmp_dir: str) -> int:
+    to_cog(BUCKET, SOURCE_KEY, BUCKET, OUTPUT_KEY, scratch_dir=tmp_dir, force=True)
+    return S3Helper(BUCKET).get_size(OUTPUT_KEY)
+
+
+def _to_cog_on_disk(source_path: str, tmp_dir: str) -> int:
+    to_cog(BUCKET, SOURCE_KEY, BUCKET, OUTPUT_KEY, in_memory_max_bytes=0, scratch_dir=tmp_dir, force=True)
+    return S3Helper(BUCKET).get_size(OUTPUT_KEY)
+
+
+def _download(source_path: str, tmp_dir: str) -> int:
+    return len(S3Helper(BUCKET).get_bytes(SOURCE_KEY).getbuffer())
+
+
+def _upload(source_path: str, tmp_dir: str) -> int:
+    with open(source_path, "rb") as fh:
+        content = fh.read()
+    S3Helper(BUCKET).write_bytes(content, OUTPUT_KEY)
+    return len(content)
+
+
+# Operations that can be benchmarked, each returns the size of its output
+OPERATIONS: Dict[str, Callable[[str, str], int]] = {
+    "to_cog": _to_cog,
+    "to_cog_on_disk": _to_cog_on_disk,
+    "download": _download,
+    "upload": _upload,
+}
+
+
+def _run_in_process(
+    case: RasterCase, operation: str, scratch_dir: Optional[str], runtime_profile: Optional[str]
+) -> BenchResult:
+    """Run a single benchmark, in a fresh process so peak memory is its own"""
+    if runtime_profile:
+        runtime.RUNTIME_PROFILE = runtime_profile
+    # Only the conversion is measured, so the bytes up are those of the output
+    footprints.INDEX = "off"
+
+    with mock_aws(), tempfile.TemporaryDirectory(prefix="bench-", dir=scratch_dir) as tmp_dir:
+        source_path = os.path.join(tmp_dir, "source.tif")
+        write_synthetic(source_path, case)
+
+        session = get_session()
+        client = session.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        client.upload_file(source_path, BUCKET, SOURCE_KEY)
+
+        counter = TransferCounter()
+        counter.register(session)
+        _reset_peak_rss()
+        try:
+            start = time.perf_counter()
+            output_size = OPERATIONS[operation](source_path, tmp_dir)
+            seconds = time.perf_counter() - start
+        finally:
+            counter.unregister(session)
+
+        return BenchResult(
+            case=case.name,
+            operation=operation,
+            params=asdict(case),
+            seconds=seconds,
+            peak_rss_mib=_current_peak_rss_mib(),
+            input_size=os.path.getsize(source_path),
+            output_size=output_size,
+            bytes_down=counter.bytes_down,
+            bytes_up=counter.bytes_up,
+            requests=counter.requests,
+            runtime_profile=runtime_profile or "",
+        )
+
+
+def run_case(
+    case: RasterCase,
+    operation: str,
+    scratch_dir: Optional[str] = None,
+    runtime_profile: Optional[str] = None,
+) -> BenchResult:
+    """Benchmark ``operation`` on a synthetic raster against an in-process S3
+
+    Parameters
+    ----------
+    case : RasterCase
+        Synthetic raster to generate and upload as the source
+    operation : str
+        One of ``OPERATIONS``
+    scratch_dir : str, optional
+        Directory for the synthetic source and conversion scratch files
+    runtime_profile : str, optional
+        GDAL runtime profile to use rather than selecting one, see
+        ``convert.runtime.PROFILES``
+
+    Returns
+    -------
+    BenchResult
+        Wall time, peak memory and the bytes moved by the operation
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation {operation}, expected one of {list(OPERATIONS)}")
+
+    # S3 is mocked within the child, which must be forked to share its imports
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork")) as pool:
+        result = pool.submit(_run_in_process, case, operation, scratch_dir, runtime_profile).result()
+
+    log.info(
+        f"{result.id} : {result.seconds:.3f}s, peak {result.peak_rss_mib:.1f} MiB, "
+        f"{result.bytes_down} bytes down / {result.bytes_up} bytes up in {result.requests} requests, "
+        f"{result.input_size} -> {result.output_size} bytes"
+    )
+    return result
+
+
+def run_suite(
+    cases: List[RasterCase],
+    operations: List[str],
+    repeat: int = 1,
+    scratch_dir: Optional[str] = None,
+    runtime_profiles: Optional[List[str]] = None,
+) -> List[BenchResult]:
+    """Run every operation on every case, keeping the best of ``repeat`` runs
+
+    With ``runtime_profiles`` each operation is run once per GDAL runtime
+    profile, to sweep the profiles on this machine.
+    """
+    results = []
+    for case in cases:
+        for operation in operations:
+            for runtime_profile in runtime_profiles or [None]:
+                runs = [run_case(case, operation, scratch_dir, runtime_profile) for _ in range(repeat)]
+                results.append(min(runs, key=lambda result: result.seconds))
+    return results
+
+
+def best_profiles(results: List[BenchResult]) -> Dict[str, str]:
+    """Fastest runtime profile of each operation and case in a sweep"""
+    best: Dict[str, BenchResult] = {}
+    for result in results:
+        if not result.runtime_profile:
+            continue
+        key = f"{result.operation}/{result.case}"
+        if key not in best or result.seconds < best[key].seconds:
+            best[key] = result
+    return {key: result.runtime_profile for key, result in best.items()}
+
+
+def save_results(path: str, results: List[BenchResult]) -> None:
+    """Write results to JSON along with the versions they were measured with"""
+    document = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "resources": asdict(runtime.container_resources()),
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "results": [asdict(result) for result in results],
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as fh:
+        json.dump(document, fh, indent=2)
+    log.info(f"Written {len(results)} results to {path}")
+
+
+def load_results(path: str) -> List[BenchResult]:
+    """Read results written by ``save_results``"""
+    with open(path, "r") as fh:
+        return [BenchResult(**result) for result in json.load(fh)["results"]]
+
+
+def compare(
+    results: List[BenchResult],
+    baseline: List[BenchResult],
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> List[str]:
+    """Find regressions of ``results`` relative to ``baseline``
+
+    Parameters
+    ----------
+    results : List[BenchResult]
+        Results of this run
+    baseline : List[BenchResult]
+        Results of an earlier run, matched by operation and case
+    tolerance : float, optional
+        Allowed relative increase of each metric, e.g. 0.25 for 25%
+
+    Returns
+    -------
+    List[str]
+        Description of each regression, empty if there are none
+    """
+    previous = {result.id: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result.id)
+        if before is None:
+            log.info(f"{result.id} : no baseline")
+            continue
+
+        for metric in COMPARED_METRICS:
+            old, new = getattr(before, metric), getattr(result, metric)
+            if metric == "seconds" and max(old, new) < MIN_COMPARABLE_SECONDS:
+                continue
+
+            change = (new - old) / old if old else 0.0
+            log.info(f"{result.id} : {metric} {old:.3f} -> {new:.3f} ({change:+.1%})")
+            if change > tolerance:
+                regressions.append(f"{result.id} : {metric} regressed {change:+.1%} ({old:.3f} -> {new:.3f})")
+
+    return regressions
@@ -0,0 +1,566 @@
+"""Simulator of the ingest path, from S3 events through the trigger Lambda to Batch conversions
+
+Replays a synthetic stream of uploads, with a configurable rate, mix of sizes
+and burstiness, through the real ``handler.main`` of the trigger Lambda. S3 is
+a local S3 compatible server (moto's threaded server) and Batch is
+``LocalBatch``, which queues the submitted jobs and runs each one as
+``s3-to-cog`` in a new process, at most ``concurrency`` at once like a compute
+environment with that many jobs' worth of vCPUs.
+
+Reports the objects converted per second, percentiles of the latency from
+upload to output, the queue depth over time and the mean time per object of
+each stage (the trigger, waiting in the queue, process start up and each stage
+of the conversion), to size compute environments and catch throughput
+regressions.
+
+Run with ``python -m benchmarks.ingest``.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import boto3
+import numpy as np
+
+from benchmarks.clients import local_s3_server
+from benchmarks.harness import DEFAULT_TOLERANCE
+from benchmarks.synthetic import RasterCase, write_synthetic
+from convert.manifest import load_manifest
+
+log = logging.getLogger(__name__)
+
+INPUT_BUCKET = "ingest-input"
+OUTPUT_BUCKET = "ingest-output"
+UPLOAD_PREFIX = "uploads/"
+
+# The trigger Lambda is deployed as a flat directory alongside the convert package
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "lambda")
+CONVERT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "s3-to-cog")
+
+# Width and height in pixels of the synthetic uploads, with the weight of each
+DEFAULT_SIZES = {512: 3, 2048: 1}
+
+# Latency percentiles reported, and the one compared against a baseline
+PERCENTILES = (50, 90, 99)
+COMPARED_PERCENTILE = "p90"
+
+
+@dataclass
+class Arrival:
+    """An upload of the synthetic stream"""
+
+    # Seconds after the start of the stream
+    at: float
+    key: str
+    # Width and height of the raster in pixels
+    size: int
+
+
+@dataclass
+class LocalJob:
+    """A job, or a child of an array job, run by ``LocalBatch``"""
+
+    job_id: str
+    key: str
+    environment: Dict[str, str]
+    # Seconds since the start of the simulation
+    submitted: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    returncode: Optional[int] = None
+    # Stage timings of the conversion, from its metrics record
+    metrics: Dict[str, float] = field(default_factory=dict)
+    output: str = ""
+
+
+@dataclass
+class IngestResult:
+    """Throughput, latency and queueing of one simulated stream"""
+
+    params: Dict[str, Any]
+    objects: int
+    # Jobs submitted by the trigger, and those that failed
+    submitted: int
+    failed: int
+    # Seconds from the first upload until the last job finished
+    seconds: float
+    objects_per_second: float
+    # Seconds from upload to output of each converted object, e.g. p50, p90, p99 and max
+    latency_seconds: Dict[str, float]
+    # Mean seconds per object of each stage
+    stage_seconds: Dict[str, float]
+    # Seconds since the start, queued jobs and running jobs of each sample
+    queue_depth: List[Tuple[float, int, int]]
+    max_queue_depth: int
+    # Fraction of the job slots that were busy
+    utilisation: float
+
+
+def synthetic_arrivals(
+    objects: int, rate: float, sizes: Dict[int, float] = DEFAULT_SIZES, burst: int = 1, seed: int = 0
+) -> List[Arrival]:
+    """Uploads arriving in bursts of ``burst`` objects at a mean of ``rate`` objects per second
+
+    Bursts start at exponentially distributed intervals (a Poisson process) and
+    the size of each object is drawn from ``sizes`` by weight.
+    """
+    rng = np.random.default_rng(seed)
+    gaps = rng.exponential(burst / rate, math.ceil(objects / burst))
+    gaps[0] = 0.0
+    starts = np.cumsum(gaps)
+
+    weights = np.array(list(sizes.values()), dtype="float64")
+    chosen = rng.choice(list(sizes), objects, p=weights / weights.sum())
+    return [
+        Arrival(float(starts[ix // burst]), f"{UPLOAD_PREFIX}{ix:06d}.tif", int(chosen[ix])) for ix in range(objects)
+    ]
+
+
+def conversion_metrics(output: str) -> Dict[str, float]:
+    """Metrics of the conversion from the output of ``s3-to-cog`` with the ``emf`` metrics sink"""
+    for line in output.splitlines():
+        if not line.startswith("{"):
+            continue
+        try:
+            document = json.loads(line)
+        except ValueError:
+            continue
+        if document.get("name") == "to_cog" and "_aws" in document:
+            names = [metric["Name"] for metric in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+            return {name: document[name] for name in names}
+    return {}
+
+
+class LocalBatch:
+    """Stand-in for the Batch client of the trigger Lambda, running each job as an ``s3-to-cog`` process
+
+    ``submit_job`` takes the arguments of boto3's, queues the job (each child of
+    an array job on its own) and returns straight away. Up to ``concurrency``
+    jobs run at once in submission order, each in a new process as in a new
+    container, so the start up of the interpreter and its imports is counted.
+    """
+
+    def __init__(self, concurrency: int, environment: Dict[str, str], clock: Callable[[], float]):
+        """
+        Parameters
+        ----------
+        concurrency : int
+            Jobs run at once
+        environment : Dict[str, str]
+            Environment of every job, which the container overrides add to
+        clock : Callable[[], float]
+            Seconds since the start of the simulation
+        """
+        self.concurrency = concurrency
+        self.jobs: List[LocalJob] = []
+        self._environment = environment
+        self._clock = clock
+        self._queue: "queue.Queue[Optional[LocalJob]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._running = 0
+        self._slots = [threading.Thread(target=self._run_jobs, daemon=True) for _ in range(concurrency)]
+        for slot in self._slots:
+            slot.start()
+
+    def submit_job(
+        self,
+        jobName: str,
+        jobDefinition: str,
+        jobQueue: str,
+        containerOverrides: Dict[str, Any],
+        arrayProperties: Optional[Dict[str, int]] = None,
+        **kwargs,
+    ) -> Dict[str, str]:
+        environment = {env["name"]: env["value"] for env in containerOverrides.get("environment", [])}
+        with self._lock:
+            self._submitted += 1
+            job_id = f"local-{self._submitted}"
+
+        if arrayProperties:
+            tasks = load_manifest(environment["INPUT_MANIFEST"])
+            children = [
+                LocalJob(
+                    f"{job_id}:{ix}",
+                    task.key,
+                    {**environment, "AWS_BATCH_JOB_ARRAY_INDEX": str(ix)},
+                    self._clock(),
+                )
+                for ix, task in enumerate(tasks)
+            ]
+        else:
+            children = [LocalJob(job_id, environment["INPUT_S3_KEY"], environment, self._clock())]
+
+        with self._lock:
+            self.jobs.extend(children)
+        for child in children:
+            self._queue.put(child)
+        return {"jobId": job_id, "jobName": jobName}
+
+    def depth(self) -> Tuple[int, int]:
+        """Jobs waiting in the queue and jobs running"""
+        with self._lock:
+            return self._queue.qsize(), self._running
+
+    def join(self) -> None:
+        """Wait for every submitted job to finish"""
+        self._queue.join()
+
+    def close(self) -> None:
+        for _ in self._slots:
+            self._queue.put(None)
+        for slot in self._slots:
+            slot.join()
+
+    def _run_jobs(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+
+            with self._lock:
+                self._running += 1
+            job.started = self._clock()
+            try:
+                process = subprocess.run(
+                    [sys.executable, CONVERT_SCRIPT],
+                    env={**self._environment, **job.environment},
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                )
+                job.returncode, job.output = process.returncode, process.stdout
+                job.metrics = conversion_metrics(process.stdout)
+            finally:
+                job.finished = self._clock()
+                with self._lock:
+                    self._running -= 1
+                self._queue.task_done()
+
+
+@contextlib.contextmanager
+def trigger_handler(batch: LocalBatch) -> Iterator[Callable[[Dict, Any], Dict]]:
+    """The ``main`` of the trigger Lambda, configured to submit to ``batch`` and convert to ``OUTPUT_BUCKET``"""
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    import handler
+
+    settings = {
+        "OUTPUT_S3_BUCKET": OUTPUT_BUCKET,
+        "BATCH_JOB_DEFINITION": "local-job-definition",
+        "BATCH_JOB_QUEUE": "local-job-queue",
+        "BATCH_TIERS": "",
+        "DIRECT_CONVERT_FUNCTION": "",
+    }
+    environ, clients = dict(os.environ), handler._clients
+    os.environ.update(settings)
+    handler._clients = {"batch": batch}
+    try:
+        # the handler prints every event and decision
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            yield handler.main
+    finally:
+        handler._clients = clients
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def _percentiles(values: Sequence[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    found = {f"p{percentile}": float(np.percentile(values, percentile)) for percentile in PERCENTILES}
+    found["max"] = float(max(values))
+    return found
+
+
+def _summarise(
+    params: Dict[str, Any],
+    arrivals: List[Arrival],
+    uploaded: Dict[str, float],
+    triggers: List[float],
+    batch: LocalBatch,
+    samples: List[Tuple[float, int, int]],
+) -> IngestResult:
+    """Throughput, latency and stage timings of a finished simulation"""
+    jobs = [job for job in batch.jobs if job.finished is not None]
+    failed = [job for job in jobs if job.returncode != 0]
+    for job in failed:
+        log.warning(f"Job {job.job_id} for {job.key} failed : {job.output.strip().splitlines()[-1:]}")
+    done = [job for job in jobs if job.returncode == 0]
+
+    first = min(uploaded.values(), default=0.0)
+    seconds = max((job.finished for job in jobs), default=first) - first
+    latencies = [job.finished - uploaded[job.key] for job in done]
+
+    stages: Dict[str, List[float]] = {
+        "trigger": triggers,
+        "queue": [job.started - job.submitted for job in jobs],
+        "startup": [job.finished - job.started - job.metrics["total_seconds"] for job in done if job.metrics],
+    }
+    for job in done:
+        for name, value in job.metrics.items():
+            if name.endswith("_seconds") and name != "total_seconds":
+                stages.setdefault(name[: -len("_seconds")], []).append(value)
+    busy = sum(job.finished - job.started for job in jobs)
+
+    return IngestResult(
+        params=params,
+        objects=len(arrivals),
+        submitted=len(batch.jobs),
+        failed=len(failed),
+        seconds=seconds,
+        objects_per_second=len(done) / seconds if seconds > 0 else 0.0,
+        latency_seconds=_percentiles(latencies),
+        stage_seconds={name: float(np.mean(values)) for name, values in stages.items() if values},
+        queue_depth=samples,
+        max_queue_depth=max((queued for _, queued, _ in samples), default=0),
+        utilisation=busy / (batch.concurrency * seconds) if seconds > 0 else 0.0,
+    )
+
+
+def simulate(
+    objects: int = 20,
+    rate: float = 2.0,
+    sizes: Dict[int, float] = DEFAULT_SIZES,
+    burst: int = 1,
+    concurrency: int = 2,
+    lambda_concurrency: int = 4,
+    sample_interval: float = 0.5,
+    seed: int = 0,
+    scratch_dir: Optional[str] = None,
+) -> IngestResult:
+    """Replay a synthetic stream of uploads through the trigger and local Batch jobs
+
+    Parameters
+    ----------
+    objects : int, optional
+        Objects uploaded
+    rate : float, optional
+        Mean uploads per second
+    sizes : Dict[int, float], optional
+        Width and height in pixels of the uploads, with the weight of each
+    burst : int, optional
+        Objects uploaded at once in each burst, 1 for a steady stream
+    concurrency : int, optional
+        Batch jobs run at once
+    lambda_concurrency : int, optional
+        Invocations of the trigger run at once
+    sample_interval : float, optional
+        Seconds between samples of the queue depth
+    seed : int, optional
+        Seed of the arrivals and sizes
+    scratch_dir : str, optional
+        Directory for the synthetic rasters
+
+    Returns
+    -------
+    IngestResult
+        Throughput, latency percentiles, queue depth over time and stage timings
+    """
+    params = {
+        "objects": objects,
+        "rate": rate,
+        "sizes": {str(size): weight for size, weight in sizes.items()},
+        "burst": burst,
+        "concurrency": concurrency,
+        "lambda_concurrency": lambda_concurrency,
+    }
+    arrivals = synthetic_arrivals(objects, rate, sizes, burst, seed)
+    log.info(
+        f"Simulating {objects} uploads at {rate} per second in bursts of {burst} "
+        f"with {concurrency} Batch job(s) at once"
+    )
+
+    with tempfile.TemporaryDirectory(prefix="ingest-", dir=scratch_dir) as tmp_dir, local_s3_server():
+        sources = {}
+        for size in sorted({arrival.size for arrival in arrivals}):
+            path = os.path.join(tmp_dir, f"{size}.tif")
+            write_synthetic(path, RasterCase(size, size))
+            with open(path, "rb") as fh:
+                sources[size] = fh.read()
+
+        s3 = boto3.client("s3")
+        for bucket in (INPUT_BUCKET, OUTPUT_BUCKET):
+            s3.create_bucket(Bucket=bucket)
+
+        start = time.perf_counter()
+
+        def clock() -> float:
+            return time.perf_counter() - start
+
+        environment = dict(os.environ, METRICS_SINKS="emf")
+        batch = LocalBatch(concurrency, environment, clock)
+        samples: List[Tuple[float, int, int]] = []
+        finished = threading.Event()
+
+        def sample() -> None:
+            while not finished.wait(sample_interval):
+                samples.append((clock(), *batch.depth()))
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        uploaded: Dict[str, float] = {}
+        triggers: List[float] = []
+
+        with trigger_handler(batch) as main:
+
+            def trigger(event: Dict) -> None:
+                begin = time.perf_counter()
+                main(event, None)
+                triggers.append(time.perf_counter() - begin)
+
+            sampler.start()
+            try:
+                with ThreadPoolExecutor(max_workers=lambda_concurrency) as lambdas:
+                    invocations = []
+                    for arrival in arrivals:
+                        delay = arrival.at - clock()
+                        if delay > 0:
+                            time.sleep(delay)
+                        body = sources[arrival.size]
+                        etag = s3.put_object(Bucket=INPUT_BUCKET, Key=arrival.key, Body=body)["ETag"]
+                        uploaded[arrival.key] = clock()
+                        record = {
+                            "s3": {
+                                "bucket": {"name": INPUT_BUCKET},
+                                "object": {"key": arrival.key, "eTag": etag.strip('"'), "size": len(body)},
+                            }
+                        }
+                        invocations.append(lambdas.submit(trigger, {"Records": [record]}))
+                for invocation in invocations:
+                    invocation.result()
+                batch.join()
+            finally:
+                finished.set()
+                sampler.join()
+                batch.close()
+
+        result = _summarise(params, arrivals, uploaded, triggers, batch, samples)
+
+    log.info(
+        f"Converted {result.objects - result.failed} of {result.objects} objects in {result.seconds:.2f}s "
+        f"({result.objects_per_second:.2f} objects/s, {result.failed} failed), "
+        f"latency {', '.join(f'{name} {value:.2f}s' for name, value in result.latency_seconds.items())}, "
+        f"max queue depth {result.max_queue_depth}, utilisation {result.utilisation:.0%}"
+    )
+    return result
+
+
+def compare(result: IngestResult, baseline: IngestResult, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """Regressions of the throughput and latency of ``result`` relative to ``baseline``"""
+    regressions = []
+    old, new = baseline.objects_per_second, result.objects_per_second
+    if old and (old - new) / old > tolerance:
+        regressions.append(f"objects_per_second regressed {(new - old) / old:+.1%} ({old:.3f} -> {new:.3f})")
+
+    old = baseline.latency_seconds.get(COMPARED_PERCENTILE, 0.0)
+    new = result.latency_seconds.get(COMPARED_PERCENTILE, 0.0)
+    if old and (new - old) / old > tolerance:
+        regressions.append(f"{COMPARED_PERCENTILE} latency regressed {(new - old) / old:+.1%} ({old:.3f} -> {new:.3f})")
+    return regressions
+
+
+def save_result(path: str, result: IngestResult) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as fh:
+        json.dump(asdict(result), fh, indent=2)
+    log.info(f"Written the result to {path}")
+
+
+def load_result(path: str) -> IngestResult:
+    with open(path, "r") as fh:
+        document = json.load(fh)
+    document["queue_depth"] = [tuple(sample) for sample in document["queue_depth"]]
+    return IngestResult(**document)
+
+
+def parse_sizes(values: List[str]) -> Dict[int, float]:
+    """Parse ``SIZE=WEIGHT`` (or ``SIZE`` for a weight of 1) pairs"""
+    sizes = {}
+    for value in values:
+        size, _, weight = value.partition("=")
+        sizes[int(size)] = float(weight or 1)
+    return sizes
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Simulate bursts of uploads through the trigger Lambda and local Batch jobs running s3-to-cog"
+    )
+    parser.add_argument("--objects", type=int, default=20, help="Objects uploaded (default: 20)")
+    parser.add_argument("--rate", type=float, default=2.0, help="Mean uploads per second (default: 2)")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=[f"{size}={weight}" for size, weight in DEFAULT_SIZES.items()],
+        help="Width and height of the uploads in pixels, with their weight (default: 512=3 2048=1)",
+    )
+    parser.add_argument("--burst", type=int, default=1, help="Objects uploaded at once in each burst (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=2, help="Batch jobs run at once (default: 2)")
+    parser.add_argument(
+        "--lambda-concurrency", type=int, default=4, help="Invocations of the trigger run at once (default: 4)"
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=0.5, help="Seconds between samples of the queue depth (default: 0.5)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the arrivals and sizes (default: 0)")
+    parser.add_argument("--scratch-dir", help="Directory for the synthetic rasters")
+    parser.add_argument("--output", help="JSON file to write the result to")
+    parser.add_argument("--baseline", help="JSON result of an earlier run, exit with 1 on any regression")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"Allowed relative regression of throughput and latency (default: {DEFAULT_TOLERANCE})",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s.%(funcName)s:L%(lineno)d - %(message)s",
+        datefmt="%y/%m/%d %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    logging.getLogger("botocore").setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    log = logging.getLogger(__file__)
+
+    result = simulate(
+        objects=args.objects,
+        rate=args.rate,
+        sizes=parse_sizes(args.sizes),
+        burst=args.burst,
+        concurrency=args.concurrency,
+        lambda_concurrency=args.lambda_concurrency,
+        sample_interval=args.sample_interval,
+        seed=args.seed,
+        scratch_dir=args.scratch_dir,
+    )
+    for name, seconds in result.stage_seconds.items():
+        log.info(f"{name} : {seconds:.3f}s per object")
+    for at, queued, running in result.queue_depth[:: max(1, len(result.queue_depth) // 20)]:
+        log.info(f"{at:7.1f}s : {queued} queued, {running} running")
+
+    if args.output:
+        save_result(args.output, result)
+    if args.baseline:
+        regressions = compare(result, load_result(args.baseline), args.tolerance)
+        for regression in regressions:
+            log.error(regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,154 @@
+"""Import time of the entry points, checked against a budget
+
+Each entry point is run in a fresh interpreter with ``python -X importtime``.
+Startup regresses when a heavy module (the GDAL bindings, rasterio, rio-cogeo
+or type stubs) is imported at module load on a path that does not use it, so
+every budget lists the modules that must not be imported as well as a time.
+
+Run with ``python -m benchmarks.startup``, which exits with 1 if any entry point
+is over its budget.
+"""
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Directory holding the convert package and scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only some code paths need
+GDAL = ("osgeo",)
+RASTERIO = ("rasterio", "rio_cogeo")
+STUBS = ("mypy_boto3_s3",)
+
+# A line of -X importtime output, "import time: self | cumulative | name" with
+# the name indented by two spaces per level of nesting
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+@dataclass(frozen=True)
+class Budget:
+    """Longest time an entry point may take to import and the modules it must not load"""
+
+    name: str
+    # Arguments to the interpreter after -X importtime
+    args: Tuple[str, ...]
+    seconds: float
+    forbidden: Tuple[str, ...] = ()
+
+
+BUDGETS: List[Budget] = [
+    Budget("convert.s3", ("-c", "import convert.s3"), 0.5, GDAL + RASTERIO + STUBS),
+    Budget("convert.worker", ("-c", "import convert.worker"), 0.5, GDAL + RASTERIO + STUBS),
+    Budget("s3-to-cog --help", (os.path.join(ROOT, "scripts", "s3-to-cog"), "--help"), 0.6, GDAL + RASTERIO + STUBS),
+    Budget("convert.cog", ("-c", "import convert.cog"), 1.5, GDAL + STUBS),
+]
+
+
+@dataclass
+class ImportProfile:
+    """Modules imported by an interpreter and the time each took"""
+
+    # Cumulative time in microseconds by module, including its own imports
+    cumulative_us: Dict[str, int] = field(default_factory=dict)
+    # Modules imported at the top level, rather than by another module
+    top_level: List[str] = field(default_factory=list)
+
+    @property
+    def seconds(self) -> float:
+        """Time spent importing"""
+        return sum(self.cumulative_us[name] for name in self.top_level) / 1e6
+
+    def loaded(self, package: str) -> bool:
+        """Whether ``package`` or any of its submodules was imported"""
+        return any(name == package or name.startswith(f"{package}.") for name in self.cumulative_us)
+
+
+def parse_importtime(output: str) -> ImportProfile:
+    """Parse the -X importtime lines written to stderr"""
+    profile = ImportProfile()
+    for line in output.splitlines():
+        match = _LINE.match(line)
+        if match is None:
+            continue
+        _, cumulative, indent, name = match.groups()
+        profile.cumulative_us[name] = int(cumulative)
+        if not indent:
+            profile.top_level.append(name)
+    return profile
+
+
+def measure(args: Sequence[str], cwd: str = ROOT) -> ImportProfile:
+    """Run the interpreter with ``args`` and profile its imports"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [cwd, os.environ.get("PYTHONPATH")])))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def check(budget: Budget, repeat: int = 3, scale: float = 1.0) -> Tuple[float, List[str]]:
+    """Import time of an entry point and how it breaks its budget
+
+    Parameters
+    ----------
+    budget : Budget
+        Entry point to measure
+    repeat : int, optional
+        Runs to measure, the fastest is kept as the others are slowed by noise
+    scale : float, optional
+        Factor to apply to the budget's time, for slower machines
+
+    Returns
+    -------
+    Tuple[float, List[str]]
+        Seconds spent importing, beyond what the interpreter imports on its
+        own, and a description of each way the budget was broken
+    """
+    baseline = min(measure(["-c", "pass"]).seconds for _ in range(repeat))
+    profiles = [measure(budget.args) for _ in range(repeat)]
+    seconds = max(min(profile.seconds for profile in profiles) - baseline, 0.0)
+
+    problems = [f"{budget.name} imports {module}" for module in budget.forbidden if profiles[0].loaded(module)]
+    limit = budget.seconds * scale
+    if seconds > limit:
+        problems.append(f"{budget.name} takes {seconds:.3f}s to import, over the budget of {limit:.3f}s")
+    return seconds, problems
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Check the import time of the entry points against their budgets")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each entry point, the fastest is kept")
+    parser.add_argument("--scale", type=float, default=1.0, help="Factor to apply to every time budget")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s.%(funcName)s:L%(lineno)d - %(message)s",
+        datefmt="%y/%m/%d %H:%M:%S",
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+    log = logging.getLogger(__file__)
+
+    failed = False
+    for budget in BUDGETS:
+        seconds, problems = check(budget, repeat=args.repeat, scale=args.scale)
+        log.info(f"{budget.name} : {seconds:.3f}s to import (budget {budget.seconds * args.scale:.3f}s)")
+        for problem in problems:
+            log.error(problem)
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,29 @@
+from typing import Dict, List
+
+from benchmarks.synthetic import RasterCase
+
+
+def _unique(cases: List[RasterCase]) -> List[RasterCase]:
+    return list(dict.fromkeys(cases))
+
+
+# Small rasters covering each layout, quick enough to run on every change
+QUICK = [
+    RasterCase(512, 512),
+    RasterCase(512, 512, count=3, dtype="uint8", tiled=True, compress="deflate"),
+    RasterCase(1024, 1024, dtype="float32", compress="lzw"),
+]
+
+# Scaling with size, band count, data type and tiling/compression in turn
+FULL = _unique(
+    [RasterCase(size, size) for size in (1024, 4096, 8192)]
+    + [RasterCase(2048, 2048, count=count, dtype="uint8") for count in (1, 3, 4)]
+    + [RasterCase(2048, 2048, dtype=dtype) for dtype in ("uint8", "uint16", "int16", "float32")]
+    + [
+        RasterCase(2048, 2048, tiled=tiled, compress=compress)
+        for tiled in (False, True)
+        for compress in (None, "deflate", "lzw")
+    ]
+)
+
+SUITES: Dict[str, List[RasterCase]] = {"quick": QUICK, "full": FULL}
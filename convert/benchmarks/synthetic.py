@@ -0,0 +1,97 @@
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+log = logging.getLogger(__name__)
+
+# Synthetic rasters are georeferenced as 30m pixels in UTM zone 30N
+CRS_UTM30N = CRS.from_epsg(32630)
+PIXEL_SIZE = 30.0
+
+# Rows written per block so that generating large rasters uses bounded memory
+ROWS_PER_WRITE = 512
+
+
+@dataclass(frozen=True)
+class RasterCase:
+    """Shape and layout of a synthetic GeoTiff"""
+
+    width: int
+    height: int
+    count: int = 1
+    dtype: str = "uint16"
+    tiled: bool = False
+    compress: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        layout = "tiled" if self.tiled else "striped"
+        return f"{self.width}x{self.height}x{self.count}-{self.dtype}-{layout}-{self.compress or 'none'}"
+
+    @property
+    def raw_size(self) -> int:
+        """Size in bytes of the uncompressed pixels"""
+        return self.width * self.height * self.count * np.dtype(self.dtype).itemsize
+
+
+def _pixels(case: RasterCase, window: Window, rng: np.random.Generator) -> np.ndarray:
+    """Smooth gradients plus noise, so that compression ratios are realistic"""
+    rows = np.arange(window.row_off, window.row_off + window.height, dtype="float64")[:, None]
+    cols = np.arange(window.col_off, window.col_off + window.width, dtype="float64")[None, :]
+
+    info = np.iinfo(case.dtype) if np.issubdtype(np.dtype(case.dtype), np.integer) else None
+    scale = min(info.max, 10000) if info else 1.0
+
+    bands = []
+    for band in range(case.count):
+        signal = np.sin(rows / (97.0 + band * 13)) * np.cos(cols / (61.0 + band * 7))
+        noise = rng.normal(0, 0.05, (int(window.height), int(window.width)))
+        bands.append((signal + noise + 1.5) / 3.0 * scale)
+
+    data = np.stack(bands)
+    if info:
+        data = np.clip(data, 1, info.max)
+    return data.astype(case.dtype)
+
+
+def write_synthetic(path: str, case: RasterCase, seed: int = 0) -> None:
+    """Write a synthetic GeoTiff described by ``case`` to ``path``
+
+    Parameters
+    ----------
+    path : str
+        Output path, may be a /vsimem/ path
+    case : RasterCase
+        Size, bands, data type, tiling and compression of the raster
+    seed : int, optional
+        Seed of the noise, so that runs are repeatable
+    """
+    profile = {
+        "driver": "GTiff",
+        "width": case.width,
+        "height": case.height,
+        "count": case.count,
+        "dtype": case.dtype,
+        "crs": CRS_UTM30N,
+        "transform": from_origin(500000.0, 6000000.0, PIXEL_SIZE, PIXEL_SIZE),
+        "nodata": 0,
+        "tiled": case.tiled,
+        "BIGTIFF": "IF_SAFER",
+    }
+    if case.tiled:
+        profile.update(blockxsize=256, blockysize=256)
+    if case.compress:
+        profile["compress"] = case.compress
+
+    log.debug(f"Writing synthetic raster {case.name} to {path}")
+    rng = np.random.default_rng(seed)
+    with rasterio.open(path, "w", **profile) as dst:
+        for row in range(0, case.height, ROWS_PER_WRITE):
+            window = Window(0, row, case.width, min(ROWS_PER_WRITE, case.height - row))
+            dst.write(_pixels(case, window, rng), window=window)
@@ -0,0 +1,149 @@
+"""Process wide registry of boto3 sessions and clients
+
+Creating a session resolves credentials and creating a client loads its service
+model and opens a connection pool, which together take far longer than a small
+request. Sessions and clients are created once per region and role and shared
+by every ``S3Helper`` in the process. boto3 clients are thread safe, but
+neither sessions nor clients survive a fork, so a forked child process starts a
+registry of its own, with a new lock in case another thread held it.
+"""
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+from uuid import uuid4
+
+import boto3
+from botocore.config import Config
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3.client import S3Client
+
+log = logging.getLogger(__name__)
+
+# Connections kept open per client. Ranged transfers of several outputs share
+# a client, so this covers S3_MAX_CONCURRENCY requests for each of them
+MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 64))
+
+# Retries of throttled and failed requests, adaptive mode also slows the client
+# down when S3 throttles it, see
+# https://boto3.amazonaws.com/v1/documentation/api/latest/guide/retries.html
+RETRY_MODE = os.environ.get("S3_RETRY_MODE", "adaptive")
+MAX_ATTEMPTS = int(os.environ.get("S3_MAX_ATTEMPTS", 10))
+
+# Key of sessions by region and role ARN, None for the defaults
+_Key = Tuple[Optional[str], Optional[str]]
+
+_lock = threading.Lock()
+_sessions: Dict[_Key, boto3.Session] = {}
+_clients: Dict[Tuple[str, Optional[str], Optional[str]], Any] = {}
+
+
+def client_config() -> Config:
+    """botocore config of every client, with a larger pool, retries and TCP keepalive"""
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+        tcp_keepalive=True,
+    )
+
+
+def _after_fork_in_child() -> None:
+    """Forget the sessions and clients of the parent, and its lock, which another of its threads may have held"""
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _assume_role(base: boto3.Session, role_arn: str, region: Optional[str]) -> boto3.Session:
+    """Session with credentials of ``role_arn``, assumed with those of ``base`` and refreshed before they expire"""
+    from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+    from botocore.session import Session as BotocoreSession
+
+    fetcher = AssumeRoleCredentialFetcher(
+        client_creator=base._session.create_client,
+        source_credentials=base.get_credentials(),
+        role_arn=role_arn,
+        extra_args={"RoleSessionName": f"aws-gdal-robot-{uuid4().hex[:8]}"},
+    )
+    botocore_session = BotocoreSession()
+    # botocore has no public way to give a session refreshable credentials
+    botocore_session._credentials = DeferredRefreshableCredentials(
+        method="assume-role", refresh_using=fetcher.fetch_credentials
+    )
+    return boto3.Session(botocore_session=botocore_session, region_name=region or base.region_name)
+
+
+def _get_session(region: Optional[str], role_arn: Optional[str]) -> boto3.Session:
+    """``get_session`` for a caller holding the lock"""
+    key = (region, role_arn)
+    if key not in _sessions:
+        if role_arn:
+            _sessions[key] = _assume_role(_get_session(region, None), role_arn, region)
+        else:
+            _sessions[key] = boto3.Session(region_name=region)
+    return _sessions[key]
+
+
+def get_session(region: Optional[str] = None, role_arn: Optional[str] = None) -> boto3.Session:
+    """Get the boto3 session of this process for a region and role
+
+    Parameters
+    ----------
+    region : str, optional
+        Region of the session, defaults to that of the environment
+    role_arn : str, optional
+        Role to assume, defaults to the credentials of the environment
+
+    Returns
+    -------
+    boto3.Session
+        Session shared by every caller in this process
+    """
+    with _lock:
+        return _get_session(region, role_arn)
+
+
+def get_client(service: str, region: Optional[str] = None, role_arn: Optional[str] = None) -> Any:
+    """Get the shared boto3 client of a service for a region and role
+
+    Clients are made with ``client_config`` and are safe to use from several
+    threads at once.
+
+    Parameters
+    ----------
+    service : str
+        Name of the service, e.g. s3
+    region : str, optional
+        Region of the client, defaults to that of the environment
+    role_arn : str, optional
+        Role to assume, defaults to the credentials of the environment
+
+    Returns
+    -------
+    Any
+        Client shared by every caller in this process
+    """
+    with _lock:
+        key = (service, region, role_arn)
+        if key not in _clients:
+            log.debug(f"Creating {service} client for region {region} and role {role_arn}")
+            _clients[key] = _get_session(region, role_arn).client(service, config=client_config())
+        return _clients[key]
+
+
+def get_s3_client(region: Optional[str] = None, role_arn: Optional[str] = None) -> "S3Client":
+    """Get the shared S3 client for a region and role, see ``get_client``"""
+    return get_client("s3", region, role_arn)
+
+
+def reset() -> None:
+    """Forget every session and client, e.g. after changing the credentials or endpoint in the environment"""
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
@@ -1,18 +1,155 @@
+import fcntl
+import hashlib
+import io
 import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field, replace
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from uuid import uuid4
 
 import rasterio
+import rasterio.shutil
 from rasterio.io import MemoryFile
 from rio_cogeo.cogeo import cog_translate
 from rio_cogeo.profiles import cog_profiles
 
+from convert.compression import AUTO, Selection, auto_options, select_compression
+from convert.engine import ENGINE, ENGINE_WORKERS, PreviousCog, copy_plan, unsupported_reason, write_cog
+from convert.fingerprint import FINGERPRINT_KEY, fingerprint, is_current, output_metadata
+from convert import footprints
+from convert.footprints import Footprint, record_outputs
+from convert.incremental import (
+    INCREMENTAL,
+    TileSidecar,
+    load_sidecar,
+    settings_digest,
+    sidecar_key,
+    source_layout,
+)
+from convert.metrics import Recorder, peak_rss_mib
+from convert.runtime import container_resources, select_profile
 from convert.s3 import S3Helper
 
 log = logging.getLogger(__name__)
 
+MiB = 1024 * 1024
 
-def to_cog(bucket: str, key: str, out_bucket: str, out_key: str) -> None:
+# Inputs larger than this many bytes are converted via local scratch files
+# rather than in memory, so that peak memory does not scale with raster size
+IN_MEMORY_MAX_BYTES = int(os.environ.get("COG_IN_MEMORY_MAX_BYTES", 256 * MiB))
+
+# Directory for scratch files, defaults to the system temp directory
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR")
+
+# GDAL block cache size (MB) used when converting on disk, overriding that of
+# the runtime profile
+ON_DISK_GDAL_CACHEMAX = os.environ.get("COG_ON_DISK_GDAL_CACHEMAX")
+
+# Name of the downloaded source in the scratch directory
+SOURCE_NAME = "source.tif"
+
+# Name of the file locked by the conversion using a resumable scratch directory
+LOCK_NAME = "lock"
+
+# Resume interrupted conversions ("on") or always start again ("off"). When
+# resuming, the scratch directory of an on disk conversion is kept if it fails
+# so a retry only downloads the rest of the source, and unfinished uploads are
+# continued rather than aborted. Neither is taken from a conversion of the same
+# source that is still running, see _work_dir and RESUME_IDLE_SECONDS
+RESUME = os.environ.get("COG_RESUME", "on")
+
+# How the source is read, "download" to fetch the whole object first or
+# "stream" to read only the ranges needed in place through GDAL's /vsis3/,
+# converting with scratch files as on disk. Streaming saves the download and
+# scratch space for the source but reads are slower, and the source's tiles
+# are never copied into the output
+READ_MODE = os.environ.get("COG_READ_MODE", "download")
+READ_MODES = ("download", "stream")
+
+# Leave tiles that are all nodata out of the COGs ("on") or store them ("off").
+# Sparse tiles have an offset and byte count of 0 and are read as nodata, at
+# every level, see GDAL's SPARSE_OK creation option
+SPARSE = os.environ.get("COG_SPARSE", "on")
+
+# Number of outputs of the same source that are written in parallel
+OUTPUT_CONCURRENCY = int(os.environ.get("COG_OUTPUT_CONCURRENCY", 4))
+
+
+@dataclass
+class OutputSpec:
+    """A COG to write from the source"""
+
+    out_key: str
+    # A rio-cogeo profile, or "auto" to choose the compression from the source
+    profile: str = "deflate"
+    # Creation options that override those of the profile
+    options: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class OutputResult:
+    """Outcome of writing a single output"""
+
+    spec: OutputSpec
+    # False when the output was already up to date so nothing was written
+    converted: bool
+    size: int = 0
+    seconds: float = 0.0
+
+
+@dataclass
+class _PendingOutput:
+    spec: OutputSpec
+    dst_profile: Dict[str, Any]
+    metadata: Dict[str, str]
+    # User metadata of the output being replaced, None if there is none
+    existing: Optional[Dict[str, str]] = None
+    # Footprint of the output for the index, see convert.footprints
+    footprint: Optional[Footprint] = None
+
+
+def output_specs(out_key: str, profiles: List[str]) -> List[OutputSpec]:
+    """Specs writing the source with each of ``profiles``
+
+    The first profile is written to ``out_key`` and the others alongside it,
+    with the profile name appended e.g. ``a-cog.tif`` and ``a-cog-webp.tif``.
+    """
+    root, ext = os.path.splitext(out_key)
+    return [
+        OutputSpec(out_key if ix == 0 else f"{root}-{profile}{ext}", profile) for ix, profile in enumerate(profiles)
+    ]
+
+
+def to_cog(
+    bucket: str,
+    key: str,
+    out_bucket: str,
+    out_key: Union[str, List[OutputSpec]],
+    in_memory_max_bytes: int = IN_MEMORY_MAX_BYTES,
+    scratch_dir: Optional[str] = SCRATCH_DIR,
+    force: bool = False,
+    max_workers: int = OUTPUT_CONCURRENCY,
+    read_mode: str = READ_MODE,
+) -> bool:
     """Convert the given S3 bucket/key to Cloud Optimised GeoTiff
 
+    Small inputs are converted entirely in memory. Inputs larger than
+    ``in_memory_max_bytes`` are downloaded to a local scratch file, converted
+    using on disk temporary files and uploaded by streaming from disk.
+
+    Each output records a fingerprint of its source object (bucket, key, ETag
+    and version) and the COG profile in its S3 metadata. If the existing
+    output already has the same fingerprint the conversion is skipped.
+
+    A conversion that is retried after being interrupted picks up where it
+    stopped, see ``RESUME``. The source is only downloaded again if the scratch
+    directory was lost, and parts of the output already uploaded are reused.
+
     Parameters
     ----------
     bucket : str
@@ -21,25 +158,684 @@ def to_cog(bucket: str, key: str, out_bucket: str, out_key: str) -> None:
         Input S3 key to convert
     out_bucket : str
         Output S3 bucket where COG will be saved
-    out_key : str
-        Key (filename) of the COG saved in ``out_bucket``
+    out_key : str or List[OutputSpec]
+        Key (filename) of the COG saved in ``out_bucket`` with the deflate
+        profile, or a spec for each of several COGs to write from the source
+    in_memory_max_bytes : int, optional
+        Largest input size (in bytes) that is converted in memory
+    scratch_dir : str, optional
+        Directory for scratch files when converting on disk, defaults to the
+        system temp directory
+    force : bool, optional
+        Convert even if the output is already up to date
+    max_workers : int, optional
+        Number of outputs to write in parallel
+    read_mode : str, optional
+        Download the source ("download") or read it in place ("stream"), see
+        ``READ_MODE``
+
+    Returns
+    -------
+    bool
+        True if a conversion was run, False if every output was already current
+    """
+    outputs = [OutputSpec(out_key)] if isinstance(out_key, str) else out_key
+    results = to_cogs(
+        bucket, key, out_bucket, outputs, in_memory_max_bytes, scratch_dir, force, max_workers, read_mode
+    )
+    return any(result.converted for result in results)
+
+
+def to_cogs(
+    bucket: str,
+    key: str,
+    out_bucket: str,
+    outputs: List[OutputSpec],
+    in_memory_max_bytes: int = IN_MEMORY_MAX_BYTES,
+    scratch_dir: Optional[str] = SCRATCH_DIR,
+    force: bool = False,
+    max_workers: int = OUTPUT_CONCURRENCY,
+    read_mode: str = READ_MODE,
+) -> List[OutputResult]:
+    """Convert the given S3 bucket/key to one COG per output spec
+
+    The source is downloaded once and shared by every output. When there are
+    several outputs a compressed source is also decoded once, to an
+    uncompressed scratch copy, rather than by each output in turn. Outputs
+    are then written in parallel.
+
+    One metrics record is emitted per call with the time spent in each stage
+    (check, download, decode, translate and upload), the bytes transferred
+    and the peak memory, see ``convert.metrics``. When streaming, the bytes
+    of the source that were fetched are recorded as ``stream_bytes``.
+
+    See ``to_cog`` for the parameters.
+
+    Returns
+    -------
+    List[OutputResult]
+        Result of each output, in the order of ``outputs``
+    """
+    if read_mode not in READ_MODES:
+        raise ValueError(f"Unknown read mode {read_mode!r}, expected one of {list(READ_MODES)}")
+
+    recorder = Recorder("to_cog", {"mode": "memory"})
+    recorder.set_property("source", f"{bucket}/{key}")
+    recorder.set_property("outputs", [f"{out_bucket}/{spec.out_key}" for spec in outputs])
+    try:
+        results = _to_cogs(
+            bucket, key, out_bucket, outputs, in_memory_max_bytes, scratch_dir, force, max_workers, read_mode, recorder
+        )
+    except Exception as e:
+        recorder.set_property("error", type(e).__name__)
+        raise
+    finally:
+        recorder.emit()
+
+    log.info(f"Peak memory usage : {peak_rss_mib():.1f} MiB")
+    return results
+
+
+def _to_cogs(
+    bucket: str,
+    key: str,
+    out_bucket: str,
+    outputs: List[OutputSpec],
+    in_memory_max_bytes: int,
+    scratch_dir: Optional[str],
+    force: bool,
+    max_workers: int,
+    read_mode: str,
+    recorder: Recorder,
+) -> List[OutputResult]:
+    # Setup connection to S3
+    resume = RESUME != "off"
+    in_s3 = S3Helper(bucket, resume=resume)
+    out_s3 = S3Helper(out_bucket, resume=resume)
+
+    # Skip the outputs that were already made from this source
+    with recorder.stage("check"):
+        source = in_s3.head(key)
+        recorder.add("source_bytes", source.size)
+
+        results = [OutputResult(spec, converted=False) for spec in outputs]
+        pending = []
+        for spec in outputs:
+            # The auto profile is resolved once the source has been read
+            dst_profile = auto_options() if spec.profile == AUTO else cog_profiles.get(spec.profile)
+            dst_profile.update(spec.options)
+
+            digest = fingerprint(bucket, key, source.etag, source.version_id, spec.profile, dict(dst_profile))
+            existing = out_s3.get_metadata(spec.out_key)
+            if not force and is_current(existing, digest):
+                log.info(f"Output {out_bucket}/{spec.out_key} is already up to date, skipping conversion")
+                recorder.add("cached_count", 1)
+                continue
+            metadata = output_metadata(bucket, key, source.etag, spec.profile, digest)
+            pending.append(_PendingOutput(spec, dst_profile, metadata, existing))
+
+    if not pending:
+        return results
+
+    # Decide how to convert based on the read mode and input size
+    if read_mode == "stream":
+        log.info(f"Input is {source.size} bytes, converting from a stream")
+        recorder.dimensions["mode"] = "stream"
+        with tempfile.TemporaryDirectory(prefix="to-cog-", dir=scratch_dir) as tmp_dir:
+            written = _to_cogs_streamed(in_s3, key, source.size, out_s3, pending, max_workers, tmp_dir, recorder)
+    elif source.size <= in_memory_max_bytes:
+        log.info(f"Input is {source.size} bytes, converting in memory")
+        written = _to_cogs_in_memory(in_s3, key, source.size, out_s3, pending, max_workers, recorder)
+    else:
+        log.info(f"Input is {source.size} bytes (> {in_memory_max_bytes}), converting on disk")
+        recorder.dimensions["mode"] = "disk"
+        source_id = f"{bucket}/{key}/{source.etag}/{source.version_id}"
+        with _work_dir(scratch_dir, source_id, resume) as tmp_dir:
+            written = _to_cogs_on_disk(in_s3, key, source.size, out_s3, pending, max_workers, tmp_dir, recorder)
+
+    recorder.add("download_bytes", in_s3.bytes_in)
+    recorder.add("upload_bytes", out_s3.bytes_out)
+    recorder.add("resumed_bytes", in_s3.bytes_resumed + out_s3.bytes_resumed)
+    recorder.add("converted_count", len(written))
+    _index_outputs(out_s3, pending, written, recorder)
+
+    by_key = {result.spec.out_key: result for result in written}
+    results = [by_key.get(result.spec.out_key, result) for result in results]
+
+    for result in written:
+        log.info(
+            f"Output {out_bucket}/{result.spec.out_key} ({result.spec.profile}) : "
+            f"{result.size / MiB:.2f} MiB in {result.seconds:.2f}s"
+        )
+    return results
+
+
+@contextmanager
+def _work_dir(scratch_dir: Optional[str], source_id: str, resume: bool) -> Iterator[str]:
+    """Scratch directory for an on disk conversion, removed once it is done
+
+    When resuming, the directory is named after the source and is kept if the
+    conversion fails, so that a retry finds the partly downloaded source and
+    its checkpoint. Anything else a failed attempt left behind is removed.
+
+    The directory is locked while it is used, the lock is released when the
+    process exits however it stops. If another conversion of the same source
+    holds it, e.g. for a duplicate S3 notification, a directory of its own is
+    used instead and nothing is resumed.
+    """
+    if resume:
+        digest = hashlib.sha256(source_id.encode()).hexdigest()[:16]
+        tmp_dir = os.path.join(scratch_dir or tempfile.gettempdir(), f"to-cog-{digest}")
+        lock = _lock_dir(tmp_dir)
+        if lock is None:
+            log.warning(f"Scratch directory {tmp_dir} is in use by another conversion, not resuming")
+    if not resume or lock is None:
+        with tempfile.TemporaryDirectory(prefix="to-cog-", dir=scratch_dir) as tmp_dir:
+            yield tmp_dir
+        return
+
+    with lock:
+        for name in os.listdir(tmp_dir):
+            if name not in (SOURCE_NAME, f"{SOURCE_NAME}.checkpoint", LOCK_NAME):
+                path = os.path.join(tmp_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+        try:
+            yield tmp_dir
+        except BaseException:
+            log.warning(f"Keeping scratch directory {tmp_dir} so a retry can resume")
+            raise
+
+        # Move the directory aside while still holding the lock, so that a
+        # conversion starting now makes a new one rather than using this one
+        removed = f"{tmp_dir}-{uuid4().hex}"
+        os.rename(tmp_dir, removed)
+    shutil.rmtree(removed, ignore_errors=True)
+
+
+def _lock_dir(path: str) -> Optional[BinaryIO]:
+    """Create the directory and lock it, or None if another process holds the lock"""
+    os.makedirs(path, exist_ok=True)
+    lock_path = os.path.join(path, LOCK_NAME)
+    lock = open(lock_path, "ab")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # The holder may have moved the directory aside before releasing it
+        if os.stat(lock_path).st_ino == os.fstat(lock.fileno()).st_ino:
+            return lock
+    except OSError:
+        pass
+    lock.close()
+    return None
+
+
+@contextmanager
+def _decoded_source(src_path: str, decoded_path: str, outputs: int, recorder: Recorder) -> Iterator[str]:
+    """Path to read the source from, decoding it once if it is shared
+
+    A compressed source used by several outputs is copied to an uncompressed
+    tiled GeoTiff at ``decoded_path`` (removed afterwards), so that each output
+    reads raw blocks instead of decompressing the whole source again.
+    """
+    with rasterio.open(src_path) as src:
+        decode = outputs > 1 and src.compression is not None
+        if decode:
+            log.info(f"Decoding {src.compression.value} source once for {outputs} outputs")
+            with recorder.stage("decode"):
+                rasterio.shutil.copy(
+                    src, decoded_path, driver="GTiff", tiled=True, blockxsize=512, blockysize=512, BIGTIFF="IF_SAFER"
+                )
+
+    if not decode:
+        yield src_path
+        return
+
+    try:
+        yield decoded_path
+    finally:
+        rasterio.shutil.delete(decoded_path)
+
+
+def _runtime_options(
+    path: str, source_bytes: int, outputs: int, recorder: Recorder
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """GDAL config and creation options of the runtime profile for a source
+
+    Parameters
+    ----------
+    path : str
+        Path of the source, to read its data type
+    source_bytes : int
+        Size of the source object
+    outputs : int
+        Outputs that will be written in parallel
+    recorder : Recorder
+        Records the name of the profile
+
+    Returns
+    -------
+    Tuple[Dict[str, Any], Dict[str, Any]]
+        Config options for ``rasterio.Env`` and creation options to add to
+        the COG profile
+    """
+    with rasterio.open(path) as src:
+        dtype = src.dtypes[0]
+
+    resources = container_resources()
+    runtime = select_profile(source_bytes, dtype, resources)
+    config = runtime.config(resources, outputs)
+    log.info(
+        f"GDAL runtime profile {runtime.name} for {source_bytes} bytes of {dtype} with "
+        f"{resources.cpus:g} CPUs and {resources.memory_bytes / MiB:.0f} MiB : {config}"
+    )
+    recorder.set_property("runtime_profile", runtime.name)
+    creation_options = runtime.creation_options(resources, outputs)
+    if SPARSE != "off":
+        creation_options["SPARSE_OK"] = "TRUE"
+    return config, creation_options
+
+
+def _select_compression(path: str, pending: List[_PendingOutput], recorder: Recorder) -> None:
+    """Replace the settings of every auto profile output with the compression chosen for the source"""
+    auto = [output for output in pending if output.spec.profile == AUTO]
+    if not auto:
+        return
+
+    with recorder.stage("select"):
+        selection: Selection = select_compression(path)
+    recorder.set_property("compression", selection.candidate.name)
+    for output in auto:
+        output.dst_profile = dict(selection.candidate.dst_profile(), **output.spec.options)
+        output.metadata.update(selection.metadata())
+
+
+def _describe_outputs(path: str, pending: List[_PendingOutput]) -> None:
+    """Set the footprint of every output from the source, which they share the georeferencing of"""
+    # Read through the module, so that changing the setting at run time applies
+    if footprints.INDEX == "off":
+        return
+    with rasterio.open(path) as src:
+        for output in pending:
+            compression = str(output.dst_profile.get("compress") or "none")
+            output.footprint = Footprint.from_dataset(output.spec.out_key, src, output.spec.profile, compression)
+
+
+def _index_outputs(
+    out_s3: S3Helper, pending: List[_PendingOutput], written: List[OutputResult], recorder: Recorder
+) -> None:
+    """Append the footprints of the written outputs to the index of the output bucket
+
+    The index is a side effect of the conversion, so failing to update it is
+    logged rather than raised.
     """
-    # Setup connection to S3 and download the data
-    in_s3 = S3Helper(bucket)
-    data = in_s3.get_bytes(key)
+    by_key = {output.spec.out_key: output.footprint for output in pending if output.footprint}
+    now = time.time()
+    described = [
+        replace(by_key[result.spec.out_key], size=result.size, written=now)
+        for result in written
+        if result.spec.out_key in by_key
+    ]
+    if not described:
+        return
+    try:
+        with recorder.stage("index"):
+            record_outputs(out_s3, described)
+    except Exception:
+        log.warning(f"Failed to add {len(described)} outputs to the footprint index", exc_info=True)
+
+
+def _write_outputs(
+    pending: List[_PendingOutput],
+    write: Callable[[_PendingOutput], int],
+    max_workers: int,
+) -> List[OutputResult]:
+    """Write each output in parallel, ``write`` returns the size of an output"""
+
+    def timed_write(output: _PendingOutput) -> OutputResult:
+        start = time.perf_counter()
+        size = write(output)
+        return OutputResult(output.spec, True, size, time.perf_counter() - start)
+
+    if len(pending) == 1 or max_workers <= 1:
+        return [timed_write(output) for output in pending]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as pool:
+        return list(pool.map(timed_write, pending))
+
+
+def _write_copied(
+    path: str,
+    fh: BinaryIO,
+    output: _PendingOutput,
+    dst_profile: Dict[str, Any],
+    out_s3: S3Helper,
+    scratch_dir: Optional[str],
+    recorder: Recorder,
+) -> Optional[int]:
+    """Stream a COG to S3 that reuses the compressed tiles of the source, if it can
+
+    Sources that are already tiled and compressed as the profile asks are
+    written by the engine copying their tiles, so only overviews are encoded.
+
+    Parameters
+    ----------
+    path : str
+        Path of the source for rasterio
+    fh : BinaryIO
+        The source's bytes
+    output : _PendingOutput
+        Output to write
+    dst_profile : Dict[str, Any]
+        COG profile with the runtime creation options
+    out_s3 : S3Helper
+        Output bucket
+    scratch_dir : str, optional
+        Directory for the engine's scratch files
+    recorder : Recorder
+        Records the translate stage
+
+    Returns
+    -------
+    Optional[int]
+        Size of the COG, or None if the tiles could not be copied
+    """
+    if ENGINE == "off":
+        return None
+
+    with rasterio.open(path) as src:
+        plan, reason = copy_plan(src, dst_profile, fh)
+        if plan is None:
+            log.info(f"Not copying the source tiles : {reason}")
+            return None
+
+        log.info(f"Converting to Cloud Optimised GeoTiff by copying the source tiles ({output.spec.profile})")
+
+        def produce(out: BinaryIO) -> int:
+            workers = ENGINE_WORKERS or dst_profile["NUM_THREADS"]
+            return write_cog(src, out, dst_profile, workers, scratch_dir=scratch_dir, recorder=recorder, source=fh)
+
+        with recorder.stage("translate"):
+            size = out_s3.write_stream(produce, output.spec.out_key, output.metadata)
+        recorder.add("copied_count", 1)
+        return size
+
+
+def _write_incremental(
+    path: str,
+    output: _PendingOutput,
+    dst_profile: Dict[str, Any],
+    out_s3: S3Helper,
+    scratch_dir: Optional[str],
+    recorder: Recorder,
+) -> Optional[int]:
+    """Stream a COG to S3 with the engine, reusing the unchanged tiles of the existing output
+
+    When ``COG_INCREMENTAL`` is on, outputs are written by the engine along
+    with a sidecar of the hashes of their source tiles. If the output already
+    has a sidecar for the same profile and source layout, only the tiles of
+    the source that changed are encoded, see ``convert.incremental``.
+
+    Parameters
+    ----------
+    path : str
+        Path of the source for rasterio
+    output : _PendingOutput
+        Output to write
+    dst_profile : Dict[str, Any]
+        COG profile with the runtime creation options
+    out_s3 : S3Helper
+        Output bucket
+    scratch_dir : str, optional
+        Directory for the engine's scratch files
+    recorder : Recorder
+        Records the translate and upload stages
+
+    Returns
+    -------
+    Optional[int]
+        Size of the COG, or None if the engine cannot write it
+    """
+    if INCREMENTAL == "off" or ENGINE == "off":
+        return None
+
+    out_key = output.spec.out_key
+    with rasterio.open(path) as src:
+        reason = unsupported_reason(src, dst_profile)
+        if reason is not None:
+            log.info(f"Not writing incrementally : {reason}")
+            return None
+
+        settings = settings_digest(output.spec.profile, output.dst_profile)
+        layout = source_layout(src, dst_profile)
+        sidecar, reason = load_sidecar(out_s3, out_key, output.existing, settings, layout)
+        if sidecar is None:
+            log.info(f"Encoding every tile of {out_key} : {reason}")
+
+        hashes: List[str] = []
+        with ExitStack() as stack:
+            previous = None
+            if sidecar is not None:
+                log.info(f"Updating {out_key} incrementally from its previous version")
+                previous = PreviousCog(stack.enter_context(out_s3.open_reader(out_key)), sidecar.hashes)
+
+            def produce(out: BinaryIO) -> int:
+                workers = ENGINE_WORKERS or dst_profile["NUM_THREADS"]
+                return write_cog(
+                    src,
+                    out,
+                    dst_profile,
+                    workers,
+                    scratch_dir=scratch_dir,
+                    recorder=recorder,
+                    previous=previous,
+                    tile_hashes=hashes,
+                )
+
+            with recorder.stage("translate"):
+                size = out_s3.write_stream(produce, out_key, output.metadata)
+
+    with recorder.stage("upload"):
+        sidecar = TileSidecar(output.metadata[FINGERPRINT_KEY], settings, layout, hashes)
+        out_s3.write_bytes(sidecar.dumps(), sidecar_key(out_key))
+    return size
+
+
+def _to_cogs_in_memory(
+    in_s3: S3Helper,
+    key: str,
+    source_bytes: int,
+    out_s3: S3Helper,
+    pending: List[_PendingOutput],
+    max_workers: int,
+    recorder: Recorder,
+) -> List[OutputResult]:
+    """Download, convert and upload holding everything in memory"""
+    with recorder.stage("download"):
+        data = in_s3.get_bytes(key)
+
+    # Each output reads the source's bytes for copying tiles through its own
+    # file object, which shares the buffer rather than copying it
+    raw = data.getvalue()
 
     # Use rasterio to open the BytesIO as a file
-    with rasterio.open(data) as src:
-        log.info(f"Opened file. Format is : {src.driver}")
+    with MemoryFile(data) as mem_src:
+        # GDAL config is thread local, so the options are set in each thread
+        env, creation_options = _runtime_options(mem_src.name, source_bytes, len(pending), recorder)
+        _select_compression(mem_src.name, pending, recorder)
+        _describe_outputs(mem_src.name, pending)
+        decoded_path = f"/vsimem/{uuid4().hex}.tif"
+        with rasterio.Env(**env), _decoded_source(mem_src.name, decoded_path, len(pending), recorder) as src_path:
+
+            def write(output: _PendingOutput) -> int:
+                dst_profile = dict(output.dst_profile, **creation_options)
+                with rasterio.Env(**env), io.BytesIO(raw) as fh:
+                    size = _write_copied(mem_src.name, fh, output, dst_profile, out_s3, None, recorder)
+                    if size is not None:
+                        return size
+
+                with rasterio.Env(**env):
+                    size = _write_incremental(src_path, output, dst_profile, out_s3, None, recorder)
+                    if size is not None:
+                        return size
+
+                with rasterio.Env(**env), rasterio.open(src_path) as src:
+                    log.info(f"Opened file. Format is : {src.driver}")
+
+                    # Write a converted Cloud Optimised GeoTiff to Bytes
+                    log.info(f"Converting to Cloud Optmised GeoTiff ({output.spec.profile})")
+                    with MemoryFile() as mem_dst:
+                        # convert the src to COG
+                        with recorder.stage("translate"):
+                            cog_translate(src, mem_dst.name, dst_profile, in_memory=True)
+
+                        # Write to S3
+                        with recorder.stage("upload"):
+                            out_s3.write_bytes(mem_dst, output.spec.out_key, output.metadata)
+                        return len(mem_dst.getbuffer())
+
+            return _write_outputs(pending, write, max_workers)
+
+
+def _to_cogs_on_disk(
+    in_s3: S3Helper,
+    key: str,
+    source_bytes: int,
+    out_s3: S3Helper,
+    pending: List[_PendingOutput],
+    max_workers: int,
+    tmp_dir: str,
+    recorder: Recorder,
+) -> List[OutputResult]:
+    """Download, convert and upload via files in a scratch directory"""
+    src_path = os.path.join(tmp_dir, SOURCE_NAME)
+    with recorder.stage("download"):
+        in_s3.download_file(key, src_path)
+
+    return _convert_with_scratch(src_path, {}, True, source_bytes, out_s3, pending, max_workers, tmp_dir, recorder)
+
+
+def _to_cogs_streamed(
+    in_s3: S3Helper,
+    key: str,
+    source_bytes: int,
+    out_s3: S3Helper,
+    pending: List[_PendingOutput],
+    max_workers: int,
+    tmp_dir: str,
+    recorder: Recorder,
+) -> List[OutputResult]:
+    """Convert reading the source in place through /vsis3/, with scratch files for the outputs"""
+    with in_s3.stream(key) as (src_path, source_env):
+        written = _convert_with_scratch(
+            src_path, source_env, False, source_bytes, out_s3, pending, max_workers, tmp_dir, recorder
+        )
+
+    recorder.add("stream_bytes", in_s3.bytes_streamed)
+    if source_bytes:
+        log.info(
+            f"Streamed {in_s3.bytes_streamed} of {source_bytes} source bytes "
+            f"({100 * in_s3.bytes_streamed / source_bytes:.1f}%)"
+        )
+    return written
+
+
+def _convert_with_scratch(
+    src_path: str,
+    source_env: Dict[str, Any],
+    local: bool,
+    source_bytes: int,
+    out_s3: S3Helper,
+    pending: List[_PendingOutput],
+    max_workers: int,
+    tmp_dir: str,
+    recorder: Recorder,
+) -> List[OutputResult]:
+    """Convert the source at ``src_path`` and upload, using files in a scratch directory
+
+    Parameters
+    ----------
+    src_path : str
+        Path of the source for rasterio
+    source_env : Dict[str, Any]
+        Options for ``rasterio.Env`` needed to read the source
+    local : bool
+        Whether ``src_path`` is a local file, whose tiles can be copied
+    source_bytes : int
+        Size of the source object
+    out_s3 : S3Helper
+        Output bucket
+    pending : List[_PendingOutput]
+        Outputs to write
+    max_workers : int
+        Number of outputs to write in parallel
+    tmp_dir : str
+        Scratch directory
+    recorder : Recorder
+        Records the stages of the conversion
+
+    Returns
+    -------
+    List[OutputResult]
+        Result of each written output
+    """
+    with rasterio.Env(**source_env):
+        env, creation_options = _runtime_options(src_path, source_bytes, len(pending), recorder)
+        _select_compression(src_path, pending, recorder)
+        _describe_outputs(src_path, pending)
+
+    # Keep GDAL's temporaries in the scratch directory, the options are set
+    # in each thread as GDAL config is thread local
+    env.update(source_env)
+    env["CPL_TMPDIR"] = tmp_dir
+    if ON_DISK_GDAL_CACHEMAX:
+        env["GDAL_CACHEMAX"] = int(ON_DISK_GDAL_CACHEMAX)
+    decoded_path = os.path.join(tmp_dir, "decoded.tif")
+    with rasterio.Env(**env), _decoded_source(src_path, decoded_path, len(pending), recorder) as read_path:
+
+        def write(output: _PendingOutput) -> int:
+            dst_profile = dict(output.dst_profile, **creation_options)
+            dst_path = os.path.join(tmp_dir, f"cog-{uuid4().hex}.tif")
+            with rasterio.Env(**env):
+                # Tiles are copied from the source as downloaded rather than
+                # from a decoded copy
+                if local:
+                    with open(src_path, "rb") as fh:
+                        size = _write_copied(src_path, fh, output, dst_profile, out_s3, tmp_dir, recorder)
+                        if size is not None:
+                            return size
+
+                size = _write_incremental(read_path, output, dst_profile, out_s3, tmp_dir, recorder)
+                if size is not None:
+                    return size
+
+                with rasterio.open(read_path) as src:
+                    log.info(f"Opened file. Format is : {src.driver}")
+
+                    reason = "COG_ENGINE is off" if ENGINE == "off" else unsupported_reason(src, dst_profile)
+                    if reason is None:
+                        # Stream tiles straight to S3 without a local copy of the COG
+                        log.info(f"Converting to Cloud Optimised GeoTiff with the engine ({output.spec.profile})")
+
+                        def produce(out: BinaryIO) -> int:
+                            workers = ENGINE_WORKERS or dst_profile["NUM_THREADS"]
+                            return write_cog(src, out, dst_profile, workers, scratch_dir=tmp_dir, recorder=recorder)
+
+                        with recorder.stage("translate"):
+                            return out_s3.write_stream(produce, output.spec.out_key, output.metadata)
 
-        # Write a converted Cloud Optimised GeoTiff to Bytes
-        log.info("Converting to Cloud Optmised GeoTiff")
-        dst_profile = cog_profiles.get("deflate")
+                    log.info(f"Not using the engine : {reason}")
+                    log.info(f"Converting to Cloud Optmised GeoTiff ({output.spec.profile})")
+                    with recorder.stage("translate"):
+                        cog_translate(src, dst_path, dst_profile, in_memory=False)
 
-        with MemoryFile() as mem_dst:
-            # convert the src to COG
-            cog_translate(src, mem_dst.name, dst_profile, in_memory=True)
+            # Stream the result from disk to S3
+            with recorder.stage("upload"):
+                out_s3.upload_file(dst_path, output.spec.out_key, output.metadata)
+            size = os.path.getsize(dst_path)
+            os.remove(dst_path)
+            return size
 
-            # Write to S3
-            out_s3 = S3Helper(out_bucket)
-            out_s3.write_bytes(mem_dst, out_key)
+        return _write_outputs(pending, write, max_workers)
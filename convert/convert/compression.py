@@ -0,0 +1,261 @@
+"""Choose the compression of a COG by trial encoding samples of its source
+
+The ``auto`` profile reads a few windows spread across the source, encodes
+them with each candidate codec and predictor, and picks one according to a
+policy trading output size against encode speed.
+"""
+import json
+import logging
+import math
+import os
+import time
+import warnings
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.errors import NotGeoreferencedWarning, RasterioError
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
+from rio_cogeo.profiles import cog_profiles
+
+from convert.fingerprint import COMPRESSION_KEY, COMPRESSION_RATIOS_KEY
+
+log = logging.getLogger(__name__)
+
+# Name of the profile that selects the compression from the source
+AUTO = "auto"
+
+# How much larger (as a fraction) than the smallest trial output the chosen
+# codec may be, the fastest codec within that margin is chosen
+POLICIES = {"size": 0.0, "balanced": 0.05, "speed": 0.25}
+
+# Policy used by the auto profile, a name from POLICIES or a fraction
+AUTO_POLICY = os.environ.get("COG_AUTO_POLICY", "balanced")
+
+# Whether lossy codecs (WebP for 3 band 8 bit imagery) may be chosen, "on" or "off"
+AUTO_LOSSY = os.environ.get("COG_AUTO_LOSSY", "off")
+
+# Number and size of the windows read from the source to trial encode
+AUTO_SAMPLES = int(os.environ.get("COG_AUTO_SAMPLES", 4))
+AUTO_SAMPLE_SIZE = int(os.environ.get("COG_AUTO_SAMPLE_SIZE", 512))
+
+
+@dataclass(frozen=True)
+class Candidate:
+    """A rio-cogeo profile and the creation options to trial it with"""
+
+    profile: str
+    options: Tuple[Tuple[str, Any], ...] = ()
+
+    @property
+    def name(self) -> str:
+        """Short name recorded in the output metadata, e.g. zstd-predictor2"""
+        return "-".join([self.profile] + [f"{key}{value}" for key, value in self.options])
+
+    def dst_profile(self) -> Dict[str, Any]:
+        """The COG profile with the candidate's options"""
+        with warnings.catch_warnings():
+            # rio-cogeo warns that codecs other than deflate, lzw and jpeg are
+            # not supported everywhere, which is a known trade off here
+            warnings.simplefilter("ignore", UserWarning)
+            profile = cog_profiles.get(self.profile)
+        profile.update(dict(self.options))
+        return profile
+
+
+@dataclass
+class Trial:
+    """Size and encode time of the samples with a candidate"""
+
+    candidate: Candidate
+    size: int
+    seconds: float
+    # Size of the samples uncompressed
+    raw_size: int
+
+    @property
+    def ratio(self) -> float:
+        """Compression ratio, uncompressed size over compressed size"""
+        return self.raw_size / self.size if self.size else 0.0
+
+
+@dataclass
+class Selection:
+    """Outcome of the auto profile for a source"""
+
+    candidate: Candidate
+    trials: List[Trial] = field(default_factory=list)
+
+    def metadata(self) -> Dict[str, str]:
+        """S3 user metadata recording the choice and the ratio of each candidate"""
+        ratios = {trial.candidate.name: round(trial.ratio, 2) for trial in self.trials}
+        return {
+            COMPRESSION_KEY: self.candidate.name,
+            COMPRESSION_RATIOS_KEY: json.dumps(ratios, separators=(",", ":")),
+        }
+
+
+def policy_slack(policy: str) -> float:
+    """Size margin of a policy given by name (see ``POLICIES``) or as a fraction such as 0.1"""
+    if policy in POLICIES:
+        return POLICIES[policy]
+    try:
+        slack = float(policy)
+    except ValueError:
+        raise ValueError(f"Unknown compression policy {policy!r}, expected one of {list(POLICIES)}") from None
+    if slack < 0:
+        raise ValueError(f"Compression policy must not be negative, got {slack}")
+    return slack
+
+
+def auto_options(policy: str = AUTO_POLICY, allow_lossy: bool = AUTO_LOSSY == "on") -> Dict[str, Any]:
+    """Settings of the auto profile, fingerprinted in place of creation options
+
+    The choice itself depends only on the source and these settings, so an
+    output does not need converting again unless one of them changes.
+    """
+    return {"policy": policy_slack(policy), "lossy": allow_lossy}
+
+
+def candidates(dtype: str, count: int, allow_lossy: bool = False) -> List[Candidate]:
+    """Candidate codecs and predictors for a source
+
+    Parameters
+    ----------
+    dtype : str
+        Data type of the source bands
+    count : int
+        Number of bands
+    allow_lossy : bool, optional
+        Include lossy codecs where the data suits them
+
+    Returns
+    -------
+    List[Candidate]
+        Candidates to trial, lossless ones first
+    """
+    floating = np.issubdtype(np.dtype(dtype), np.floating)
+    # Floating point predictor for floats, horizontal differencing otherwise
+    predictor = 3 if floating else 2
+
+    found = []
+    for profile in ("deflate", "zstd", "lzw"):
+        found.append(Candidate(profile))
+        found.append(Candidate(profile, (("predictor", predictor),)))
+    if floating:
+        # LERC with the default max error of 0 is lossless
+        found.extend(Candidate(profile) for profile in ("lerc", "lerc_deflate", "lerc_zstd"))
+    if allow_lossy and count == 3 and np.dtype(dtype) == np.uint8:
+        found.append(Candidate("webp"))
+    return found
+
+
+def sample_windows(width: int, height: int, count: int = AUTO_SAMPLES, size: int = AUTO_SAMPLE_SIZE) -> List[Window]:
+    """Up to ``count`` windows of at most ``size`` pixels, spread over a grid across the raster
+
+    A raster no larger than a window is sampled whole.
+    """
+    if width <= size and height <= size:
+        return [Window(0, 0, width, height)]
+
+    cells = math.ceil(math.sqrt(count))
+    windows = []
+    for ix in range(count):
+        row, col = divmod(ix, cells)
+        # centre a window on each grid cell, kept within the raster
+        x = min(max(int((col + 0.5) * width / cells) - size // 2, 0), max(width - size, 0))
+        y = min(max(int((row + 0.5) * height / cells) - size // 2, 0), max(height - size, 0))
+        window = Window(x, y, min(size, width), min(size, height))
+        if window not in windows:
+            windows.append(window)
+    return windows
+
+
+def trial_encode(samples: List[np.ndarray], candidate: Candidate) -> Trial:
+    """Encode each sample as a single tile GeoTiff in memory with ``candidate``"""
+    options = candidate.dst_profile()
+    size, seconds, raw_size = 0, 0.0, 0
+    for data in samples:
+        count, height, width = data.shape
+        profile = dict(
+            options,
+            width=width,
+            height=height,
+            count=count,
+            dtype=data.dtype.name,
+            # one tile per sample, blocks must be multiples of 16
+            blockxsize=16 * math.ceil(width / 16),
+            blockysize=16 * math.ceil(height / 16),
+        )
+        with MemoryFile() as mem:
+            start = time.perf_counter()
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", NotGeoreferencedWarning)
+                with mem.open(**profile) as dst:
+                    dst.write(data)
+            seconds += time.perf_counter() - start
+            size += len(mem.getbuffer())
+        raw_size += data.nbytes
+    return Trial(candidate, size, seconds, raw_size)
+
+
+def choose(trials: List[Trial], slack: float) -> Trial:
+    """Fastest trial whose size is within ``slack`` of the smallest"""
+    smallest = min(trial.size for trial in trials)
+    eligible = [trial for trial in trials if trial.size <= smallest * (1 + slack)]
+    return min(eligible, key=lambda trial: trial.seconds)
+
+
+def select_compression(
+    path: str,
+    policy: str = AUTO_POLICY,
+    allow_lossy: bool = AUTO_LOSSY == "on",
+    samples: int = AUTO_SAMPLES,
+    sample_size: int = AUTO_SAMPLE_SIZE,
+) -> Selection:
+    """Choose the compression of a COG of the raster at ``path``
+
+    Parameters
+    ----------
+    path : str
+        Path of the source raster, which may be in /vsimem
+    policy : str, optional
+        Name of a policy in ``POLICIES`` or the size margin as a fraction
+    allow_lossy : bool, optional
+        Whether lossy codecs may be chosen
+    samples : int, optional
+        Number of windows to read from the source
+    sample_size : int, optional
+        Width and height of each window in pixels
+
+    Returns
+    -------
+    Selection
+        The chosen candidate and the trial of every candidate
+    """
+    slack = policy_slack(policy)
+    with rasterio.open(path) as src:
+        windows = sample_windows(src.width, src.height, samples, sample_size)
+        data = [src.read(window=window) for window in windows]
+        found = candidates(src.dtypes[0], src.count, allow_lossy)
+
+    trials = []
+    for candidate in found:
+        try:
+            trials.append(trial_encode(data, candidate))
+        except RasterioError as e:
+            # e.g. a codec this build of GDAL does not have
+            log.warning(f"Could not trial {candidate.name} : {e}")
+    if not trials:
+        raise RuntimeError(f"No compression could be trialled for {path}")
+
+    best = choose(trials, slack)
+    for trial in sorted(trials, key=lambda trial: trial.size):
+        log.info(
+            f"Compression trial {trial.candidate.name} : ratio {trial.ratio:.2f}, "
+            f"{trial.raw_size / 1024 / 1024 / trial.seconds if trial.seconds else 0:.1f} MiB/s"
+        )
+    log.info(f"Chose {best.candidate.name} with policy {policy} from {len(windows)} samples")
+    return Selection(best.candidate, trials)
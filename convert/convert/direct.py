@@ -0,0 +1,36 @@
+"""AWS Lambda entry point that converts small objects without AWS Batch
+
+The S3 trigger invokes this function asynchronously for objects below its
+size threshold, with the same bucket/key/out_bucket/out_key tasks that are
+written to Batch manifests, and writes the same ``COG_PROFILES`` as Batch.
+"""
+import logging
+import os
+from typing import Any, Dict
+
+from convert.manifest import Task
+from convert.worker import parse_profiles, run_tasks
+
+log = logging.getLogger(__name__)
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """Convert each of the ``tasks`` in the event
+
+    Raises if any task fails, so that the invocation is retried by Lambda.
+    """
+    logging.getLogger().setLevel(logging.INFO)
+
+    tasks = [Task(**task) for task in event["tasks"]]
+    results = run_tasks(tasks, profiles=parse_profiles([os.environ.get("COG_PROFILES", "")]))
+
+    failed = [result for result in results if not result.ok]
+    for result in failed:
+        log.error(f"Failed to convert s3://{result.task.bucket}/{result.task.key} : {result.error}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(tasks)} conversions failed")
+
+    return {
+        "converted": sum(result.converted for result in results),
+        "skipped": sum(not result.converted for result in results),
+    }
@@ -0,0 +1,982 @@
+"""Windowed, block parallel Cloud Optimised GeoTiff writer
+
+The source is read one row of output tiles at a time. Each row is split into
+tiles that are compressed on a thread pool (zlib and numpy release the GIL),
+and downsampled into the row buffer of the next overview level, so every
+overview is built from the level below rather than from the full resolution
+source. Compressed tiles are spooled to one scratch file per level and the
+COG is then assembled with every IFD ahead of the tile data, smallest
+overview first. Memory use is bounded by the width of the raster rather than
+its size.
+
+A source that is already tiled and compressed as the profile asks has its
+tiles copied byte for byte instead (see ``copy_plan``), along with any of its
+overviews that fit the COG, so only the missing overviews are computed.
+
+The engine can also hash each full resolution tile of the source. Given the
+hashes and bytes of an earlier COG of the same layout, only the tiles whose
+hash changed, and the overview tiles above them, are encoded again, the rest
+are reused from the earlier COG (see ``PreviousCog``).
+
+With the ``SPARSE_OK`` creation option, as GDAL's, tiles whose pixels are all
+nodata at any level are not encoded or stored. Their offset and byte count
+are 0, which readers take as a tile of nodata.
+"""
+import hashlib
+import logging
+import math
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+from rasterio.io import DatasetReader, MemoryFile
+from rasterio.windows import Window
+
+from convert import tiff
+from convert.metrics import Recorder
+from convert.tiff import Tag
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# "auto" converts with the engine whenever it supports the source and profile,
+# "off" always uses rio-cogeo's cog_translate
+ENGINE = os.environ.get("COG_ENGINE", "auto")
+
+# Threads compressing tiles, overriding the threads of the runtime profile
+ENGINE_WORKERS = int(os.environ.get("COG_ENGINE_WORKERS", 0))
+
+# Approximate memory the engine may use for pixels, which bounds the number of
+# rows of tiles that are waiting to be compressed
+ENGINE_MEMORY_MAX_BYTES = int(os.environ.get("COG_ENGINE_MEMORY_MAX_BYTES", 512 * MiB))
+
+RESAMPLING = ("nearest", "average")
+COMPRESSION = {"deflate": tiff.COMPRESSION_DEFLATE, "none": tiff.COMPRESSION_NONE}
+SAMPLE_FORMATS = {"u": 1, "i": 2, "f": 3}
+
+# Columns averaged at a time, which bounds the temporary float arrays
+AVERAGE_COLUMNS = 4096
+
+# Size of the chunks copied from the scratch files to the output
+COPY_CHUNK_SIZE = 8 * MiB
+
+# Source tiles are only copied if their width and height are in this range,
+# smaller tiles make for inefficient COG reads and larger ones for slow ones
+COPY_MIN_BLOCK_SIZE = 128
+COPY_MAX_BLOCK_SIZE = 2048
+
+# Bytes in the digest of each source tile, see tile_hash
+TILE_HASH_SIZE = 16
+
+# Compressed bytes of a sparse tile, which is neither encoded nor stored
+SPARSE_TILE = b""
+
+
+def unsupported_reason(src: DatasetReader, dst_profile: Dict[str, Any]) -> Optional[str]:
+    """Why the engine cannot convert ``src`` with ``dst_profile``, or None if it can"""
+    compress = str(dst_profile.get("compress") or "none").lower()
+    if compress not in COMPRESSION:
+        return f"{compress} compression is not supported"
+    if str(dst_profile.get("interleave", "pixel")).lower() != "pixel":
+        return "only pixel interleaving is supported"
+    if len(set(src.dtypes)) != 1:
+        return "bands have different data types"
+
+    dtype = np.dtype(src.dtypes[0])
+    if dtype.kind not in SAMPLE_FORMATS:
+        return f"{dtype} data is not supported"
+
+    predictor = int(dst_profile.get("predictor", 1))
+    if predictor not in (1, 2) or (predictor == 2 and dtype.kind == "f"):
+        return f"predictor {predictor} is not supported for {dtype} data"
+
+    if src.nodata is None and any(MaskFlags.per_dataset in flags for flags in src.mask_flag_enums):
+        return "the source has an internal mask"
+
+    for size in (dst_profile.get("blockxsize", 512), dst_profile.get("blockysize", 512)):
+        if int(size) % 16:
+            return f"block size {size} is not a multiple of 16"
+
+    return None
+
+
+@dataclass
+class CopyPlan:
+    """Layout of a source whose compressed tiles can be copied into the COG"""
+
+    block_width: int
+    block_height: int
+    compression: int
+    predictor: int
+    # Tile offsets and byte counts of the full resolution image, followed by
+    # those of each source overview that matches the next COG level
+    levels: List[Tuple[Tuple[int, ...], Tuple[int, ...]]]
+
+
+def copy_plan(
+    src: DatasetReader, dst_profile: Dict[str, Any], fh: BinaryIO
+) -> Tuple[Optional[CopyPlan], Optional[str]]:
+    """Whether the tiles of ``src`` can be copied into a COG with ``dst_profile``
+
+    The source must be a little endian GeoTiff, tiled with blocks the engine
+    supports, and compressed with the codec of the profile. The predictor and
+    block size of the source are kept.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Open source raster
+    dst_profile : Dict[str, Any]
+        COG profile
+    fh : BinaryIO
+        Seekable file object of the source's bytes
+
+    Returns
+    -------
+    Tuple[Optional[CopyPlan], Optional[str]]
+        The plan, or None and why the tiles cannot be copied
+    """
+    compress = str(dst_profile.get("compress") or "none").lower()
+    if compress not in COMPRESSION:
+        return None, f"{compress} compression is not supported"
+    if src.driver != "GTiff":
+        return None, f"the source is a {src.driver}"
+
+    fh.seek(0)
+    if fh.read(2) != b"II":
+        return None, "the source is not a little endian TIFF"
+    try:
+        _, ifds = tiff.read_ifds(fh)
+    except tiff.TiffFormatError as e:
+        return None, str(e)
+
+    main = ifds[0]
+    if tiff.TILE_WIDTH not in main.tags:
+        return None, "the source is not tiled"
+    block_width, block_height = main.get(tiff.TILE_WIDTH), main.get(tiff.TILE_LENGTH)
+    for size in (block_width, block_height):
+        if not COPY_MIN_BLOCK_SIZE <= size <= COPY_MAX_BLOCK_SIZE:
+            return None, f"source block size {size} is outside {COPY_MIN_BLOCK_SIZE}-{COPY_MAX_BLOCK_SIZE}"
+
+    compression = main.get(tiff.COMPRESSION, tiff.COMPRESSION_NONE)
+    if compression != COMPRESSION[compress]:
+        return None, f"the source has TIFF compression {compression}, the profile asks for {compress}"
+    if src.count > 1 and main.get(tiff.PLANAR_CONFIGURATION, 1) != 1:
+        return None, "the source is not pixel interleaved"
+
+    predictor = main.get(tiff.PREDICTOR, 1)
+    reason = unsupported_reason(
+        src, dict(dst_profile, blockxsize=block_width, blockysize=block_height, predictor=predictor)
+    )
+    if reason:
+        return None, reason
+
+    def tiles(ifd: tiff.Ifd) -> Optional[Tuple[Tuple[int, ...], Tuple[int, ...]]]:
+        offsets, counts = ifd.values(tiff.TILE_OFFSETS), ifd.values(tiff.TILE_BYTE_COUNTS)
+        if not offsets or len(offsets) != len(counts):
+            return None
+        # Sparse tiles (offset and byte count 0) stay sparse, but an empty
+        # tile stored somewhere in the file is not one GDAL would write
+        if any(count == 0 and offset != 0 for offset, count in zip(offsets, counts)):
+            return None
+        return offsets, counts
+
+    levels = [tiles(main)]
+    if levels[0] is None:
+        return None, "the source has missing or empty tiles"
+
+    # Source overviews are reused while they have the shape and encoding of
+    # the next level, the rest are computed
+    shapes = level_shapes(src.width, src.height, block_width, block_height)
+    overviews = [ifd for ifd in ifds[1:] if ifd.get(tiff.NEW_SUBFILE_TYPE, 0) == tiff.REDUCED_RESOLUTION]
+    for (width, height), ifd in zip(shapes[1:], overviews):
+        layout = (ifd.get(tiff.IMAGE_WIDTH), ifd.get(tiff.IMAGE_LENGTH), ifd.get(tiff.TILE_WIDTH))
+        encoding = (ifd.get(tiff.TILE_LENGTH), ifd.get(tiff.COMPRESSION, 1), ifd.get(tiff.PREDICTOR, 1))
+        found = tiles(ifd)
+        if layout != (width, height, block_width) or encoding != (block_height, compression, predictor) or not found:
+            break
+        levels.append(found)
+
+    return CopyPlan(block_width, block_height, compression, predictor, levels), None
+
+
+@dataclass
+class PreviousCog:
+    """An earlier COG of the same source, and the hashes of the source tiles it was made from"""
+
+    # Seekable file object of the COG's bytes
+    fh: BinaryIO
+    # Hash of each full resolution tile, in row major order, see tile_hash
+    hashes: List[str]
+
+
+def tile_hash(tile: np.ndarray) -> str:
+    """Hash of the pixels of a (bands, rows, columns) tile of the source"""
+    digest = hashlib.blake2b(str(tile.shape).encode(), digest_size=TILE_HASH_SIZE)
+    digest.update(np.ascontiguousarray(tile).data)
+    return digest.hexdigest()
+
+
+def is_sparse(tile: np.ndarray, nodata: Optional[float]) -> bool:
+    """Whether every pixel of every band of a (bands, rows, columns) tile is nodata"""
+    if nodata is None:
+        return False
+    if np.isnan(nodata):
+        return tile.dtype.kind == "f" and bool(np.isnan(tile).all())
+    # Most tiles with data are rejected by their first pixel, without a pass over the tile
+    return bool(tile.flat[0] == nodata) and not (tile != nodata).any()
+
+
+def sparse_option(dst_profile: Dict[str, Any]) -> bool:
+    """Whether the profile asks for sparse tiles, with GDAL's SPARSE_OK creation option"""
+    value = dst_profile.get("SPARSE_OK", dst_profile.get("sparse_ok", False))
+    return str(value).upper() in ("TRUE", "YES", "ON", "1")
+
+
+def reuse_plan(
+    previous: PreviousCog,
+    shapes: List[Tuple[int, int]],
+    block_width: int,
+    block_height: int,
+    compression: int,
+    predictor: int,
+    dtype: np.dtype,
+    count: int,
+) -> Tuple[Optional[List[Tuple[Tuple[int, ...], Tuple[int, ...]]]], Optional[str]]:
+    """Tile offsets and byte counts of each level of an earlier COG, if its tiles can be reused
+
+    The earlier COG must have the levels, block size and encoding that the
+    new one will have, and a hash for every full resolution tile.
+
+    Returns
+    -------
+    Tuple[Optional[List[Tuple[Tuple[int, ...], Tuple[int, ...]]]], Optional[str]]
+        The offsets and byte counts of each level, or None and why the tiles
+        cannot be reused
+    """
+    try:
+        _, ifds = tiff.read_ifds(previous.fh)
+    except tiff.TiffFormatError as e:
+        return None, str(e)
+    if len(ifds) != len(shapes):
+        return None, f"it has {len(ifds)} levels rather than {len(shapes)}"
+
+    expected = (block_width, block_height, compression, predictor, count, dtype.itemsize * 8)
+    levels = []
+    for (width, height), ifd in zip(shapes, ifds):
+        if (ifd.get(tiff.IMAGE_WIDTH), ifd.get(tiff.IMAGE_LENGTH)) != (width, height):
+            return None, f"a level is {ifd.get(tiff.IMAGE_WIDTH)}x{ifd.get(tiff.IMAGE_LENGTH)}, not {width}x{height}"
+        layout = (
+            ifd.get(tiff.TILE_WIDTH),
+            ifd.get(tiff.TILE_LENGTH),
+            ifd.get(tiff.COMPRESSION, tiff.COMPRESSION_NONE),
+            ifd.get(tiff.PREDICTOR, 1),
+            ifd.get(tiff.SAMPLES_PER_PIXEL, 1),
+            ifd.get(tiff.BITS_PER_SAMPLE),
+        )
+        if layout != expected:
+            return None, f"its block size or encoding {layout} differs from {expected}"
+        offsets, counts = ifd.values(tiff.TILE_OFFSETS), ifd.values(tiff.TILE_BYTE_COUNTS)
+        tiles = math.ceil(width / block_width) * math.ceil(height / block_height)
+        if len(offsets) != tiles or len(counts) != tiles:
+            return None, "it has missing tiles"
+        levels.append((offsets, counts))
+
+    if len(previous.hashes) != len(levels[0][0]):
+        return None, f"there are {len(previous.hashes)} tile hashes for {len(levels[0][0])} tiles"
+    return levels, None
+
+
+def level_shapes(width: int, height: int, block_width: int, block_height: int) -> List[Tuple[int, int]]:
+    """Width and height of the full resolution image and each overview level
+
+    Levels halve in size (rounding up) until the image fits in a single tile.
+    """
+    shapes = [(width, height)]
+    while width > block_width or height > block_height:
+        width, height = math.ceil(width / 2), math.ceil(height / 2)
+        shapes.append((width, height))
+    return shapes
+
+
+def nearest_indices(size: int, start: int, stop: int) -> np.ndarray:
+    """Pixels of a level ``size`` pixels long that GDAL's nearest overview pixels ``start`` to ``stop`` take
+
+    GDAL builds each overview from the level below and takes the pixel at
+    ``int(0.5 + i * size / ceil(size / 2))`` for overview pixel ``i``, which is
+    ``2i`` for an even size and one less over the second half of an odd size.
+    """
+    ratio = size / math.ceil(size / 2)
+    return np.minimum((0.5 + np.arange(start, stop) * ratio).astype("int64"), size - 1)
+
+
+def downsample_nearest(
+    block: np.ndarray, row: int = 0, height: Optional[int] = None, above: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Halve a (bands, rows, columns) block, matching GDAL's nearest overviews
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Full width rows of a level, starting at an even ``row``
+    row : int, optional
+        Row of the level the block starts at
+    height : int, optional
+        Height of the level, by default the block is the whole level
+    above : np.ndarray, optional
+        The row of the level before the block, which the overview of an odd
+        height can take for its first row
+
+    Returns
+    -------
+    np.ndarray
+        The overview rows of the block
+    """
+    _, rows, cols = block.shape
+    height = row + rows if height is None else height
+    row_ix = nearest_indices(height, row // 2, row // 2 + math.ceil(rows / 2)) - row
+    if row_ix[0] < 0:
+        block = np.concatenate([above, block], axis=1)
+        row_ix += 1
+    return block[:, row_ix][:, :, nearest_indices(cols, 0, math.ceil(cols / 2))]
+
+
+def downsample_average(block: np.ndarray, nodata: Optional[float]) -> np.ndarray:
+    """Halve a (bands, rows, columns) block by averaging the valid pixels of each 2x2"""
+    bands, rows, cols = block.shape
+    out = np.empty((bands, math.ceil(rows / 2), math.ceil(cols / 2)), dtype=block.dtype)
+    work = "float64" if block.dtype.itemsize > 2 else "float32"
+
+    for col in range(0, cols, AVERAGE_COLUMNS):
+        chunk = block[:, :, col : col + AVERAGE_COLUMNS]
+        if nodata is None:
+            valid = np.ones(chunk.shape, dtype=bool)
+        elif np.isnan(nodata):
+            valid = ~np.isnan(chunk)
+        else:
+            valid = chunk != nodata
+
+        # pad odd sizes with invalid pixels so every output pixel has a 2x2
+        height, width = math.ceil(chunk.shape[1] / 2), math.ceil(chunk.shape[2] / 2)
+        values = np.zeros((bands, height * 2, width * 2), dtype=work)
+        counts = np.zeros(values.shape, dtype=work)
+        values[:, : chunk.shape[1], : chunk.shape[2]] = np.where(valid, chunk, 0)
+        counts[:, : chunk.shape[1], : chunk.shape[2]] = valid
+
+        sums = values.reshape(bands, height, 2, width, 2).sum(axis=(2, 4))
+        numbers = counts.reshape(bands, height, 2, width, 2).sum(axis=(2, 4))
+        mean = np.where(numbers > 0, sums / np.maximum(numbers, 1), 0 if nodata is None else nodata)
+        if block.dtype.kind in "ui":
+            info = np.iinfo(block.dtype)
+            mean = np.clip(np.rint(mean), info.min, info.max)
+
+        out[:, :, col // 2 : col // 2 + width] = mean
+    return out
+
+
+class _Encoder:
+    """Pad, interleave, predict and compress tiles"""
+
+    def __init__(
+        self,
+        dtype: np.dtype,
+        block_width: int,
+        block_height: int,
+        fill: float,
+        compression: int,
+        predictor: int,
+        zlevel: int,
+        recorder: Recorder,
+    ):
+        self.dtype = dtype.newbyteorder("<")
+        self.block_width = block_width
+        self.block_height = block_height
+        self.fill = fill
+        self.compression = compression
+        self.predictor = predictor
+        self.zlevel = zlevel
+        self.recorder = recorder
+
+    def __call__(self, tile: np.ndarray) -> bytes:
+        with self.recorder.stage("compress"):
+            bands, rows, cols = tile.shape
+            if rows < self.block_height or cols < self.block_width:
+                padded = np.full((bands, self.block_height, self.block_width), self.fill, dtype=tile.dtype)
+                padded[:, :rows, :cols] = tile
+                tile = padded
+
+            # TIFF tiles are pixel interleaved (rows, columns, bands), and the
+            # source block is shared with the overviews so must not be modified
+            pixels = np.ascontiguousarray(tile.transpose(1, 2, 0), dtype=self.dtype)
+            if self.predictor == 2:
+                predicted = np.empty_like(pixels)
+                predicted[:, 0] = pixels[:, 0]
+                np.subtract(pixels[:, 1:], pixels[:, :-1], out=predicted[:, 1:])
+                pixels = predicted
+
+            data = pixels.tobytes()
+            if self.compression == tiff.COMPRESSION_DEFLATE:
+                data = zlib.compress(data, self.zlevel)
+            return data
+
+
+class _Level:
+    """Row buffer and spooled compressed tiles of one level of the pyramid"""
+
+    def __init__(self, index: int, width: int, height: int, block_width: int, block_height: int, path: str):
+        self.index = index
+        self.width = width
+        self.height = height
+        self.block_width = block_width
+        self.block_height = block_height
+        self.tiles_across = math.ceil(width / block_width)
+        self.tiles_down = math.ceil(height / block_height)
+        # Whether the tiles were copied from the source rather than encoded
+        self.copied = False
+        # Whether each tile was encoded (True) or reused from an earlier COG,
+        # in row major order, and the number reused
+        self.dirty: List[bool] = []
+        self.reused = 0
+        # Tiles that are all nodata, and so neither encoded nor stored
+        self.sparse = 0
+
+        # Rows received from the level below (or the source) not yet tiled
+        self._rows: List[np.ndarray] = []
+        self._buffered = 0
+        self.received = 0
+        # Rows taken as blocks so far, and the last of them
+        self.taken = 0
+        self.last_row: Optional[np.ndarray] = None
+
+        # Compressed tiles in row major order, spooled to a scratch file with
+        # the leader and trailer GDAL expects of a COG around each. Sparse
+        # tiles have a byte count of 0 and nothing in the file
+        self.byte_counts: List[int] = []
+        self.size = 0
+        self.path = path
+        self.file = open(path, "w+b")
+
+    def append(self, rows: np.ndarray) -> None:
+        self._rows.append(rows)
+        self._buffered += rows.shape[1]
+        self.received += rows.shape[1]
+
+    def ready(self) -> bool:
+        """Whether a full row of tiles, or the last partial row, is buffered"""
+        return self._buffered >= self.block_height or (self._buffered > 0 and self.received >= self.height)
+
+    def take(self) -> np.ndarray:
+        """Remove and return the next row of tiles worth of rows"""
+        rows = self._rows[0] if len(self._rows) == 1 else np.concatenate(self._rows, axis=1)
+        block, rest = rows[:, : self.block_height], rows[:, self.block_height :]
+        self._rows = [rest] if rest.shape[1] else []
+        self._buffered = rest.shape[1]
+        self.taken += block.shape[1]
+        self.last_row = block[:, -1:].copy()
+        return block
+
+    def write_tile(self, data: bytes) -> None:
+        if data == SPARSE_TILE:
+            self.byte_counts.append(0)
+            self.sparse += 1
+            return
+        self.file.write(struct.pack("<I", len(data)))
+        self.file.write(data)
+        self.file.write(data[-tiff.BLOCK_TRAILER_SIZE :])
+        self.byte_counts.append(len(data))
+        self.size += tiff.BLOCK_LEADER_SIZE + len(data) + tiff.BLOCK_TRAILER_SIZE
+
+    def copy_tiles(self, fh: BinaryIO, offsets: Tuple[int, ...], byte_counts: Tuple[int, ...]) -> None:
+        """Copy already compressed tiles from the source, in row major order"""
+        for offset, count in zip(offsets, byte_counts):
+            if count == 0:
+                self.write_tile(SPARSE_TILE)
+                continue
+            fh.seek(offset)
+            data = fh.read(count)
+            if len(data) != count:
+                raise IOError(f"Truncated tile at {offset} of the source")
+            self.write_tile(data)
+        self.copied = True
+
+    def offsets(self, start: int) -> List[int]:
+        """File offset of each tile when the level is written from ``start``"""
+        offsets = []
+        for count in self.byte_counts:
+            if count == 0:
+                offsets.append(0)
+                continue
+            offsets.append(start + tiff.BLOCK_LEADER_SIZE)
+            start += tiff.BLOCK_LEADER_SIZE + count + tiff.BLOCK_TRAILER_SIZE
+        return offsets
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def _done(data: bytes) -> Future:
+    """A future already holding the compressed bytes of a tile"""
+    future: Future = Future()
+    future.set_result(data)
+    return future
+
+
+class _Pyramid:
+    """Cascade rows through the levels, compressing tiles as rows fill up"""
+
+    def __init__(
+        self,
+        levels: List[_Level],
+        encoder: _Encoder,
+        pool: ThreadPoolExecutor,
+        max_pending_rows: int,
+        resampling: str,
+        nodata: Optional[float],
+        recorder: Recorder,
+        hashes: Optional[List[str]] = None,
+        previous: Optional[PreviousCog] = None,
+        reusable: Optional[List[Tuple[Tuple[int, ...], Tuple[int, ...]]]] = None,
+        sparse: bool = False,
+    ):
+        self.levels = levels
+        self.encoder = encoder
+        self.pool = pool
+        self.max_pending_rows = max_pending_rows
+        self.resampling = resampling
+        self.nodata = nodata
+        self.recorder = recorder
+        # Hashes of the full resolution tiles are appended here if given
+        self.hashes = hashes
+        # Earlier COG and the offsets and byte counts of its tiles, whose
+        # tiles are reused where the source did not change
+        self.previous = previous
+        self.reusable = reusable
+        # Whether tiles that are all nodata are left out
+        self.sparse = sparse
+        self._pending: Deque[Tuple[_Level, List[Future]]] = deque()
+
+    def push(self, index: int, rows: np.ndarray) -> None:
+        level = self.levels[index]
+        level.append(rows)
+        while level.ready():
+            row, above = level.taken, level.last_row
+            block = level.take()
+            if not level.copied:
+                self._submit(level, block)
+
+            if index + 1 < len(self.levels):
+                with self.recorder.stage("overviews"):
+                    if self.resampling == "average":
+                        smaller = downsample_average(block, self.nodata)
+                    else:
+                        smaller = downsample_nearest(block, row, level.height, above)
+                self.push(index + 1, smaller)
+
+    def _submit(self, level: _Level, block: np.ndarray) -> None:
+        row = len(level.dirty) // level.tiles_across
+        futures = []
+        for ix, col in enumerate(range(0, level.width, level.block_width)):
+            tile = block[:, :, col : col + level.block_width]
+            dirty = self._dirty(level, row, ix, tile)
+            level.dirty.append(dirty)
+            if dirty and self.sparse and self._is_sparse(tile):
+                futures.append(_done(SPARSE_TILE))
+            elif dirty:
+                futures.append(self.pool.submit(self.encoder, tile))
+            else:
+                futures.append(self._reuse(level, row * level.tiles_across + ix))
+        self._pending.append((level, futures))
+        while len(self._pending) > self.max_pending_rows:
+            self._write_next()
+
+    def _dirty(self, level: _Level, row: int, col: int, tile: np.ndarray) -> bool:
+        """Whether a tile must be encoded, rather than reused from the earlier COG"""
+        if level.index == 0:
+            if self.hashes is None:
+                return True
+            with self.recorder.stage("hash"):
+                self.hashes.append(tile_hash(tile))
+            return self.reusable is None or self.previous.hashes[len(self.hashes) - 1] != self.hashes[-1]
+
+        if self.reusable is None:
+            return True
+        # An overview tile is built from the 2x2 tiles below it, and with an
+        # odd size below from the last pixels of the tiles before those too
+        below = self.levels[level.index - 1]
+        top, left = row * level.block_height, col * level.block_width
+        rows = nearest_indices(below.height, top, min(top + level.block_height, level.height))
+        cols = nearest_indices(below.width, left, min(left + level.block_width, level.width))
+        return any(
+            below.dirty[r * below.tiles_across + c]
+            for r in range(rows[0] // below.block_height, rows[-1] // below.block_height + 1)
+            for c in range(cols[0] // below.block_width, cols[-1] // below.block_width + 1)
+        )
+
+    def _is_sparse(self, tile: np.ndarray) -> bool:
+        with self.recorder.stage("sparse"):
+            return is_sparse(tile, self.nodata)
+
+    def _reuse(self, level: _Level, index: int) -> Future:
+        """The compressed bytes of a tile of the earlier COG"""
+        offsets, byte_counts = self.reusable[level.index]
+        level.reused += 1
+        if byte_counts[index] == 0:
+            return _done(SPARSE_TILE)
+        with self.recorder.stage("reuse"):
+            self.previous.fh.seek(offsets[index])
+            data = self.previous.fh.read(byte_counts[index])
+        if len(data) != byte_counts[index]:
+            raise IOError(f"Truncated tile at {offsets[index]} of the previous COG")
+        return _done(data)
+
+    def _write_next(self) -> None:
+        # Rows are written in the order they were submitted, which is row
+        # major order within each level
+        level, futures = self._pending.popleft()
+        for future in futures:
+            level.write_tile(future.result())
+
+    def finish(self) -> None:
+        while self._pending:
+            self._write_next()
+        for level in self.levels:
+            expected = level.tiles_across * level.tiles_down
+            if len(level.byte_counts) != expected:
+                raise RuntimeError(f"Level {level.index} has {len(level.byte_counts)} of {expected} tiles")
+
+
+def template_tags(src: DatasetReader) -> Dict[int, Tag]:
+    """Georeferencing and metadata tags that GDAL writes for ``src``
+
+    A 1x1 GeoTiff with the same CRS, transform, nodata, colour interpretation
+    and metadata as ``src`` is written with GDAL, and its descriptive tags are
+    reused so the output is described exactly as GDAL would describe it.
+    """
+    profile = {
+        "driver": "GTiff",
+        "width": 1,
+        "height": 1,
+        "count": src.count,
+        "dtype": src.dtypes[0],
+        "crs": src.crs,
+        "transform": src.transform,
+        "nodata": src.nodata,
+    }
+    with MemoryFile() as mem:
+        with mem.open(**profile) as dst:
+            dst.colorinterp = src.colorinterp
+            dst.update_tags(**src.tags())
+            for bidx in src.indexes:
+                dst.update_tags(bidx, **src.tags(bidx))
+                dst.set_band_description(bidx, src.descriptions[bidx - 1] or "")
+                dst.set_band_unit(bidx, src.units[bidx - 1] or "")
+            dst.scales = src.scales
+            dst.offsets = src.offsets
+            try:
+                dst.write_colormap(1, src.colormap(1))
+            except ValueError:
+                pass
+
+        mem.seek(0)
+        _, ifds = tiff.read_ifds(mem)
+
+    return {code: tag for code, tag in ifds[0].tags.items() if code in tiff.DESCRIPTIVE_TAGS}
+
+
+def _ifd_tags(
+    level: _Level,
+    dtype: np.dtype,
+    count: int,
+    compression: int,
+    predictor: int,
+    descriptive: Dict[int, Tag],
+    offsets: List[int],
+    bigtiff: bool,
+) -> Dict[int, Tag]:
+    offset_type = tiff.LONG8 if bigtiff else tiff.LONG
+    tags = {
+        tiff.NEW_SUBFILE_TYPE: Tag(tiff.LONG, (tiff.REDUCED_RESOLUTION if level.index else 0,)),
+        tiff.IMAGE_WIDTH: Tag(tiff.LONG, (level.width,)),
+        tiff.IMAGE_LENGTH: Tag(tiff.LONG, (level.height,)),
+        tiff.BITS_PER_SAMPLE: Tag(tiff.SHORT, (dtype.itemsize * 8,) * count),
+        tiff.COMPRESSION: Tag(tiff.SHORT, (compression,)),
+        tiff.PHOTOMETRIC: descriptive.get(tiff.PHOTOMETRIC, Tag(tiff.SHORT, (1,))),
+        tiff.SAMPLES_PER_PIXEL: Tag(tiff.SHORT, (count,)),
+        tiff.PLANAR_CONFIGURATION: Tag(tiff.SHORT, (1,)),
+        tiff.TILE_WIDTH: Tag(tiff.SHORT, (level.block_width,)),
+        tiff.TILE_LENGTH: Tag(tiff.SHORT, (level.block_height,)),
+        tiff.TILE_OFFSETS: Tag(offset_type, tuple(offsets)),
+        tiff.TILE_BYTE_COUNTS: Tag(offset_type, tuple(level.byte_counts)),
+        tiff.SAMPLE_FORMAT: Tag(tiff.SHORT, (SAMPLE_FORMATS[dtype.kind],) * count),
+    }
+    if predictor != 1:
+        tags[tiff.PREDICTOR] = Tag(tiff.SHORT, (predictor,))
+
+    # Overviews share the layout tags of the image, only the full resolution
+    # image carries the georeferencing and metadata. GDAL reads the sparse
+    # tiles of an overview as its own nodata, so as GDAL it is on every level
+    shared = (tiff.EXTRA_SAMPLES, tiff.COLORMAP, tiff.GDAL_NODATA)
+    tags.update({code: tag for code, tag in descriptive.items() if level.index == 0 or code in shared})
+    return tags
+
+
+def _assemble(
+    levels: List[_Level],
+    out: BinaryIO,
+    dtype: np.dtype,
+    count: int,
+    compression: int,
+    predictor: int,
+    descriptive: Dict[int, Tag],
+    force_bigtiff: bool,
+) -> int:
+    """Write the header, every IFD and then the tiles of each level to ``out``"""
+
+    def layout(bigtiff: bool) -> Tuple[int, List[Dict[int, Tag]]]:
+        start = len(tiff.header(bigtiff, 0)) + len(tiff.ghost_header())
+        start += start % 2
+
+        # Sizes do not depend on the offsets, so lay out with placeholders first
+        placeholders = [
+            _ifd_tags(level, dtype, count, compression, predictor, descriptive, [0] * len(level.byte_counts), bigtiff)
+            for level in levels
+        ]
+        data_start = start + sum(tiff.ifd_size(tags, bigtiff) for tags in placeholders)
+
+        # Tile data is written from the smallest overview to the full image
+        ifds = []
+        base = data_start + sum(level.size for level in levels)
+        for level in levels:
+            base -= level.size
+            offsets = level.offsets(base)
+            ifds.append(_ifd_tags(level, dtype, count, compression, predictor, descriptive, offsets, bigtiff))
+        return start, ifds
+
+    total = sum(level.size for level in levels)
+    start, ifds = layout(False)
+    bigtiff = force_bigtiff or start + total + sum(tiff.ifd_size(tags, False) for tags in ifds) >= 2**32
+    if bigtiff:
+        start, ifds = layout(True)
+
+    head = tiff.header(bigtiff, start) + tiff.ghost_header()
+    head += b"\0" * (start - len(head))
+    head += tiff.encode_ifds(ifds, start, bigtiff)
+    out.write(head)
+
+    for level in reversed(levels):
+        level.file.seek(0)
+        shutil.copyfileobj(level.file, out, COPY_CHUNK_SIZE)
+
+    return len(head) + total
+
+
+def _read_level(
+    src: DatasetReader, index: int, push: Callable[[np.ndarray], None], block_height: int, recorder: Recorder
+) -> None:
+    """Read level ``index`` of the pyramid a row of tiles at a time, 0 being ``src`` and 1 its first overview"""
+    if index:
+        with rasterio.open(src.name, overview_level=index - 1) as overview:
+            _read_level(overview, 0, push, block_height, recorder)
+        return
+
+    for row in range(0, src.height, block_height):
+        with recorder.stage("read"):
+            rows = src.read(window=Window(0, row, src.width, min(block_height, src.height - row)))
+        push(rows)
+
+
+def _log_sparse(levels: List[_Level], encoder: _Encoder, count: int, dtype: np.dtype, recorder: Recorder) -> None:
+    """Log and record how many tiles are sparse and the bytes they would have taken"""
+    # Every nodata tile, padded or not, encodes to the same bytes
+    empty = np.full((count, encoder.block_height, encoder.block_width), encoder.fill, dtype=dtype)
+    tile_bytes = tiff.BLOCK_LEADER_SIZE + len(encoder(empty)) + tiff.BLOCK_TRAILER_SIZE
+
+    sparse = sum(level.sparse for level in levels)
+    total = sum(len(level.byte_counts) for level in levels)
+    saved = sparse * tile_bytes
+    log.info(
+        f"{sparse} of {total} tiles ({sparse / total:.1%}) are all nodata and stored sparse, "
+        f"{sum(level.sparse for level in levels[1:])} of them overview tiles, saving {saved / MiB:.2f} MiB"
+    )
+    recorder.add("sparse_tile_count", sparse)
+    recorder.add("sparse_saved_bytes", saved)
+
+
+def write_cog(
+    src: DatasetReader,
+    out: BinaryIO,
+    dst_profile: Dict[str, Any],
+    workers: Optional[int] = None,
+    memory_max_bytes: int = ENGINE_MEMORY_MAX_BYTES,
+    scratch_dir: Optional[str] = None,
+    resampling: str = "nearest",
+    recorder: Optional[Recorder] = None,
+    source: Optional[BinaryIO] = None,
+    previous: Optional[PreviousCog] = None,
+    tile_hashes: Optional[List[str]] = None,
+) -> int:
+    """Write ``src`` to ``out`` as a Cloud Optimised GeoTiff
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Open source raster, check it with ``unsupported_reason`` first
+    out : BinaryIO
+        Writable file object, e.g. a local file or an S3 ``MultipartWriter``.
+        It is written sequentially so does not need to be seekable.
+    dst_profile : Dict[str, Any]
+        COG profile, the block size, compression (deflate or none), zlevel,
+        predictor, BIGTIFF and SPARSE_OK options are used
+    workers : int, optional
+        Number of threads compressing tiles, defaults to ``COG_ENGINE_WORKERS``
+        or one per CPU
+    memory_max_bytes : int, optional
+        Approximate memory to use for pixels
+    scratch_dir : str, optional
+        Directory for the compressed tiles until they are assembled
+    resampling : str, optional
+        Overview resampling, nearest (as GDAL) or average
+    recorder : Recorder, optional
+        Records the time spent reading, building overviews, compressing and
+        assembling
+    source : BinaryIO, optional
+        Seekable file object of the bytes of ``src``. If ``copy_plan`` allows,
+        the source's compressed tiles are copied rather than re-encoded, and
+        the source's block size and predictor are used instead of the
+        profile's
+    previous : PreviousCog, optional
+        An earlier COG of this source with the same profile, whose tiles are
+        reused where the hash of the source tile is unchanged. Ignored when the
+        source's tiles are copied
+    tile_hashes : List[str], optional
+        An empty list, the hash of each full resolution tile of the source is
+        appended to it in row major order to pass to a later update. Left empty
+        when the source's tiles are copied
+
+    Returns
+    -------
+    int
+        Size of the COG in bytes
+    """
+    if resampling not in RESAMPLING:
+        raise ValueError(f"Unknown resampling {resampling}, expected one of {RESAMPLING}")
+    reason = unsupported_reason(src, dst_profile)
+    if reason:
+        raise ValueError(f"Cannot convert {src.name} : {reason}")
+
+    recorder = recorder or Recorder("write_cog")
+    workers = workers or ENGINE_WORKERS or os.cpu_count() or 1
+    block_width = int(dst_profile.get("blockxsize", 512))
+    block_height = int(dst_profile.get("blockysize", 512))
+    compression = COMPRESSION[str(dst_profile.get("compress") or "none").lower()]
+    predictor = int(dst_profile.get("predictor", 1))
+    dtype = np.dtype(src.dtypes[0])
+    nodata = src.nodata
+    sparse = sparse_option(dst_profile)
+
+    plan = None
+    if source is not None:
+        plan, reason = copy_plan(src, dst_profile, source)
+        if plan is None:
+            log.info(f"Not copying source tiles : {reason}")
+        else:
+            block_width, block_height = plan.block_width, plan.block_height
+            compression, predictor = plan.compression, plan.predictor
+
+    shapes = level_shapes(src.width, src.height, block_width, block_height)
+    row_bytes = src.width * block_height * src.count * dtype.itemsize
+    max_pending_rows = max(1, memory_max_bytes // max(row_bytes, 1) - 2)
+    if row_bytes * 3 > memory_max_bytes:
+        log.warning(
+            f"A row of tiles is {row_bytes / MiB:.1f} MiB, memory use will exceed {memory_max_bytes / MiB:.0f} MiB"
+        )
+
+    log.info(
+        f"Writing {src.width}x{src.height}x{src.count} {dtype} COG with {len(shapes) - 1} overviews, "
+        f"{workers} workers and up to {max_pending_rows} rows of tiles pending"
+    )
+
+    reusable = None
+    if previous is not None and plan is None:
+        reusable, reason = reuse_plan(
+            previous, shapes, block_width, block_height, compression, predictor, dtype, src.count
+        )
+        if reusable is None:
+            log.info(f"Not reusing the tiles of the previous COG : {reason}")
+    hashes = None
+    if plan is None and (tile_hashes is not None or reusable is not None):
+        hashes = [] if tile_hashes is None else tile_hashes
+
+    with tempfile.TemporaryDirectory(prefix="cog-engine-", dir=scratch_dir) as tmp_dir:
+        levels = [
+            _Level(ix, width, height, block_width, block_height, os.path.join(tmp_dir, f"level-{ix}.bin"))
+            for ix, (width, height) in enumerate(shapes)
+        ]
+        try:
+            # Copy what can be copied, then compute the remaining levels from
+            # the last copied one
+            copied = len(plan.levels) if plan else 0
+            for level, (offsets, byte_counts) in zip(levels, plan.levels if plan else []):
+                with recorder.stage("copy"):
+                    level.copy_tiles(source, offsets, byte_counts)
+            if copied:
+                log.info(f"Copied the tiles of {copied} of {len(levels)} levels from the source")
+
+            encoder = _Encoder(
+                dtype,
+                block_width,
+                block_height,
+                0 if nodata is None else nodata,
+                compression,
+                predictor,
+                int(dst_profile.get("zlevel", 6)),
+                recorder,
+            )
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                pyramid = _Pyramid(
+                    levels,
+                    encoder,
+                    pool,
+                    max_pending_rows,
+                    resampling,
+                    nodata,
+                    recorder,
+                    hashes,
+                    previous,
+                    reusable,
+                    sparse,
+                )
+                if copied < len(levels):
+                    start = max(copied - 1, 0)
+                    _read_level(src, start, lambda rows: pyramid.push(start, rows), block_height, recorder)
+                pyramid.finish()
+
+            if reusable is not None:
+                reused = sum(level.reused for level in levels)
+                total = sum(len(level.byte_counts) for level in levels)
+                log.info(
+                    f"Reused {reused} of {total} tiles of the previous COG, "
+                    f"{sum(levels[0].dirty)} of {len(levels[0].dirty)} full resolution tiles changed"
+                )
+                recorder.add("reused_tile_count", reused)
+
+            if any(level.sparse for level in levels):
+                _log_sparse(levels, encoder, src.count, dtype, recorder)
+
+            with recorder.stage("assemble"):
+                descriptive = template_tags(src)
+                force_bigtiff = str(dst_profile.get("BIGTIFF", "")).upper() == "YES"
+                return _assemble(levels, out, dtype, src.count, compression, predictor, descriptive, force_bigtiff)
+        finally:
+            for level in levels:
+                level.close()
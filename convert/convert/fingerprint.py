@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+# S3 user metadata keys stored on each output COG. The Lambda trigger computes
+# the fingerprint with a copy of ``fingerprint``, keep it in sync with
+# lambda/fingerprint.py
+FINGERPRINT_KEY = "cog-fingerprint"
+SOURCE_KEY = "cog-source"
+SOURCE_ETAG_KEY = "cog-source-etag"
+PROFILE_KEY = "cog-profile"
+
+# Codec chosen by the auto profile and the compression ratio of each codec it
+# trialled, see convert.compression
+COMPRESSION_KEY = "cog-compression"
+COMPRESSION_RATIOS_KEY = "cog-compression-ratios"
+
+
+@dataclass
+class CacheStats:
+    """Counts of conversions skipped (hits) or run (misses) in this process"""
+
+    hits: int = 0
+    misses: int = 0
+
+
+CACHE_STATS = CacheStats()
+
+
+def normalise_etag(etag: str) -> str:
+    """Strip the quotes that S3 puts around ETags in some responses"""
+    return etag.strip('"')
+
+
+def fingerprint(
+    bucket: str,
+    key: str,
+    etag: str,
+    version_id: Optional[str],
+    profile: str,
+    options: Dict[str, Any],
+) -> str:
+    """Fingerprint a conversion of a source object with a given COG profile
+
+    Parameters
+    ----------
+    bucket : str
+        Source S3 bucket
+    key : str
+        Source S3 key
+    etag : str
+        ETag of the source object
+    version_id : str, optional
+        Version of the source object, if the bucket is versioned
+    profile : str
+        Name of the COG profile
+    options : Dict[str, Any]
+        Creation options used with the profile
+
+    Returns
+    -------
+    str
+        Hex digest that changes whenever the source or conversion changes
+    """
+    payload = json.dumps(
+        {
+            "bucket": bucket,
+            "key": key.lstrip("/"),
+            "etag": normalise_etag(etag),
+            "version_id": version_id,
+            "profile": profile,
+            "options": options,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def output_metadata(bucket: str, key: str, etag: str, profile: str, digest: str) -> Dict[str, str]:
+    """S3 user metadata recording what an output was converted from"""
+    return {
+        FINGERPRINT_KEY: digest,
+        SOURCE_KEY: f"{bucket}/{key.lstrip('/')}",
+        SOURCE_ETAG_KEY: normalise_etag(etag),
+        PROFILE_KEY: profile,
+    }
+
+
+def is_current(metadata: Optional[Dict[str, str]], digest: str) -> bool:
+    """Check whether an output's metadata matches the given fingerprint
+
+    The result is counted as a cache hit or miss in ``CACHE_STATS``.
+    """
+    current = metadata is not None and metadata.get(FINGERPRINT_KEY) == digest
+    if current:
+        CACHE_STATS.hits += 1
+    else:
+        CACHE_STATS.misses += 1
+
+    log.info(f"Conversion cache {'hit' if current else 'miss'} ({CACHE_STATS.hits} hits, {CACHE_STATS.misses} misses)")
+    return current
@@ -0,0 +1,591 @@
+"""Index of the footprints of the COGs in an output bucket
+
+Each conversion appends the bounds, CRS, resolution, size and band count of
+the outputs it wrote to the index as a side effect, so consumers can find
+COGs by location or attributes without listing the bucket or opening a
+single COG.
+
+The index is a set of shards under a prefix of the output bucket. Every
+conversion writes a shard of its own with a unique key, so concurrent jobs
+never write the same object. Shards are merged from time to time by
+``compact``, which writes a merged shard listing the shards it replaces and
+only then deletes them. Readers ignore shards replaced by any shard they see,
+and keep the most recent record of each output, so merges running at the same
+time as each other or as readers lose nothing.
+
+A shard is a packed columnar file: a JSON header followed by the raw little
+endian arrays of each column. Text columns with few distinct values (CRS, data
+type, profile) are dictionary encoded so filtering on them compares integers.
+"""
+import json
+import logging
+import math
+import os
+import random
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+from convert.s3 import S3Helper
+
+if TYPE_CHECKING:
+    from rasterio.io import DatasetReader
+
+log = logging.getLogger(__name__)
+
+# Append the footprints of converted outputs to the index ("on") or not ("off")
+INDEX = os.environ.get("COG_INDEX", "on")
+
+# Prefix of the index shards in the output bucket
+INDEX_PREFIX = os.environ.get("COG_INDEX_PREFIX", "_index/footprints/")
+
+# Shards are merged in the background after one in this many appends, chosen
+# at random so concurrent jobs rarely merge at once, 0 never merges
+COMPACT_EVERY = int(os.environ.get("COG_INDEX_COMPACT_EVERY", 64))
+
+# Shards read in parallel when loading the index
+LOAD_CONCURRENCY = int(os.environ.get("COG_INDEX_LOAD_CONCURRENCY", 16))
+
+SHARD_SUFFIX = ".fpx"
+SHARD_MAGIC = b"FPX1"
+SHARD_VERSION = 1
+# Magic and length of the JSON header
+_PREAMBLE = struct.Struct("<4sI")
+
+# Numeric columns and their little endian types
+NUMERIC_COLUMNS = {
+    # Bounds in longitude and latitude (EPSG:4326), west > east when crossing
+    # the antimeridian and NaN without a CRS
+    "west": "<f8",
+    "south": "<f8",
+    "east": "<f8",
+    "north": "<f8",
+    # Bounds in the CRS of the COG
+    "minx": "<f8",
+    "miny": "<f8",
+    "maxx": "<f8",
+    "maxy": "<f8",
+    "res_x": "<f8",
+    "res_y": "<f8",
+    "width": "<u4",
+    "height": "<u4",
+    "count": "<u2",
+    # Size of the COG in bytes
+    "size": "<u8",
+    # Seconds since the epoch when the COG was written
+    "written": "<f8",
+}
+
+# Dictionary encoded text columns
+DICTIONARY_COLUMNS = ("crs", "dtype", "profile", "compression")
+
+
+@dataclass
+class Footprint:
+    """A record of the index, describing one COG"""
+
+    key: str
+    crs: str
+    west: float
+    south: float
+    east: float
+    north: float
+    minx: float
+    miny: float
+    maxx: float
+    maxy: float
+    res_x: float
+    res_y: float
+    width: int
+    height: int
+    count: int
+    dtype: str
+    profile: str = ""
+    compression: str = ""
+    size: int = 0
+    written: float = 0.0
+
+    @classmethod
+    def from_dataset(cls, key: str, src: "DatasetReader", profile: str = "", compression: str = "") -> "Footprint":
+        """Footprint of the COG at ``key`` written from ``src``, which has the same georeferencing
+
+        Parameters
+        ----------
+        key : str
+            Key of the COG
+        src : DatasetReader
+            Open source raster
+        profile : str, optional
+            COG profile of the output
+        compression : str, optional
+            Compression of the output
+
+        Returns
+        -------
+        Footprint
+            Footprint without the size and time the COG was written
+        """
+        from rasterio.warp import transform_bounds
+
+        bounds = src.bounds
+        if src.crs:
+            west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *bounds, densify_pts=21)
+            crs = src.crs.to_string()
+        else:
+            west = south = east = north = math.nan
+            crs = ""
+        res_x, res_y = src.res
+        return cls(
+            key,
+            crs,
+            west,
+            south,
+            east,
+            north,
+            bounds.left,
+            bounds.bottom,
+            bounds.right,
+            bounds.top,
+            res_x,
+            res_y,
+            src.width,
+            src.height,
+            src.count,
+            src.dtypes[0],
+            profile,
+            (compression or "").lower(),
+        )
+
+
+class FootprintTable:
+    """Footprints held column by column, as stored in a shard"""
+
+    def __init__(
+        self,
+        columns: Dict[str, np.ndarray],
+        dictionaries: Dict[str, List[str]],
+        key_offsets: np.ndarray,
+        key_data: bytes,
+    ):
+        # Numeric columns, and the codes of the dictionary encoded columns
+        self.columns = columns
+        # Values of each dictionary encoded column, indexed by code
+        self.dictionaries = dictionaries
+        # The keys, utf-8 encoded and concatenated, key i spans
+        # key_data[key_offsets[i]:key_offsets[i + 1]]
+        self.key_offsets = key_offsets
+        self.key_data = key_data
+
+    def __len__(self) -> int:
+        return len(self.key_offsets) - 1
+
+    @classmethod
+    def empty(cls) -> "FootprintTable":
+        return cls.from_footprints([])
+
+    @classmethod
+    def from_footprints(cls, footprints: Sequence[Footprint]) -> "FootprintTable":
+        columns = {
+            name: np.array([getattr(footprint, name) for footprint in footprints], dtype=dtype)
+            for name, dtype in NUMERIC_COLUMNS.items()
+        }
+        dictionaries = {}
+        for name in DICTIONARY_COLUMNS:
+            values = [getattr(footprint, name) for footprint in footprints]
+            dictionaries[name] = sorted(set(values))
+            lookup = {value: code for code, value in enumerate(dictionaries[name])}
+            columns[name] = np.array([lookup[value] for value in values], dtype="<u4")
+
+        keys = [footprint.key.encode("utf-8") for footprint in footprints]
+        key_offsets = np.zeros(len(keys) + 1, dtype="<u8")
+        np.cumsum([len(key) for key in keys], out=key_offsets[1:])
+        return cls(columns, dictionaries, key_offsets, b"".join(keys))
+
+    @classmethod
+    def concat(cls, tables: Sequence["FootprintTable"]) -> "FootprintTable":
+        """Join tables end to end, merging their dictionaries"""
+        tables = [table for table in tables if len(table)]
+        if not tables:
+            return cls.empty()
+        if len(tables) == 1:
+            return tables[0]
+
+        columns = {name: np.concatenate([table.columns[name] for table in tables]) for name in NUMERIC_COLUMNS}
+        dictionaries = {}
+        for name in DICTIONARY_COLUMNS:
+            dictionaries[name] = sorted(set().union(*(table.dictionaries[name] for table in tables)))
+            lookup = {value: code for code, value in enumerate(dictionaries[name])}
+            columns[name] = np.concatenate(
+                [
+                    np.array([lookup[value] for value in table.dictionaries[name]], dtype="<u4")[table.columns[name]]
+                    for table in tables
+                ]
+            )
+
+        key_offsets, start = [np.zeros(1, dtype="<u8")], 0
+        for table in tables:
+            key_offsets.append(table.key_offsets[1:] + start)
+            start += len(table.key_data)
+        return cls(columns, dictionaries, np.concatenate(key_offsets), b"".join(table.key_data for table in tables))
+
+    def key(self, index: int) -> str:
+        return self.key_data[self.key_offsets[index] : self.key_offsets[index + 1]].decode("utf-8")
+
+    def keys(self) -> List[str]:
+        return [self.key(index) for index in range(len(self))]
+
+    def _fixed_width_keys(self) -> np.ndarray:
+        """The keys as a numpy array of bytes padded to the longest, which sorts without Python objects"""
+        lengths = np.diff(self.key_offsets).astype("i8")
+        width = max(int(lengths.max()), 1) if len(lengths) else 1
+        padded = np.zeros((len(lengths), width), dtype="u1")
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        columns = np.arange(len(self.key_data)) - np.repeat(self.key_offsets[:-1].astype("i8"), lengths)
+        padded[rows, columns] = np.frombuffer(self.key_data, dtype="u1")
+        return padded.view(f"S{width}").ravel()
+
+    def take(self, indices: np.ndarray) -> "FootprintTable":
+        """A table of the rows at ``indices``"""
+        columns = {name: column[indices] for name, column in self.columns.items()}
+
+        # Gather the bytes of the keys with a single fancy index
+        starts = self.key_offsets[indices].astype("i8")
+        lengths = self.key_offsets[np.asarray(indices) + 1].astype("i8") - starts
+        key_offsets = np.zeros(len(lengths) + 1, dtype="<u8")
+        np.cumsum(lengths, out=key_offsets[1:])
+        positions = np.repeat(starts - key_offsets[:-1].astype("i8"), lengths) + np.arange(int(key_offsets[-1]))
+        key_data = np.frombuffer(self.key_data, dtype="u1")[positions].tobytes()
+        return FootprintTable(columns, self.dictionaries, key_offsets, key_data)
+
+    def latest(self) -> "FootprintTable":
+        """The most recently written record of each key, sorted by key"""
+        if not len(self):
+            return self
+        keys = self._fixed_width_keys()
+        # sort most recent first, then stably by key, and keep the first of each key
+        newest = np.argsort(-self.columns["written"], kind="stable")
+        order = newest[np.argsort(keys[newest], kind="stable")]
+        sorted_keys = keys[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        return self.take(order[first])
+
+    def footprint(self, index: int) -> Footprint:
+        values: Dict[str, Any] = {name: self.columns[name][index].item() for name in NUMERIC_COLUMNS}
+        for name in DICTIONARY_COLUMNS:
+            values[name] = self.dictionaries[name][self.columns[name][index]]
+        return Footprint(key=self.key(index), **values)
+
+    def mask(
+        self,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:
+        """Rows that intersect ``bbox`` and match ``where``, see ``FootprintIndex.query``"""
+        mask = np.ones(len(self), dtype=bool)
+        if bbox is not None:
+            mask &= _intersects(self.columns, *bbox)
+
+        for name, value in (where or {}).items():
+            if name in DICTIONARY_COLUMNS:
+                lookup = {text: code for code, text in enumerate(self.dictionaries[name])}
+                values = value if isinstance(value, (list, set)) else [value]
+                codes = [lookup[text] for text in values if text in lookup]
+                mask &= np.isin(self.columns[name], codes)
+            elif name in NUMERIC_COLUMNS:
+                column = self.columns[name]
+                if isinstance(value, tuple):
+                    low, high = value
+                    if low is not None:
+                        mask &= column >= low
+                    if high is not None:
+                        mask &= column <= high
+                elif isinstance(value, (list, set)):
+                    mask &= np.isin(column, list(value))
+                else:
+                    mask &= column == value
+            else:
+                raise ValueError(f"Unknown footprint attribute {name}")
+        return mask
+
+    def select(
+        self,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        prefix: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Footprint]:
+        """Footprints of the rows matching a query, see ``FootprintIndex.query``"""
+        indices = np.flatnonzero(self.mask(bbox, where))
+        if prefix is not None:
+            indices = np.array([index for index in indices if self.key(index).startswith(prefix)], dtype="i8")
+        indices = indices[:limit]
+
+        # Build the footprints from whole columns rather than a row at a time
+        values: Dict[str, List[Any]] = {name: self.columns[name][indices].tolist() for name in NUMERIC_COLUMNS}
+        for name in DICTIONARY_COLUMNS:
+            values[name] = [self.dictionaries[name][code] for code in self.columns[name][indices].tolist()]
+        values["key"] = [self.key(index) for index in indices]
+        return [Footprint(**dict(zip(values, row))) for row in zip(*values.values())]
+
+    def dumps(self, replaces: Sequence[str] = ()) -> bytes:
+        """Pack the table into a shard, which replaces the shards at ``replaces``"""
+        buffers = [(name, np.ascontiguousarray(column)) for name, column in self.columns.items()]
+        buffers.append(("key_offsets", self.key_offsets))
+        buffers.append(("key_data", np.frombuffer(self.key_data, dtype="u1")))
+
+        layout, offset = {}, 0
+        for name, array in buffers:
+            layout[name] = {"dtype": array.dtype.str, "offset": offset, "length": len(array)}
+            # keep every array 8 byte aligned
+            offset += -(-array.nbytes // 8) * 8
+        header = json.dumps(
+            {
+                "version": SHARD_VERSION,
+                "rows": len(self),
+                "replaces": list(replaces),
+                "dictionaries": self.dictionaries,
+                "columns": layout,
+            },
+            separators=(",", ":"),
+        ).encode("utf-8")
+        header += b" " * (-(_PREAMBLE.size + len(header)) % 8)
+
+        data = bytearray(_PREAMBLE.pack(SHARD_MAGIC, len(header)) + header)
+        for _, array in buffers:
+            data += array.tobytes()
+            data += b"\0" * (-array.nbytes % 8)
+        return bytes(data)
+
+    @classmethod
+    def loads(cls, data: bytes) -> Tuple["FootprintTable", List[str]]:
+        """Unpack a shard, returning the table and the keys of the shards it replaces
+
+        Raises ValueError if ``data`` is not a shard of this version.
+        """
+        magic, length = _PREAMBLE.unpack_from(data)
+        if magic != SHARD_MAGIC:
+            raise ValueError("Not a footprint index shard")
+        header = json.loads(data[_PREAMBLE.size : _PREAMBLE.size + length])
+        if header["version"] != SHARD_VERSION:
+            raise ValueError(f"Footprint index shard is of version {header['version']}, not {SHARD_VERSION}")
+
+        start = _PREAMBLE.size + length
+        arrays = {
+            name: np.frombuffer(data, dtype=column["dtype"], count=column["length"], offset=start + column["offset"])
+            for name, column in header["columns"].items()
+        }
+        key_offsets, key_data = arrays.pop("key_offsets"), arrays.pop("key_data").tobytes()
+        return cls(arrays, header["dictionaries"], key_offsets, key_data), header["replaces"]
+
+
+def _intersects(columns: Dict[str, np.ndarray], west: float, south: float, east: float, north: float) -> np.ndarray:
+    """Rows whose longitude and latitude bounds intersect a box, either of which may cross the antimeridian"""
+    row_west, row_east = columns["west"], columns["east"]
+    mask = (columns["south"] <= north) & (columns["north"] >= south)
+
+    wraps = row_west > row_east
+    if west <= east:
+        lon = np.where(wraps, (row_west <= east) | (row_east >= west), (row_west <= east) & (row_east >= west))
+    else:
+        # Rows that also cross the antimeridian always overlap the box in longitude
+        lon = wraps | (row_east >= west) | (row_west <= east)
+    return mask & lon
+
+
+@dataclass
+class _Shard:
+    table: FootprintTable
+    replaces: List[str]
+
+
+class FootprintIndex:
+    """The footprint index under a prefix of a bucket
+
+    Shards are immutable, so each is read once and kept for the life of the
+    index, and only new shards are read when the index is loaded again.
+    """
+
+    def __init__(self, s3: S3Helper, prefix: str = INDEX_PREFIX):
+        self.s3 = s3
+        self.prefix = prefix
+        self._shards: Dict[str, _Shard] = {}
+        self._live: Optional[Tuple[str, ...]] = None
+        self._table = FootprintTable.empty()
+        self._lock = threading.Lock()
+
+    def _new_key(self, kind: str) -> str:
+        # time first so the shards list in the order they were written
+        return f"{self.prefix}{time.time_ns():020d}-{kind}-{uuid4().hex[:12]}{SHARD_SUFFIX}"
+
+    def shard_keys(self) -> List[str]:
+        return [key for key in self.s3.list_keys(self.prefix) if key.endswith(SHARD_SUFFIX)]
+
+    def append(self, footprints: Sequence[Footprint]) -> Optional[str]:
+        """Write ``footprints`` to a new shard, returning its key"""
+        if not footprints:
+            return None
+        key = self._new_key("part")
+        # sorted by key as the index is, so a lone shard needs no sorting
+        table = FootprintTable.from_footprints(sorted(footprints, key=lambda footprint: footprint.key))
+        self.s3.write_bytes(table.dumps(), key)
+        log.info(f"Appended {len(footprints)} footprints to the index at {self.s3.bucket_name}/{key}")
+        return key
+
+    def _read(self, keys: Sequence[str]) -> List[str]:
+        """Read the shards at ``keys`` not already read, returning the keys that no longer exist"""
+        keys = [key for key in keys if key not in self._shards]
+        if not keys:
+            return []
+
+        def read(key: str) -> Optional[Tuple[str, _Shard]]:
+            try:
+                data = self.s3.get_bytes(key).getvalue()
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                    return None
+                raise
+            return key, _Shard(*FootprintTable.loads(data))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(LOAD_CONCURRENCY, len(keys)))) as pool:
+            results = list(pool.map(read, keys))
+        self._shards.update(result for result in results if result)
+        return [key for key, result in zip(keys, results) if result is None]
+
+    def _live_shards(self) -> List[str]:
+        """Keys of the shards that are not replaced by another, reading any new ones"""
+        for _ in range(5):
+            keys = self.shard_keys()
+            # A shard that was listed but is gone has been merged, and the
+            # merged shard was written before it was deleted, so list again
+            if not self._read(keys):
+                break
+        else:
+            raise RuntimeError(f"Shards under {self.prefix} kept disappearing while loading the index")
+
+        replaced = {old for key in keys for old in self._shards[key].replaces}
+        for key in list(self._shards):
+            if key not in keys:
+                del self._shards[key]
+        return [key for key in keys if key not in replaced]
+
+    def load(self) -> FootprintTable:
+        """The most recent footprint of every COG in the index"""
+        with self._lock:
+            live = tuple(self._live_shards())
+            if live != self._live:
+                table = FootprintTable.concat([self._shards[key].table for key in live])
+                # A single shard has one footprint per COG already, as it was
+                # either merged or written by a single conversion
+                self._table = table.latest() if len(live) > 1 else table
+                self._live = live
+            return self._table
+
+    def query(
+        self,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        prefix: Optional[str] = None,
+        limit: Optional[int] = None,
+        refresh: bool = True,
+    ) -> List[Footprint]:
+        """Find COGs by location and attributes, without reading the COGs
+
+        Parameters
+        ----------
+        bbox : Tuple[float, float, float, float], optional
+            West, south, east and north bounds in longitude and latitude
+            (EPSG:4326). COGs whose bounds intersect it are returned, west may
+            be greater than east for a box crossing the antimeridian
+        where : Dict[str, Any], optional
+            Attributes to match by name, see ``Footprint``. Values are matched
+            exactly, against any of a list of values, or within an inclusive
+            ``(low, high)`` range of numbers where either may be None, e.g.
+            ``{"crs": "EPSG:32630", "count": 3, "res_x": (None, 10)}``
+        prefix : str, optional
+            Only return COGs whose key starts with this prefix
+        limit : int, optional
+            Return at most this many footprints
+        refresh : bool, optional
+            Read any shards written since the index was last loaded
+
+        Returns
+        -------
+        List[Footprint]
+            Matching footprints, sorted by key
+        """
+        table = self.load() if refresh or self._live is None else self._table
+        return table.select(bbox, where, prefix, limit)
+
+    def compact(self, min_shards: int = 2) -> Optional[str]:
+        """Merge every shard into one, returning its key or None if there were fewer than ``min_shards``
+
+        The merged shard is written before the shards it replaces are deleted,
+        so readers see every footprint throughout.
+        """
+        with self._lock:
+            live = self._live_shards()
+            if len(live) < min_shards:
+                return None
+            table = FootprintTable.concat([self._shards[key].table for key in live]).latest()
+
+        key = self._new_key("merged")
+        self.s3.write_bytes(table.dumps(replaces=live), key)
+        self.s3.delete_keys(live)
+        log.info(f"Merged {len(live)} index shards with {len(table)} footprints into {self.s3.bucket_name}/{key}")
+        return key
+
+
+_compactions: Dict[Tuple[str, str], threading.Thread] = {}
+_compactions_lock = threading.Lock()
+
+
+def compact_in_background(index: FootprintIndex) -> Optional[threading.Thread]:
+    """Merge the shards of ``index`` on a thread, unless a merge of it is already running in this process
+
+    The thread is not a daemon, so the interpreter waits for it on exit.
+    """
+
+    def run() -> None:
+        try:
+            index.compact()
+        except Exception:
+            log.warning(f"Failed to merge the footprint index at {index.s3.bucket_name}/{index.prefix}", exc_info=True)
+
+    key = (index.s3.bucket_name, index.prefix)
+    with _compactions_lock:
+        running = _compactions.get(key)
+        if running is not None and running.is_alive():
+            return None
+        thread = threading.Thread(target=run, name=f"compact-{index.prefix}")
+        _compactions[key] = thread
+        thread.start()
+    return thread
+
+
+def record_outputs(s3: S3Helper, footprints: Iterable[Footprint]) -> Optional[str]:
+    """Append the footprints of converted outputs to the index of their bucket, see ``INDEX``
+
+    After one in ``COMPACT_EVERY`` appends the shards of the index are merged
+    in the background.
+
+    Returns
+    -------
+    Optional[str]
+        Key of the new shard, None if nothing was appended
+    """
+    footprints = list(footprints)
+    if INDEX == "off" or not footprints:
+        return None
+    index = FootprintIndex(s3)
+    key = index.append(footprints)
+    if COMPACT_EVERY and random.random() * COMPACT_EVERY < 1:
+        compact_in_background(index)
+    return key
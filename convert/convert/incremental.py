@@ -0,0 +1,133 @@
+"""Update a COG incrementally when a new version of its source arrives
+
+Each output written incrementally has a sidecar object alongside it holding
+the hash of every full resolution tile of the source it was made from. When
+the source changes, the engine hashes the tiles of the new version and only
+encodes those that differ, and the overview tiles above them. The compressed
+bytes of every other tile are read from the existing output.
+
+The sidecar records the fingerprint of the output it describes, so it is
+ignored if the output was written again without it.
+"""
+import hashlib
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from rasterio.io import DatasetReader
+
+from convert.fingerprint import FINGERPRINT_KEY
+from convert.s3 import S3Helper
+
+log = logging.getLogger(__name__)
+
+# Write outputs incrementally ("on") or always encode every tile ("off")
+INCREMENTAL = os.environ.get("COG_INCREMENTAL", "off")
+
+# Suffix of the key of the sidecar of an output
+SIDECAR_SUFFIX = ".tiles.json"
+
+# Version of the sidecar format, sidecars of other versions are ignored
+SIDECAR_VERSION = 1
+
+
+def sidecar_key(out_key: str) -> str:
+    """Key of the tile hashes of the output at ``out_key``"""
+    return f"{out_key}{SIDECAR_SUFFIX}"
+
+
+def settings_digest(profile: str, options: Dict[str, Any]) -> str:
+    """Digest of the profile and creation options, tiles are only reused between outputs with the same"""
+    payload = json.dumps({"profile": profile, "options": options}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def source_layout(src: DatasetReader, dst_profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Properties of the source that must be unchanged for its tiles to be comparable"""
+    return {
+        "width": src.width,
+        "height": src.height,
+        "count": src.count,
+        "dtype": src.dtypes[0],
+        # a string so that a NaN nodata compares equal
+        "nodata": str(src.nodata),
+        "blockxsize": int(dst_profile.get("blockxsize", 512)),
+        "blockysize": int(dst_profile.get("blockysize", 512)),
+    }
+
+
+@dataclass
+class TileSidecar:
+    """Hashes of the source tiles of an output"""
+
+    # Fingerprint of the output, see convert.fingerprint
+    fingerprint: str
+    # See settings_digest
+    settings: str
+    # See source_layout
+    layout: Dict[str, Any]
+    # Hash of each full resolution tile in row major order, see convert.engine.tile_hash
+    hashes: List[str]
+
+    def dumps(self) -> bytes:
+        return json.dumps(dict(asdict(self), version=SIDECAR_VERSION), separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def loads(cls, data: bytes) -> "TileSidecar":
+        """Parse a sidecar, raising ValueError if it is not one of this version"""
+        try:
+            fields = json.loads(data)
+            if fields.pop("version") != SIDECAR_VERSION:
+                raise ValueError("Tile sidecar is of another version")
+            return cls(**fields)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Not a tile sidecar : {e}") from None
+
+
+def load_sidecar(
+    s3: S3Helper,
+    out_key: str,
+    existing: Optional[Dict[str, str]],
+    settings: str,
+    layout: Dict[str, Any],
+) -> Tuple[Optional[TileSidecar], Optional[str]]:
+    """The sidecar of the existing output, if its tiles can be reused
+
+    Parameters
+    ----------
+    s3 : S3Helper
+        Output bucket
+    out_key : str
+        Key of the output
+    existing : Dict[str, str], optional
+        User metadata of the existing output, None if there is none
+    settings : str
+        Digest of the profile and options of the new output
+    layout : Dict[str, Any]
+        Layout of the new source
+
+    Returns
+    -------
+    Tuple[Optional[TileSidecar], Optional[str]]
+        The sidecar, or None and why the existing output cannot be reused
+    """
+    if existing is None:
+        return None, "there is no existing output"
+
+    key = sidecar_key(out_key)
+    if s3.get_metadata(key) is None:
+        return None, f"the existing output has no tile hashes at {key}"
+    try:
+        sidecar = TileSidecar.loads(s3.get_bytes(key).getvalue())
+    except ValueError as e:
+        return None, str(e)
+
+    if sidecar.fingerprint != existing.get(FINGERPRINT_KEY):
+        return None, "the tile hashes are of another version of the output"
+    if sidecar.settings != settings:
+        return None, "the profile or creation options changed"
+    if sidecar.layout != layout:
+        return None, f"the source layout changed from {sidecar.layout} to {layout}"
+    return sidecar, None
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass
+from typing import List
+from urllib.parse import urlparse
+
+from convert.s3 import S3Helper
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Task:
+    """A single object to convert"""
+
+    bucket: str
+    key: str
+    out_bucket: str
+    out_key: str
+
+
+# Extensions of keys whose output key keeps the extension, matched in any case
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+
+def default_out_key(key: str) -> str:
+    """Output key used when one is not given explicitly, ``a.tif`` to ``a-cog.tif``"""
+    root, ext = os.path.splitext(key)
+    if ext.lower() in TIFF_EXTENSIONS:
+        return f"{root}-cog{ext}"
+    return f"{key}-cog.tif"
+
+
+def check_task(task: Task) -> None:
+    """Raise a ValueError if converting ``task`` would overwrite its source"""
+    if (task.bucket, task.key) == (task.out_bucket, task.out_key):
+        raise ValueError(f"Output s3://{task.out_bucket}/{task.out_key} is the source, refusing to overwrite it")
+
+
+def parse_manifest(text: str) -> List[Task]:
+    """Parse a JSON manifest, a list of bucket/key/out_bucket/out_key objects
+
+    Parameters
+    ----------
+    text : str
+        JSON text of the manifest
+
+    Returns
+    -------
+    List[Task]
+        Tasks in the order of the manifest
+    """
+    return [Task(**entry) for entry in json.loads(text)]
+
+
+def dump_manifest(tasks: List[Task]) -> str:
+    """Serialise ``tasks`` to the JSON manifest format"""
+    return json.dumps([asdict(task) for task in tasks])
+
+
+def load_manifest(source: str) -> List[Task]:
+    """Load a manifest from an S3 URI, a local file or an inline JSON string
+
+    Parameters
+    ----------
+    source : str
+        ``s3://bucket/key`` of a manifest object, path to a local manifest
+        file, or the JSON manifest itself
+
+    Returns
+    -------
+    List[Task]
+        Tasks in the order of the manifest
+    """
+    if source.startswith("s3://"):
+        url = urlparse(source)
+        log.info(f"Loading manifest from S3 : {source}")
+        text = S3Helper(url.netloc).get_bytes(url.path).getvalue().decode("utf-8")
+    elif os.path.isfile(source):
+        log.info(f"Loading manifest from file : {source}")
+        with open(source, "r") as fh:
+            text = fh.read()
+    else:
+        text = source
+
+    return parse_manifest(text)
+
+
+def task_for_array_index(tasks: List[Task]) -> Task:
+    """Select the task for this child of an AWS Batch array job
+
+    Batch sets AWS_BATCH_JOB_ARRAY_INDEX to the index of each child job, which
+    is not set for a plain (non-array) job, so that defaults to the first task.
+    """
+    index = int(os.environ.get("AWS_BATCH_JOB_ARRAY_INDEX", 0))
+    log.info(f"Array index {index} of {len(tasks)} tasks")
+    return tasks[index]
@@ -0,0 +1,273 @@
+import ctypes
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import rasterio  # noqa: F401, loads the GDAL library that cache usage is read from
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# CloudWatch namespace of metrics written in embedded metric format
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "aws-gdal-robot")
+
+# Comma separated sinks that records are emitted to by default, see SINKS
+DEFAULT_SINKS = os.environ.get("METRICS_SINKS", "log")
+
+# CloudWatch units of each metric, by the suffix of its name
+UNITS = {"_seconds": "Seconds", "_bytes": "Bytes", "_mib": "Megabytes", "_count": "Count"}
+
+
+def peak_rss_mib() -> float:
+    """Peak resident set size of this process in MiB"""
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@lru_cache(maxsize=None)
+def _libgdal() -> Optional[ctypes.CDLL]:
+    """Handle on the GDAL library loaded by rasterio, if it can be found
+
+    Rasterio does not expose the block cache statistics, so the library is
+    found in the memory map of the process and the C API called directly.
+    """
+    try:
+        with open("/proc/self/maps", "r") as fh:
+            paths = sorted({line.split()[-1] for line in fh if "libgdal" in line})
+    except OSError:
+        return None
+
+    for path in paths:
+        try:
+            lib = ctypes.CDLL(path)
+            lib.GDALGetCacheUsed64.restype = ctypes.c_int64
+            lib.GDALGetCacheMax64.restype = ctypes.c_int64
+            return lib
+        except (OSError, AttributeError):
+            continue
+    return None
+
+
+def gdal_cache_mib() -> Optional[Tuple[float, float]]:
+    """Used and maximum size of the GDAL block cache in MiB, if available"""
+    lib = _libgdal()
+    if lib is None:
+        return None
+    return lib.GDALGetCacheUsed64() / MiB, lib.GDALGetCacheMax64() / MiB
+
+
+def reset_network_stats() -> None:
+    """Reset GDAL's counts of the requests made by its network file systems, if available"""
+    lib = _libgdal()
+    if lib is not None and hasattr(lib, "VSINetworkStatsReset"):
+        lib.VSINetworkStatsReset()
+
+
+def network_bytes() -> Optional[int]:
+    """Bytes downloaded by GDAL's network file systems (e.g. /vsis3/) since the stats were reset
+
+    GDAL only counts requests made while ``CPL_VSIL_NETWORK_STATS_ENABLED`` is
+    set, and counts them for the whole process. None if the stats are not
+    available from this build of GDAL.
+    """
+    lib = _libgdal()
+    if lib is None or not hasattr(lib, "VSINetworkStatsGetAsSerializedJSON"):
+        return None
+
+    lib.VSINetworkStatsGetAsSerializedJSON.argtypes = [ctypes.c_void_p]
+    lib.VSINetworkStatsGetAsSerializedJSON.restype = ctypes.c_void_p
+    lib.VSIFree.argtypes = [ctypes.c_void_p]
+    ptr = lib.VSINetworkStatsGetAsSerializedJSON(None)
+    if not ptr:
+        return None
+    try:
+        stats = json.loads(ctypes.string_at(ptr).decode())
+    finally:
+        lib.VSIFree(ptr)
+    return sum(method.get("downloaded_bytes", 0) for method in stats.get("methods", {}).values())
+
+
+class Sink(ABC):
+    """Destination of metric records, a subclass must implement emit"""
+
+    @abstractmethod
+    def emit(self, record: Dict[str, Any]) -> None:
+        """Write a single metric record"""
+
+
+class LogSink(Sink):
+    """Write each record as a single JSON log line"""
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        log.info(json.dumps(record, sort_keys=True))
+
+
+class EmfSink(Sink):
+    """Write each record to stdout in CloudWatch embedded metric format
+
+    CloudWatch Logs extracts the metrics from these lines, so no API calls are
+    needed. See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format.html
+    """
+
+    def __init__(self, namespace: str = NAMESPACE, stream: Any = None):
+        self.namespace = namespace
+        self.stream = stream
+
+    def format(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        metrics = [{"Name": name, "Unit": _unit(name)} for name in record["metrics"]]
+        document = {
+            "_aws": {
+                "Timestamp": int(record["timestamp"] * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [["name", *record["dimensions"]]],
+                        "Metrics": metrics,
+                    }
+                ],
+            },
+            "name": record["name"],
+        }
+        # Properties are searchable in CloudWatch Logs Insights but not metrics
+        document.update(record["properties"])
+        document.update(record["dimensions"])
+        document.update(record["metrics"])
+        return document
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        stream = self.stream or sys.stdout
+        stream.write(json.dumps(self.format(record)) + "\n")
+        stream.flush()
+
+
+class CaptureSink(Sink):
+    """Keep records in memory, for tests and local debugging"""
+
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        self.records.append(record)
+
+
+# Sinks that can be selected by name with METRICS_SINKS
+SINKS = {"log": LogSink, "emf": EmfSink}
+
+
+def _unit(name: str) -> str:
+    for suffix, unit in UNITS.items():
+        if name.endswith(suffix):
+            return unit
+    return "None"
+
+
+def sinks_from_names(names: str) -> List[Sink]:
+    """Create sinks from a comma separated list of names, e.g. ``log,emf``"""
+    return [SINKS[name.strip()]() for name in names.split(",") if name.strip()]
+
+
+_sinks: List[Sink] = sinks_from_names(DEFAULT_SINKS)
+
+
+def get_sinks() -> List[Sink]:
+    """Sinks that records are currently emitted to"""
+    return list(_sinks)
+
+
+def set_sinks(sinks: List[Sink]) -> List[Sink]:
+    """Replace the sinks that records are emitted to, returning the previous ones"""
+    global _sinks
+    previous, _sinks = _sinks, list(sinks)
+    return previous
+
+
+@contextmanager
+def capture() -> Iterator[CaptureSink]:
+    """Capture the records emitted within the block instead of emitting them"""
+    sink = CaptureSink()
+    previous = set_sinks([sink])
+    try:
+        yield sink
+    finally:
+        set_sinks(previous)
+
+
+class Recorder:
+    """Stage timings and resource usage of a single operation, e.g. a conversion
+
+    Time spent in each named ``stage`` is accumulated, so a stage that runs in
+    several threads records the total time across them. ``emit`` sends one
+    record to every sink, which includes the peak RSS and GDAL cache usage.
+    """
+
+    def __init__(self, name: str, dimensions: Optional[Dict[str, str]] = None):
+        """
+        Parameters
+        ----------
+        name : str
+            Name of the operation being recorded
+        dimensions : Dict[str, str], optional
+            Low cardinality values to aggregate metrics by, e.g. the profile
+        """
+        self.name = name
+        self.dimensions = dict(dimensions or {})
+        self.properties: Dict[str, Any] = {}
+        self.metrics: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Time the block as part of the stage ``name``"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{name}_seconds", time.perf_counter() - start)
+
+    def add(self, name: str, value: float) -> None:
+        """Add ``value`` to the metric ``name``"""
+        with self._lock:
+            self.metrics[name] = self.metrics.get(name, 0) + value
+
+    def set_property(self, name: str, value: Any) -> None:
+        """Record a value that describes the operation but is not a metric"""
+        self.properties[name] = value
+
+    def record(self) -> Dict[str, Any]:
+        """The record for the operation so far"""
+        metrics = dict(self.metrics)
+        metrics["total_seconds"] = time.perf_counter() - self._start
+        metrics["peak_rss_mib"] = peak_rss_mib()
+
+        cache = gdal_cache_mib()
+        if cache is not None:
+            metrics["gdal_cache_used_mib"], metrics["gdal_cache_max_mib"] = cache
+
+        return {
+            "name": self.name,
+            "timestamp": time.time(),
+            "dimensions": dict(self.dimensions),
+            "properties": dict(self.properties),
+            "metrics": metrics,
+        }
+
+    def emit(self, sinks: Optional[List[Sink]] = None) -> Dict[str, Any]:
+        """Send the record to ``sinks`` (default: the configured sinks)"""
+        record = self.record()
+        for sink in _sinks if sinks is None else sinks:
+            try:
+                sink.emit(record)
+            except Exception:
+                # Metrics must never fail a conversion
+                log.exception(f"Failed to emit metrics to {type(sink).__name__}")
+        return record
@@ -0,0 +1,195 @@
+"""GDAL runtime configuration profiles
+
+A profile is a set of GDAL config options (block cache, threads and file
+system behaviour) plus the creation options that go with them. One is picked
+per conversion from the input size, data type and the CPU and memory limits
+of the container, and applied with ``rasterio.Env``.
+"""
+import logging
+import math
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# Name of the profile to use for every conversion, or "auto" to select one
+RUNTIME_PROFILE = os.environ.get("GDAL_RUNTIME_PROFILE", "auto")
+
+# Inputs with less work than this (source bytes times bytes per sample) are
+# converted on a single thread, as threads cost more than they save
+SERIAL_MAX_WORK = int(os.environ.get("GDAL_RUNTIME_SERIAL_MAX_WORK", 64 * MiB))
+
+# Inputs larger than this fraction of the container memory use a bounded cache
+BOUNDED_MEMORY_FRACTION = 0.25
+
+# Options that apply to every profile, sidecar files (.aux.xml, .ovr, .msk)
+# are never used so directories need not be listed when a file is opened
+COMMON_OPTIONS = {"GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"}
+
+
+@dataclass(frozen=True)
+class Resources:
+    """CPUs and memory available to this process"""
+
+    cpus: float
+    memory_bytes: int
+
+
+def _read_first_line(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as fh:
+            return fh.readline().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_cpus() -> Optional[float]:
+    """CPU quota of the container from cgroup v2 or v1, None if unlimited"""
+    quota = _read_first_line("/sys/fs/cgroup/cpu.max")
+    if quota:
+        limit, period = quota.split()[:2]
+        return None if limit == "max" else int(limit) / int(period)
+
+    limit = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if limit and period and int(limit) > 0:
+        return int(limit) / int(period)
+    return None
+
+
+def _cgroup_memory() -> Optional[int]:
+    """Memory limit of the container from cgroup v2 or v1, None if unlimited"""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        limit = _read_first_line(path)
+        # cgroup v1 reports "unlimited" as a huge number rather than "max"
+        if limit and limit != "max" and int(limit) < 2**60:
+            return int(limit)
+    return None
+
+
+@lru_cache(maxsize=None)
+def container_resources() -> Resources:
+    """CPUs and memory of the container, falling back to those of the host"""
+    cpus = os.cpu_count() or 1
+    quota = _cgroup_cpus()
+    if quota:
+        cpus = min(cpus, quota)
+
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = _cgroup_memory()
+    if limit:
+        memory = min(memory, limit)
+
+    return Resources(cpus=cpus, memory_bytes=memory)
+
+
+@dataclass(frozen=True)
+class RuntimeProfile:
+    """GDAL runtime options for a class of conversion"""
+
+    name: str
+    # Fraction of the container memory for the GDAL block cache, and its cap
+    cache_fraction: float
+    cache_max_mib: int
+    # Whether to use every CPU for compression, decoding and overviews
+    threaded: bool
+    options: Dict[str, str] = field(default_factory=dict)
+
+    def threads(self, resources: Resources, outputs: int = 1) -> int:
+        """Threads for each of ``outputs`` written in parallel"""
+        if not self.threaded:
+            return 1
+        return max(1, math.floor(resources.cpus) // max(1, outputs))
+
+    def config(self, resources: Resources, outputs: int = 1) -> Dict[str, Any]:
+        """GDAL config options to pass to ``rasterio.Env``
+
+        Parameters
+        ----------
+        resources : Resources
+            CPUs and memory of the container
+        outputs : int, optional
+            Outputs written in parallel, which share the CPUs
+
+        Returns
+        -------
+        Dict[str, Any]
+            Config options
+        """
+        cache_mib = min(self.cache_max_mib, int(resources.memory_bytes * self.cache_fraction / MiB))
+        config = dict(COMMON_OPTIONS)
+        config.update(
+            {
+                "GDAL_CACHEMAX": max(cache_mib, 16),
+                "GDAL_NUM_THREADS": self.threads(resources, outputs),
+            }
+        )
+        config.update(self.options)
+        return config
+
+    def creation_options(self, resources: Resources, outputs: int = 1) -> Dict[str, Any]:
+        """Creation options to add to the COG profile, these do not change the output"""
+        return {"NUM_THREADS": self.threads(resources, outputs)}
+
+
+PROFILES = {
+    # Small inputs, a small cache and no threads
+    "serial": RuntimeProfile("serial", cache_fraction=0.1, cache_max_mib=256, threaded=False),
+    # Inputs that fit comfortably in memory, compress on every CPU
+    "parallel": RuntimeProfile("parallel", cache_fraction=0.25, cache_max_mib=2048, threaded=True),
+    # Inputs that approach the memory of the container, every CPU but a
+    # bounded cache, with large temporary files kept out of memory
+    "bounded": RuntimeProfile(
+        "bounded",
+        cache_fraction=0.1,
+        cache_max_mib=256,
+        threaded=True,
+        options={"CPL_VSIL_USE_TEMP_FILE_FOR_RANDOM_WRITE": "YES"},
+    ),
+}
+
+
+def select_profile(
+    source_bytes: int,
+    dtype: str,
+    resources: Optional[Resources] = None,
+    name: Optional[str] = None,
+) -> RuntimeProfile:
+    """Pick the runtime profile for a conversion
+
+    Parameters
+    ----------
+    source_bytes : int
+        Size of the source object
+    dtype : str
+        Data type of the source bands
+    resources : Resources, optional
+        CPUs and memory of the container, detected if not given
+    name : str, optional
+        Profile to use, or "auto" to select one (default: ``RUNTIME_PROFILE``)
+
+    Returns
+    -------
+    RuntimeProfile
+        The profile to apply
+    """
+    name = name or RUNTIME_PROFILE
+    if name != "auto":
+        if name not in PROFILES:
+            raise ValueError(f"Unknown runtime profile {name}, expected one of {list(PROFILES)} or auto")
+        return PROFILES[name]
+
+    resources = resources or container_resources()
+    # Wider samples take longer to compress, so threads pay off sooner
+    work = source_bytes * np.dtype(dtype).itemsize
+    if resources.cpus < 2 or work <= SERIAL_MAX_WORK:
+        return PROFILES["serial"]
+    if source_bytes > resources.memory_bytes * BOUNDED_MEMORY_FRACTION:
+        return PROFILES["bounded"]
+    return PROFILES["parallel"]
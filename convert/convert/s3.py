@@ -1,36 +1,196 @@
 import logging
+import os
+import threading
+from contextlib import contextmanager
 from io import BytesIO
-from uuid import uuid4
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urlparse
 
-import boto3
-from mypy_boto3_s3.client import S3Client
-from osgeo import gdal
+from botocore.exceptions import ClientError
+
+from convert.clients import get_s3_client, get_session
+from convert.transfer import (
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_PART_SIZE,
+    MIN_PART_SIZE,
+    DownloadCheckpoint,
+    MultipartWriter,
+    PartStats,
+    RangedReader,
+    download_ranges,
+)
+from convert.vsimem import VsiMemFile
+
+# Type only imports, kept off the import path of the module as the stubs and
+# GDAL bindings take a while to load and are not installed everywhere
+if TYPE_CHECKING:
+    from mypy_boto3_s3.client import S3Client
+    from osgeo import gdal
+    from rasterio.io import MemoryFile
 
 log = logging.getLogger(__name__)
 
+MiB = 1024 * 1024
+
+# GDAL config for reading sources in place through /vsis3/, see S3Helper.stream.
+# Reads ahead in large chunks, caches them per file and in total so blocks that
+# are read again (e.g. for overviews) are not fetched again, and merges
+# adjacent ranges into a single request
+STREAM_CONFIG = {
+    "CPL_VSIL_CURL_CHUNK_SIZE": int(os.environ.get("S3_STREAM_CHUNK_SIZE", 2 * MiB)),
+    "CPL_VSIL_CURL_CACHE_SIZE": int(os.environ.get("S3_STREAM_CACHE_SIZE", 256 * MiB)),
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": int(os.environ.get("S3_STREAM_BLOCK_CACHE_SIZE", 64 * MiB)),
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIRANGE": "PARALLEL",
+    "GDAL_HTTP_MAX_RETRY": 5,
+    "GDAL_HTTP_RETRY_DELAY": 1,
+    # Count the bytes fetched, see convert.metrics.network_bytes
+    "CPL_VSIL_NETWORK_STATS_ENABLED": "YES",
+}
+
+
+class ObjectInfo(NamedTuple):
+    """Attributes of an S3 object returned by a HEAD request"""
+
+    size: int
+    etag: str
+    version_id: Optional[str]
+    metadata: Dict[str, str]
+
 
 class S3Helper:
     """Helper class for reading and writing to S3 using Boto3"""
 
-    def __init__(self, bucket_name: str):
+    def __init__(
+        self,
+        bucket_name: str,
+        part_size: int = DEFAULT_PART_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        resume: bool = False,
+        region: Optional[str] = None,
+        role_arn: Optional[str] = None,
+    ):
         """Initialise an instance of an S3 Bucket
 
+        The S3 client is shared with every other helper of the same region and
+        role in the process, see ``convert.clients``, so helpers are cheap to
+        create.
+
         Parameters
         ----------
         bucket : str
             Name of S3 bucket
+        part_size : int, optional
+            Size in bytes of each ranged request used for transfers
+        max_concurrency : int, optional
+            Number of ranged requests to run in parallel
+        resume : bool, optional
+            Continue interrupted transfers rather than starting them again,
+            see ``download_file`` and ``open_writer``
+        region : str, optional
+            Region of the client, defaults to that of the environment
+        role_arn : str, optional
+            Role to assume to access the bucket, defaults to the credentials
+            of the environment
         """
         self.bucket_name = bucket_name
-        self.bucket = self._init_bucket()
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.resume = resume
+        self.region = region
+        self.role_arn = role_arn
+        self.client: "S3Client" = get_s3_client(region, role_arn)
+
+        # Per part timings of the most recent transfer, useful for tuning the
+        # part size and concurrency
+        self.part_stats: List[PartStats] = []
 
-    def _init_bucket(self) -> S3Client:
-        """Initialise the Boto3 S3 client"""
-        log.info(f"Initialising S3 bucket with boto3 : {self.bucket_name}")
-        return boto3.Session().resource("s3").Bucket(self.bucket_name)
+        # Total bytes downloaded and uploaded by this helper, and the bytes
+        # that were not transferred because an earlier attempt already had
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bytes_resumed = 0
+        # Bytes fetched by GDAL when reading in place, see ``stream``
+        self.bytes_streamed = 0
+        self._lock = threading.Lock()
+
+    def head(self, key: str) -> ObjectInfo:
+        """Get the size, ETag, version and user metadata of the given key
+
+        Parameters
+        ----------
+        key : str
+            Key to inspect
+
+        Returns
+        -------
+        ObjectInfo
+            Attributes of ``key``
+        """
+        response = self.client.head_object(Bucket=self.bucket_name, Key=key.lstrip("/"))
+        return ObjectInfo(
+            size=response["ContentLength"],
+            etag=response["ETag"],
+            version_id=response.get("VersionId"),
+            metadata=response.get("Metadata", {}),
+        )
+
+    def get_size(self, key: str) -> int:
+        """Get the size of the given key in bytes"""
+        return self.head(key).size
+
+    def get_metadata(self, key: str) -> Optional[Dict[str, str]]:
+        """Get the user metadata of the given key, or None if it does not exist"""
+        try:
+            return self.head(key).metadata
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def list_keys(self, prefix: str = "") -> Iterator[str]:
+        """List the keys in the bucket under the given prefix
+
+        Parameters
+        ----------
+        prefix : str, optional
+            Only list keys that start with this prefix
+
+        Returns
+        -------
+        Iterator[str]
+            Keys in the bucket
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix.lstrip("/")):
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
+
+    def delete_keys(self, keys: List[str]) -> None:
+        """Delete the given keys, a thousand per request, ignoring any that do not exist
+
+        Parameters
+        ----------
+        keys : List[str]
+            Keys to delete
+        """
+        for start in range(0, len(keys), 1000):
+            batch = keys[start : start + 1000]
+            log.info(f"Deleting {len(batch)} keys from {self.bucket_name}")
+            response = self.client.delete_objects(
+                Bucket=self.bucket_name, Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+            for error in response.get("Errors", []):
+                log.warning(f"Failed to delete {error['Key']} : {error['Message']}")
 
     def get_bytes(self, key: str) -> BytesIO:
         """Get a file from S3 using Boto3 returning the binary data
 
+        The object is fetched with concurrent ranged requests that are written
+        directly into a buffer preallocated to the size of the object.
+
         Parameters
         ----------
         key : str
@@ -41,43 +201,336 @@ class S3Helper:
         BytesIO
             Bytes of ``key``
         """
-        # Download the bytes for the given key to a BytesIO object
         log.info(f"Reading bytes from key : {key}")
+        size, etag, _, _ = self.head(key)
+
+        # An empty object is not downloaded, so it has no parts of its own
+        self.part_stats = []
+
+        # Preallocate the buffer and write each part into it at its offset
         buf = BytesIO()
-        self.bucket.download_fileobj(Key=key.lstrip("/"), Fileobj=buf)
+        if size:
+            buf.seek(size - 1)
+            buf.write(b"\0")
+            view = buf.getbuffer()
+
+            def write_at(offset: int, data: bytes) -> None:
+                view[offset : offset + len(data)] = data
+
+            try:
+                self._download(key, size, etag, write_at)
+            finally:
+                view.release()
+
         buf.seek(0)
         return buf
 
-    def write_bytes(self, content: BytesIO, key: str) -> None:
-        """Write a BytesIO object to the given key
+    def download_file(self, key: str, path: str) -> None:
+        """Download the given key to a local file
+
+        Like ``get_bytes`` the object is fetched in concurrent ranges, each
+        written to its offset in a file that is preallocated to the object size.
+
+        When resuming, the parts written to ``path`` are recorded in a
+        checkpoint file alongside it. If the download is interrupted, the next
+        download of the same object version to the same path only fetches the
+        parts that are missing.
+
+        Parameters
+        ----------
+        key : str
+            Key to download
+        path : str
+            Local path to write to, any existing file is overwritten
+        """
+        log.info(f"Downloading key : {key} to {path}")
+        size, etag, _, _ = self.head(key)
+
+        checkpoint = None
+        if self.resume:
+            checkpoint = DownloadCheckpoint(f"{path}.checkpoint", etag, size, self.part_size)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                checkpoint.parts.clear()
+
+        with open(path, "r+b" if checkpoint is not None and checkpoint.parts else "wb") as fh:
+            fh.truncate(size)
+            fd = fh.fileno()
+
+            def write_at(offset: int, data: bytes) -> None:
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+
+            self._download(key, size, etag, write_at, checkpoint)
+
+    def _download(
+        self,
+        key: str,
+        size: int,
+        etag: str,
+        write_at: Callable[[int, bytes], None],
+        checkpoint: Optional[DownloadCheckpoint] = None,
+    ) -> None:
+        """Run a ranged download of ``key`` recording the per part timings"""
+        self.part_stats = download_ranges(
+            self.client,
+            self.bucket_name,
+            key.lstrip("/"),
+            size,
+            write_at,
+            part_size=self.part_size,
+            max_concurrency=self.max_concurrency,
+            etag=etag,
+            checkpoint=checkpoint,
+        )
+        fetched = sum(part.size for part in self.part_stats)
+        with self._lock:
+            self.bytes_in += fetched
+            self.bytes_resumed += size - fetched
+
+    def open_writer(self, key: str, metadata: Optional[Dict[str, str]] = None) -> MultipartWriter:
+        """Open a streaming multipart writer for the given key
+
+        Parts are uploaded concurrently as they are written, see
+        ``MultipartWriter``. Use as a context manager so the upload is
+        completed, or aborted if an exception is raised. When resuming, an
+        unfinished upload of ``key`` is continued and is left for a retry
+        rather than aborted.
 
         Parameters
         ----------
-        content : BytesIO
-            Bytes to write
         key : str
             Output key (filename)
+        metadata : Dict[str, str], optional
+            User metadata to store on the object
+
+        Returns
+        -------
+        MultipartWriter
+            Write-only file-like object
         """
-        log.info(f"Writing data to S3 : {key}")
-        content.seek(0)
-        self.bucket.upload_fileobj(
-            Key=key.lstrip("/"),
-            Fileobj=content,
-            ExtraArgs={"ACL": "bucket-owner-full-control"},
+        return MultipartWriter(
+            self.client,
+            self.bucket_name,
+            key.lstrip("/"),
+            part_size=max(self.part_size, MIN_PART_SIZE),
+            max_concurrency=self.max_concurrency,
+            extra_args={"ACL": "bucket-owner-full-control", "Metadata": metadata or {}},
+            resume=self.resume,
         )
 
-    def get_gdal_dataset(self, key: str) -> gdal.Dataset:
+    def open_reader(self, key: str) -> RangedReader:
+        """Open a seekable reader of the given key that fetches ranges as they are read
+
+        Suits reading scattered parts of a large object, such as the tiles of
+        a COG. The reader is pinned to the current version of the object, so
+        reads fail rather than mix versions if it is replaced. The bytes
+        fetched are added to ``bytes_in``.
+
+        Parameters
+        ----------
+        key : str
+            Key to read
+
+        Returns
+        -------
+        RangedReader
+            Read-only file-like object
+        """
+        size, etag, _, _ = self.head(key)
+
+        def fetched(size: int) -> None:
+            with self._lock:
+                self.bytes_in += size
+
+        return RangedReader(self.client, self.bucket_name, key.lstrip("/"), size, etag, on_fetch=fetched)
+
+    def write_bytes(
+        self,
+        content: Union[BytesIO, "MemoryFile", memoryview, bytes, str],
+        key: str,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Write data to the given key with a concurrent multipart upload
+
+        In-memory content is uploaded directly from its buffer without being
+        copied, and paths are streamed from disk one part at a time.
+
+        Parameters
+        ----------
+        content : Union[BytesIO, MemoryFile, memoryview, bytes, str]
+            Bytes to write, any object with a ``getbuffer()`` method (such as a
+            BytesIO or rasterio MemoryFile), a bytes-like object, or the path
+            of a local file
+        key : str
+            Output key (filename)
+        metadata : Dict[str, str], optional
+            User metadata to store on the object
+        """
+        log.info(f"Writing data to S3 : {key}")
+        if isinstance(content, (str, os.PathLike)):
+            with self.open_writer(key, metadata) as writer:
+                writer.write_file(content)
+        else:
+            buffer = content.getbuffer() if hasattr(content, "getbuffer") else content
+            try:
+                with memoryview(buffer) as view, self.open_writer(key, metadata) as writer:
+                    writer.write_view(view)
+            finally:
+                # Release the export so a BytesIO can be resized again
+                if isinstance(buffer, memoryview) and buffer is not content:
+                    buffer.release()
+
+        self._record_upload(writer)
+
+    def _record_upload(self, writer: MultipartWriter) -> None:
+        self.part_stats = writer.part_stats
+        with self._lock:
+            self.bytes_out += writer.bytes_written - writer.bytes_reused
+            self.bytes_resumed += writer.bytes_reused
+
+    def write_stream(
+        self,
+        produce: Callable[[BinaryIO], Any],
+        key: str,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        """Write data to the given key as it is produced, without a local copy
+
+        Parameters
+        ----------
+        produce : Callable[[BinaryIO], Any]
+            Called with a writable file object, everything written to it is
+            uploaded in parts as it arrives
+        key : str
+            Output key (filename)
+        metadata : Dict[str, str], optional
+            User metadata to store on the object
+
+        Returns
+        -------
+        Any
+            Return value of ``produce``
+        """
+        log.info(f"Streaming data to S3 : {key}")
+        with self.open_writer(key, metadata) as writer:
+            result = produce(writer)
+
+        self._record_upload(writer)
+        return result
+
+    def upload_file(self, path: str, key: str, metadata: Optional[Dict[str, str]] = None) -> None:
+        """Upload a local file to the given key, streaming it from disk
+
+        Parameters
+        ----------
+        path : str
+            Local path of the file to upload
+        key : str
+            Output key (filename)
+        metadata : Dict[str, str], optional
+            User metadata to store on the object
+        """
+        log.info(f"Uploading {path} to S3 : {key}")
+        self.write_bytes(path, key, metadata)
+
+    def gdal_env(self) -> Dict[str, Any]:
+        """Options for ``rasterio.Env`` to read this bucket through GDAL's /vsis3/
+
+        GDAL does not follow the whole AWS provider chain (it cannot use the
+        credentials of an ECS or EKS task, see
+        https://github.com/OSGeo/gdal/issues/4058), so credentials are resolved
+        by boto3 and passed to GDAL through a rasterio ``AWSSession``. A custom
+        endpoint of the client, such as a local S3 compatible server, is passed
+        on too. Temporary credentials are not refreshed, so get new options for
+        each conversion rather than holding on to them.
+
+        Returns
+        -------
+        Dict[str, Any]
+            ``STREAM_CONFIG`` with the ``session`` to pass to ``rasterio.Env``
+        """
+        from rasterio.session import AWSSession
+
+        session = get_session(self.region, self.role_arn)
+        env: Dict[str, Any] = dict(STREAM_CONFIG)
+
+        endpoint_url = None
+        endpoint = urlparse(self.client.meta.endpoint_url)
+        if not endpoint.netloc.endswith("amazonaws.com"):
+            endpoint_url = endpoint.netloc
+            env["AWS_HTTPS"] = "YES" if endpoint.scheme == "https" else "NO"
+            env["AWS_VIRTUAL_HOSTING"] = "FALSE"
+        if not session.region_name:
+            env["AWS_REGION"] = self.client.meta.region_name
+
+        env["session"] = AWSSession(session, endpoint_url=endpoint_url)
+        return env
+
+    def vsis3_path(self, key: str) -> str:
+        """GDAL path of the given key in this bucket"""
+        return f"/vsis3/{self.bucket_name}/{key.lstrip('/')}"
+
+    @contextmanager
+    def stream(self, key: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Read the given key in place with GDAL rather than downloading it
+
+        Only the ranges of the object that GDAL reads are fetched, read ahead
+        and cached as configured by ``STREAM_CONFIG``. Open the path inside a
+        ``rasterio.Env`` with the options, in every thread that reads it as
+        GDAL config is thread local::
+
+            with s3.stream(key) as (path, env):
+                with rasterio.Env(**env), rasterio.open(path) as src:
+                    data = src.read(1, window=window)
+
+        The bytes fetched are added to ``bytes_in`` and ``bytes_streamed``
+        when the block exits. GDAL counts them for the whole process, so the
+        count includes any other /vsis3/ reads running at the same time.
+
+        Parameters
+        ----------
+        key : str
+            Key of a GDAL readable dataset
+
+        Returns
+        -------
+        Iterator[Tuple[str, Dict[str, Any]]]
+            The /vsis3/ path of ``key`` and the options for ``rasterio.Env``
+        """
+        from convert.metrics import network_bytes, reset_network_stats
+
+        path = self.vsis3_path(key)
+        log.info(f"Streaming {path} through GDAL")
+        env = self.gdal_env()
+        reset_network_stats()
+        try:
+            yield path, env
+        finally:
+            fetched = network_bytes()
+            if fetched is not None:
+                with self._lock:
+                    self.bytes_in += fetched
+                    self.bytes_streamed += fetched
+
+    def get_gdal_dataset(self, key: str) -> VsiMemFile:
         """Read a GDAL Dataset directly from S3
 
         This function helps read a GDAL Dataset directly from S3 by using
-        boto3 directly. This has the downside that we cannot intelligently
-        stream the data and the entire dataset will be read into memory upfront
-        however it does correctly use the S3 provider chain (meaning it can run
-        in non-EC2 environments such as EKS or ECS).
+        boto3 directly. The entire dataset is read into memory upfront, using
+        the S3 provider chain (meaning it can run in non-EC2 environments such
+        as EKS or ECS). To read only the parts of a dataset that are needed,
+        use ``stream`` which passes the boto3 credentials to GDAL's /vsis3/.
+
+        The object is downloaded straight into a buffer that GDAL reads in
+        place as a /vsimem file, so it is held in memory only once. The file is
+        unlinked and the buffer freed when the handle is closed, use it as a
+        context manager::
 
-        GDALs virtual file system for S3 does not inherit the provider chain
-        correctly so we cannot use /vsis3/bucket/key outside of EC2
-        See https://github.com/OSGeo/gdal/issues/4058.
+            with s3.get_gdal_dataset(key) as mem:
+                band = mem.dataset.GetRasterBand(1)
 
         Parameters
         ----------
@@ -86,44 +539,74 @@ class S3Helper:
 
         Returns
         -------
-        gdal.Dataset
-            GDAL Dataset in memory
+        VsiMemFile
+            Handle on the in memory file, with the GDAL Dataset as ``dataset``
         """
-        # This is a bit of a messy workaround as GDALs python bindings do not
-        # open a File/Path like object. Rasterio for example can write directly
-        # from ``self.get_bytes()``, so that is probably preferred.
         log.info(f"Loading GDAL Dataset from : {key}")
+        size, etag, _, _ = self.head(key)
 
-        # Write bytes to temporary memory file buffer and open that with GDAL
-        tmp_fname = f"/vsimem/{uuid4()}"
-        gdal.FileFromMemBuffer(tmp_fname, self.get_bytes(key).getvalue())
+        mem = VsiMemFile.allocate(size)
+        try:
+            with memoryview(mem.buffer) as view:
 
-        log.info(f"Opening GDAL file from memory buffer ({tmp_fname})")
-        return gdal.Open(tmp_fname)
+                def write_at(offset: int, data: bytes) -> None:
+                    view[offset : offset + len(data)] = data
 
-    def write_gdal_dataset(self, ds: gdal.Dataset, key: str) -> None:
+                self._download(key, size, etag, write_at)
+
+            mem.register()
+            # Open the dataset now so that unreadable objects fail here
+            log.info(f"Opening {mem.path} holding {mem.nbytes} bytes")
+            mem.dataset
+        except BaseException:
+            mem.close()
+            raise
+        return mem
+
+    def write_gdal_dataset(
+        self,
+        ds: "gdal.Dataset",
+        key: str,
+        driver: str = "GTiff",
+        options: Optional[List[str]] = None,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> int:
         """Write a GDAL dataset to S3
 
+        The dataset is written with ``driver`` to a /vsimem file, which is
+        uploaded from GDAL's buffer without being copied and then unlinked.
+
         Parameters
         ----------
         ds : gdal.Dataset
             GDAL dataset to write
         key : str
             Output key (filename)
+        driver : str, optional
+            GDAL driver to write with, e.g. GTiff or COG
+        options : List[str], optional
+            Creation options of the driver, e.g. ``["COMPRESS=DEFLATE"]``
+        metadata : Dict[str, str], optional
+            User metadata to store on the object
+
+        Returns
+        -------
+        int
+            Size of the written object in bytes
         """
-        # Not implementing this for now, but this is an option for how to write
-        # a GDAL dataset from memory to a Bytes object
-        # Taken from the OSGeo mailing list
-        # gdal.GetDriverByName('PNG').CreateCopy('/vsimem/output.png', mem)
-
-        # # Read /vsimem/output.png
-        # f = gdal.VSIFOpenL('/vsimem/output.png', 'rb')
-        # gdal.VSIFSeekL(f, 0, 2) # seek to end
-        # size = gdal.VSIFTellL(f)
-        # gdal.VSIFSeekL(f, 0, 0) # seek to beginning
-        # data = gdal.VSIFReadL(1, size, f)
-        # gdal.VSIFCloseL(f)
-
-        # # Cleanup
-        # gdal.Unlink('/vsimem/output.png')
-        raise NotImplementedError
+        # The GDAL bindings are only needed here, images without them (e.g.
+        # the Lambda image) use the GDAL bundled with rasterio
+        from osgeo import gdal
+
+        with VsiMemFile() as mem:
+            out = gdal.GetDriverByName(driver).CreateCopy(mem.path, ds, options=options or [])
+            if out is None:
+                raise OSError(f"GDAL could not write {key} with the {driver} driver")
+            # Dereferencing the dataset flushes and closes it
+            out = None
+
+            size = mem.nbytes
+            log.info(f"Written {size} bytes with {driver} to {mem.path}")
+            with mem.view() as view:
+                self.write_bytes(view, key, metadata)
+        return size
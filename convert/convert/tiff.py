@@ -0,0 +1,276 @@
+"""Minimal reading and writing of TIFF/BigTIFF structure
+
+Only the file structure (header, IFDs and tags) is handled here, image data
+is read and written by the callers. This lets the conversion engine lay out
+a Cloud Optimised GeoTiff itself, with every IFD before the tile data.
+"""
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+# Tags
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+SAMPLES_PER_PIXEL = 277
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+COLORMAP = 320
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+EXTRA_SAMPLES = 338
+SAMPLE_FORMAT = 339
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+MODEL_TRANSFORMATION = 34264
+GEO_KEY_DIRECTORY = 34735
+GEO_DOUBLE_PARAMS = 34736
+GEO_ASCII_PARAMS = 34737
+GDAL_METADATA = 42112
+GDAL_NODATA = 42113
+
+# Tags describing the georeferencing and metadata of an image rather than its
+# layout, which GDAL writes and the engine copies from a template
+DESCRIPTIVE_TAGS = (
+    PHOTOMETRIC,
+    COLORMAP,
+    EXTRA_SAMPLES,
+    MODEL_PIXEL_SCALE,
+    MODEL_TIEPOINT,
+    MODEL_TRANSFORMATION,
+    GEO_KEY_DIRECTORY,
+    GEO_DOUBLE_PARAMS,
+    GEO_ASCII_PARAMS,
+    GDAL_METADATA,
+    GDAL_NODATA,
+)
+
+# Values of the compression tag
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = 8
+
+# NewSubfileType flag of reduced resolution (overview) images
+REDUCED_RESOLUTION = 1
+
+# Field types
+BYTE = 1
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+UNDEFINED = 7
+DOUBLE = 12
+LONG8 = 16
+
+# Struct format of each field type, a rational is a pair of longs
+TYPE_FORMATS = {1: "B", 2: "B", 3: "H", 4: "I", 5: "I", 6: "b", 7: "B", 8: "h", 9: "i", 10: "i", 11: "f", 12: "d"}
+TYPE_FORMATS.update({16: "Q", 17: "q", 18: "Q"})
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+
+# Field types whose values are kept as raw bytes
+BYTES_TYPES = (BYTE, ASCII, UNDEFINED)
+
+# Each tile is preceded by its size and followed by a copy of its last 4 bytes,
+# which lets readers check a tile is intact and fetch the next one blindly
+BLOCK_LEADER_SIZE = 4
+BLOCK_TRAILER_SIZE = 4
+
+GHOST_HEADER = (
+    "LAYOUT=IFDS_BEFORE_DATA\n"
+    "BLOCK_ORDER=ROW_MAJOR\n"
+    "BLOCK_LEADER=SIZE_AS_UINT4\n"
+    "BLOCK_TRAILER=LAST_4_BYTES_REPEATED\n"
+    "KNOWN_INCOMPATIBLE_EDITION=NO\n"
+    " "  # as GDAL pads it
+)
+
+
+class TiffFormatError(ValueError):
+    """Raised when data is not a readable TIFF"""
+
+
+@dataclass
+class Tag:
+    """A TIFF field, values are bytes for byte/ascii/undefined types"""
+
+    type: int
+    values: Union[bytes, Tuple]
+
+    @property
+    def count(self) -> int:
+        if self.type == RATIONAL:
+            return len(self.values) // 2
+        return len(self.values)
+
+    def encode(self, endian: str = "<") -> bytes:
+        if self.type in BYTES_TYPES:
+            return bytes(self.values)
+        return struct.pack(f"{endian}{len(self.values)}{TYPE_FORMATS[self.type]}", *self.values)
+
+
+@dataclass
+class Ifd:
+    """An Image File Directory read from a file"""
+
+    offset: int
+    tags: Dict[int, Tag]
+
+    def get(self, code: int, default: Optional[int] = None) -> Optional[int]:
+        """First value of the tag ``code``"""
+        tag = self.tags.get(code)
+        return tag.values[0] if tag is not None and tag.values else default
+
+    def values(self, code: int) -> Tuple:
+        """All values of the tag ``code``, empty if it is missing"""
+        tag = self.tags.get(code)
+        return tuple(tag.values) if tag is not None else ()
+
+
+def read_ifds(fh: BinaryIO) -> Tuple[bool, List[Ifd]]:
+    """Read every IFD of a little or big endian TIFF/BigTIFF
+
+    Parameters
+    ----------
+    fh : BinaryIO
+        Seekable file object of the TIFF
+
+    Returns
+    -------
+    Tuple[bool, List[Ifd]]
+        Whether the file is a BigTIFF, and its IFDs in file order
+    """
+
+    def read(offset: int, size: int) -> bytes:
+        fh.seek(offset)
+        data = fh.read(size)
+        if len(data) < size:
+            raise TiffFormatError(f"Truncated TIFF, wanted {size} bytes at {offset}")
+        return data
+
+    header = read(0, 8)
+    if header[:2] not in (b"II", b"MM"):
+        raise TiffFormatError("Not a TIFF (bad byte order mark)")
+    endian = "<" if header[:2] == b"II" else ">"
+
+    (magic,) = struct.unpack(endian + "H", header[2:4])
+    if magic == 42:
+        bigtiff = False
+        (offset,) = struct.unpack(endian + "I", header[4:8])
+    elif magic == 43:
+        bigtiff = True
+        (offset,) = struct.unpack(endian + "Q", read(8, 8))
+    else:
+        raise TiffFormatError(f"Not a TIFF (magic number {magic})")
+
+    count_fmt, entry_size, value_fmt = ("Q", 20, "Q") if bigtiff else ("H", 12, "I")
+    value_size = struct.calcsize(value_fmt)
+    count_size = struct.calcsize(count_fmt)
+
+    ifds: List[Ifd] = []
+    seen = set()
+    while offset:
+        if offset in seen:
+            raise TiffFormatError("IFD chain contains a loop")
+        seen.add(offset)
+
+        (count,) = struct.unpack(endian + count_fmt, read(offset, count_size))
+        entries = read(offset + count_size, count * entry_size + value_size)
+
+        tags = {}
+        for ix in range(count):
+            entry = entries[ix * entry_size : (ix + 1) * entry_size]
+            code, dtype = struct.unpack(endian + "HH", entry[:4])
+            (num,) = struct.unpack(endian + value_fmt, entry[4 : 4 + value_size])
+            if dtype not in TYPE_SIZES:
+                continue
+
+            size = num * TYPE_SIZES[dtype]
+            raw = entry[4 + value_size : 4 + value_size + size]
+            if size > value_size:
+                (pointer,) = struct.unpack(endian + value_fmt, entry[4 + value_size :])
+                raw = read(pointer, size)
+
+            if dtype in BYTES_TYPES:
+                tags[code] = Tag(dtype, raw)
+            else:
+                fmt = TYPE_FORMATS[dtype]
+                tags[code] = Tag(dtype, struct.unpack(f"{endian}{size // struct.calcsize(fmt)}{fmt}", raw))
+
+        ifds.append(Ifd(offset, tags))
+        (offset,) = struct.unpack(endian + value_fmt, entries[count * entry_size :])
+
+    return bigtiff, ifds
+
+
+def header(bigtiff: bool, first_ifd: int) -> bytes:
+    """Little endian TIFF or BigTIFF header pointing at the first IFD"""
+    if bigtiff:
+        return struct.pack("<2sHHHQ", b"II", 43, 8, 0, first_ifd)
+    return struct.pack("<2sHI", b"II", 42, first_ifd)
+
+
+def ghost_header() -> bytes:
+    """GDAL's structural metadata block, placed straight after the header"""
+    return f"GDAL_STRUCTURAL_METADATA_SIZE={len(GHOST_HEADER):06d} bytes\n{GHOST_HEADER}".encode("ascii")
+
+
+def ifd_size(tags: Dict[int, Tag], bigtiff: bool) -> int:
+    """Size in bytes of an IFD including the values that do not fit inline"""
+    count_size, entry_size, value_size = (8, 20, 8) if bigtiff else (2, 12, 4)
+    size = count_size + len(tags) * entry_size + value_size
+    for tag in tags.values():
+        data = TYPE_SIZES[tag.type] * tag.count
+        if data > value_size:
+            size += data + data % 2
+    return size
+
+
+def encode_ifds(ifds: List[Dict[int, Tag]], start: int, bigtiff: bool) -> bytes:
+    """Encode IFDs back to back, each followed by its out of line values
+
+    Parameters
+    ----------
+    ifds : List[Dict[int, Tag]]
+        Tags of each IFD, chained in this order
+    start : int
+        Offset in the file at which the first IFD will be written
+    bigtiff : bool
+        Encode BigTIFF rather than classic TIFF IFDs
+
+    Returns
+    -------
+    bytes
+        Encoded IFDs, ``sum(ifd_size(...))`` bytes long
+    """
+    count_fmt, entry_size, value_fmt = ("<Q", 20, "<Q") if bigtiff else ("<H", 12, "<I")
+    value_size = struct.calcsize(value_fmt)
+
+    out = bytearray()
+    offset = start
+    for ix, tags in enumerate(ifds):
+        size = ifd_size(tags, bigtiff)
+        next_offset = offset + size if ix + 1 < len(ifds) else 0
+
+        entries = bytearray(struct.pack(count_fmt, len(tags)))
+        values = bytearray()
+        values_offset = offset + struct.calcsize(count_fmt) + len(tags) * entry_size + value_size
+        for code in sorted(tags):
+            tag = tags[code]
+            data = tag.encode()
+            entries += struct.pack("<HH", code, tag.type) + struct.pack(value_fmt, tag.count)
+            if len(data) <= value_size:
+                entries += data.ljust(value_size, b"\0")
+            else:
+                entries += struct.pack(value_fmt, values_offset + len(values))
+                values += data + b"\0" * (len(data) % 2)
+
+        entries += struct.pack(value_fmt, next_offset)
+        out += entries + values
+        offset += size
+
+    return bytes(out)
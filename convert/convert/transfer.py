@@ -0,0 +1,623 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from statistics import median
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+# Defaults for ranged transfers, these can be overridden per S3Helper or for a
+# whole job through the environment
+DEFAULT_PART_SIZE = int(os.environ.get("S3_PART_SIZE", 16 * MiB))
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("S3_MAX_CONCURRENCY", 8))
+
+# Size of the reads from each response body, bounds memory held per part
+READ_CHUNK_SIZE = 1 * MiB
+
+# S3 requires every part of a multipart upload except the last to be >= 5 MiB
+MIN_PART_SIZE = 5 * MiB
+
+# Seconds an unfinished upload must have been idle, since it was started or its
+# last part was uploaded, before it is resumed. A more recent upload may belong
+# to another conversion of the same key that is still running, e.g. from a
+# duplicate S3 notification, and is left alone
+RESUME_IDLE_SECONDS = int(os.environ.get("COG_RESUME_IDLE_SECONDS", 300))
+
+
+@dataclass
+class PartStats:
+    """Timing information for a single ranged transfer"""
+
+    part_number: int
+    offset: int
+    size: int
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Throughput of the part in MiB/s"""
+        return self.size / MiB / self.seconds if self.seconds > 0 else float("inf")
+
+
+def byte_ranges(size: int, part_size: int) -> List[Tuple[int, int]]:
+    """Split ``size`` bytes into ``(offset, length)`` ranges
+
+    Parameters
+    ----------
+    size : int
+        Total number of bytes
+    part_size : int
+        Maximum length of each range
+
+    Returns
+    -------
+    List[Tuple[int, int]]
+        Offset and length of each range, in order
+    """
+    if part_size <= 0:
+        raise ValueError(f"Part size must be positive, got {part_size}")
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def download_ranges(
+    client: Any,
+    bucket: str,
+    key: str,
+    size: int,
+    write_at: Callable[[int, bytes], None],
+    part_size: int = DEFAULT_PART_SIZE,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    etag: Optional[str] = None,
+    checkpoint: Optional["DownloadCheckpoint"] = None,
+) -> List[PartStats]:
+    """Download an S3 object in byte ranges on a thread pool
+
+    Each range is fetched with its own ranged GET and written to its final
+    position with ``write_at(offset, data)``, so the destination must be
+    preallocated (e.g. a sized buffer or a truncated file). ``write_at`` is
+    called concurrently for non-overlapping regions.
+
+    Parameters
+    ----------
+    client : S3Client
+        Boto3 S3 client
+    bucket : str
+        Name of the S3 bucket
+    key : str
+        Key to download
+    size : int
+        Size of the object in bytes
+    write_at : Callable[[int, bytes], None]
+        Function that writes ``data`` at ``offset`` in the destination
+    part_size : int, optional
+        Size of each ranged GET in bytes
+    max_concurrency : int, optional
+        Number of ranges to fetch in parallel
+    etag : str, optional
+        If given, each range is requested with ``IfMatch`` so a change to the
+        object part way through the download is an error rather than a
+        corrupt result
+    checkpoint : DownloadCheckpoint, optional
+        Parts it records as complete are skipped, and each part is recorded
+        once written so an interrupted download can be resumed
+
+    Returns
+    -------
+    List[PartStats]
+        Timing for each part fetched, in order of offset
+    """
+    extra_args = {"IfMatch": etag} if etag else {}
+
+    def fetch(part_number: int, offset: int, length: int) -> PartStats:
+        start = time.perf_counter()
+        response = client.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range=f"bytes={offset}-{offset + length - 1}",
+            **extra_args,
+        )
+
+        position = offset
+        body = response["Body"]
+        for chunk in iter(lambda: body.read(READ_CHUNK_SIZE), b""):
+            write_at(position, chunk)
+            position += len(chunk)
+
+        if position - offset != length:
+            raise IOError(f"Part {part_number} of {key} returned {position - offset} bytes, expected {length}")
+
+        stats = PartStats(part_number, offset, length, time.perf_counter() - start)
+        log.debug(
+            f"Part {part_number} of {key} : {length} bytes in {stats.seconds:.3f}s ({stats.throughput:.1f} MiB/s)"
+        )
+        if checkpoint is not None:
+            checkpoint.record(part_number)
+        return stats
+
+    ranges = [(ix + 1, offset, length) for ix, (offset, length) in enumerate(byte_ranges(size, part_size))]
+    if checkpoint is not None and checkpoint.parts:
+        ranges = [(number, offset, length) for number, offset, length in ranges if number not in checkpoint.parts]
+        log.info(f"Resuming download of {key} : {len(checkpoint.parts)} parts already complete, {len(ranges)} to fetch")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(ranges)))) as pool:
+        futures = [pool.submit(fetch, number, offset, length) for number, offset, length in ranges]
+        try:
+            parts = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    log_transfer_summary(f"Downloaded {key}", parts, time.perf_counter() - start)
+    return parts
+
+
+class DownloadCheckpoint:
+    """Parts of a ranged download that have been written to a local file
+
+    The completed part numbers are saved in a JSON file next to the download
+    along with the object's ETag, size and the part size. A later download of
+    the same object version with the same part size only fetches the
+    remaining parts, any other download starts again from scratch.
+    """
+
+    def __init__(self, path: str, etag: str, size: int, part_size: int):
+        """Load the checkpoint at ``path``, ignoring it if it is for another download
+
+        Parameters
+        ----------
+        path : str
+            Path of the checkpoint file
+        etag : str
+            ETag of the object being downloaded
+        size : int
+            Size of the object in bytes
+        part_size : int
+            Size of each ranged GET in bytes
+        """
+        self.path = path
+        self._header = {"etag": etag, "size": size, "part_size": part_size}
+        self.parts: Set[int] = set()
+        self._lock = threading.Lock()
+
+        try:
+            with open(path) as fh:
+                saved = json.load(fh)
+        except (OSError, ValueError):
+            return
+        if all(saved.get(name) == value for name, value in self._header.items()):
+            self.parts = set(saved.get("parts", []))
+
+    def record(self, part_number: int) -> None:
+        """Mark a part as written, replacing the file so it is never left half written"""
+        with self._lock:
+            self.parts.add(part_number)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump(dict(self._header, parts=sorted(self.parts)), fh)
+            os.replace(tmp_path, self.path)
+
+
+def log_transfer_summary(prefix: str, parts: List[PartStats], seconds: float) -> None:
+    """Log the aggregate and per-part throughput of a transfer"""
+    total = sum(part.size for part in parts)
+    if not parts:
+        log.info(f"{prefix} : 0 bytes")
+        return
+
+    rates = [part.throughput for part in parts]
+    log.info(
+        f"{prefix} : {total} bytes in {len(parts)} parts, {seconds:.3f}s "
+        f"({total / MiB / seconds if seconds > 0 else 0:.1f} MiB/s overall, "
+        f"per part min/median/max {min(rates):.1f}/{median(rates):.1f}/{max(rates):.1f} MiB/s)"
+    )
+
+
+class _ViewReader(io.RawIOBase):
+    """Seekable read-only file object over a memoryview, used as a request body
+
+    Boto3 does not accept a memoryview as a body, wrapping it like this lets
+    parts be uploaded directly from the caller's buffer without copying it.
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self._view) - self._position)
+        buffer[:size] = self._view[self._position : self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class RangedReader(io.RawIOBase):
+    """Seekable read-only file object over an S3 object, fetched in ranges as it is read
+
+    Reads are served from chunks of ``chunk_size`` bytes, each fetched with a
+    single ranged GET. The most recently used ``cache_chunks`` chunks are kept,
+    so reads that move between a few regions of the object do not fetch the
+    same chunk again. Every request is made with ``IfMatch`` when an ETag is
+    given, so the object cannot change part way through.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        bucket: str,
+        key: str,
+        size: int,
+        etag: Optional[str] = None,
+        chunk_size: int = 4 * MiB,
+        cache_chunks: int = 16,
+        on_fetch: Optional[Callable[[int], None]] = None,
+    ):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.chunk_size = chunk_size
+        self.cache_chunks = cache_chunks
+        # Bytes fetched from S3, also passed to ``on_fetch`` after each request
+        self.bytes_fetched = 0
+        self.on_fetch = on_fetch
+        self._chunks: "OrderedDict[int, bytes]" = OrderedDict()
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def _chunk(self, index: int) -> bytes:
+        if index in self._chunks:
+            self._chunks.move_to_end(index)
+            return self._chunks[index]
+
+        offset = index * self.chunk_size
+        end = min(offset + self.chunk_size, self.size) - 1
+        extra_args = {"IfMatch": self.etag} if self.etag else {}
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={offset}-{end}", **extra_args)
+        data = response["Body"].read()
+        if len(data) != end - offset + 1:
+            raise IOError(f"Range {offset}-{end} of {self.key} returned {len(data)} bytes")
+        self.bytes_fetched += len(data)
+        if self.on_fetch is not None:
+            self.on_fetch(len(data))
+
+        self._chunks[index] = data
+        while len(self._chunks) > self.cache_chunks:
+            self._chunks.popitem(last=False)
+        return data
+
+    def readinto(self, buffer) -> int:
+        # Fill the whole buffer (up to the end of the object) so callers
+        # never see a short read
+        with memoryview(buffer) as view:
+            filled = 0
+            while filled < len(view) and self._position < self.size:
+                index, start = divmod(self._position, self.chunk_size)
+                data = self._chunk(index)
+                size = min(len(view) - filled, len(data) - start)
+                view[filled : filled + size] = data[start : start + size]
+                filled += size
+                self._position += size
+        return filled
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class MultipartWriter:
+    """Write-only file-like object that streams to S3 as a multipart upload
+
+    Written data is split into parts of ``part_size`` bytes, and each part is
+    uploaded on a thread pool as soon as it is complete while writing
+    continues. At most ``max_pending`` parts are held in memory, further
+    writes block until an upload has finished.
+
+    ``close()`` completes the upload and ``abort()`` cancels it, the context
+    manager calls one or the other depending on whether an exception was
+    raised. Objects smaller than a single part are sent with one PutObject.
+
+    With ``resume`` an unfinished upload of the same key is continued rather
+    than starting a new one, and it is left in place rather than aborted on
+    error so that a retry can continue it in turn. Parts that were already
+    uploaded with the same content (their ETag is the MD5 of the part) are
+    not sent again. The earlier upload is only reused if its first part,
+    which for a COG holds the header and the offset of every tile, matches,
+    and if it has been idle for ``RESUME_IDLE_SECONDS`` so that it is not
+    taken from another writer still using it. Unfinished uploads should be
+    removed by a bucket lifecycle rule.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        bucket: str,
+        key: str,
+        part_size: int = DEFAULT_PART_SIZE,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_pending: Optional[int] = None,
+        extra_args: Optional[Dict[str, Any]] = None,
+        resume: bool = False,
+    ):
+        """Initialise the writer, no request is made until the first part is full
+
+        Parameters
+        ----------
+        client : S3Client
+            Boto3 S3 client
+        bucket : str
+            Name of the S3 bucket
+        key : str
+            Key to write
+        part_size : int, optional
+            Size of each uploaded part in bytes, at least 5 MiB
+        max_concurrency : int, optional
+            Number of parts to upload in parallel
+        max_pending : int, optional
+            Maximum number of parts held in memory, defaults to twice
+            ``max_concurrency``
+        extra_args : Dict[str, Any], optional
+            Extra arguments for PutObject / CreateMultipartUpload, e.g. ACL
+        resume : bool, optional
+            Continue an unfinished upload of ``key`` if there is one
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"Part size must be at least {MIN_PART_SIZE} bytes, got {part_size}")
+
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args or {}
+        self.resume = resume
+        self.bytes_written = 0
+        # Bytes of parts that were already uploaded by an earlier attempt
+        self.bytes_reused = 0
+        self.closed = False
+        self.part_stats: List[PartStats] = []
+
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        # ETag and size of each part of the resumed upload
+        self._uploaded: Dict[int, Tuple[str, int]] = {}
+        self._reused_lock = threading.Lock()
+        self._part_number = 0
+        self._futures: List[Future] = []
+        self._pending = threading.BoundedSemaphore(max_pending or 2 * max_concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._start = time.perf_counter()
+
+    def __enter__(self) -> "MultipartWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        """Write bytes-like ``data``, copying it into the current part
+
+        Returns
+        -------
+        int
+            Number of bytes written
+        """
+        view = memoryview(data).cast("B")
+        size = len(view)
+        while view:
+            take = min(len(view), self.part_size - len(self._buffer))
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) == self.part_size:
+                part, self._buffer = self._buffer, bytearray()
+                self._submit(memoryview(part))
+
+        self.bytes_written += size
+        return size
+
+    def write_view(self, data) -> None:
+        """Write a buffer without copying it
+
+        Whole parts are uploaded directly from ``data``, so unlike ``write``
+        the buffer must not be modified or released until the writer has
+        been closed.
+        """
+        view = memoryview(data).cast("B")
+
+        # Top up any partially filled part first to keep parts aligned
+        if self._buffer:
+            take = min(len(view), self.part_size - len(self._buffer))
+            self.write(view[:take])
+            view = view[take:]
+
+        while len(view) >= self.part_size:
+            self._submit(view[: self.part_size])
+            self.bytes_written += self.part_size
+            view = view[self.part_size :]
+
+        if view:
+            self.write(view)
+
+    def write_file(self, path: str) -> None:
+        """Write the contents of a local file, reading one part at a time"""
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(self.part_size - len(self._buffer)), b""):
+                if not self._buffer and len(chunk) == self.part_size:
+                    # A full part read from disk can be uploaded as is
+                    self._submit(memoryview(chunk))
+                    self.bytes_written += len(chunk)
+                else:
+                    self.write(chunk)
+
+    def _submit(self, part: memoryview) -> None:
+        """Queue a full part for upload, blocking while too many are pending"""
+        if self._upload_id is None:
+            if self.resume:
+                self._resume_upload(part)
+            if self._upload_id is None:
+                response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)
+                self._upload_id = response["UploadId"]
+                log.debug(f"Started multipart upload of {self.key} : {self._upload_id}")
+
+        self._part_number += 1
+        self._pending.acquire()
+        future = self._pool.submit(self._upload_part, self._part_number, part)
+        future.add_done_callback(lambda _: self._pending.release())
+        self._futures.append(future)
+
+    def _resume_upload(self, first_part: memoryview) -> None:
+        """Continue the latest idle unfinished upload of the key if its first part matches ``first_part``"""
+        response = self.client.list_multipart_uploads(Bucket=self.bucket, Prefix=self.key)
+        uploads = [upload for upload in response.get("Uploads", []) if upload["Key"] == self.key]
+        idle_since = datetime.now(timezone.utc) - timedelta(seconds=RESUME_IDLE_SECONDS)
+
+        for upload in sorted(uploads, key=lambda upload: upload["Initiated"], reverse=True):
+            upload_id = upload["UploadId"]
+            uploaded, last_modified = {}, upload["Initiated"]
+            for page in self.client.get_paginator("list_parts").paginate(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id
+            ):
+                for part in page.get("Parts", []):
+                    uploaded[part["PartNumber"]] = (part["ETag"], part["Size"])
+                    last_modified = max(last_modified, part["LastModified"])
+
+            if last_modified > idle_since:
+                log.info(f"Unfinished upload of {self.key} may still be in use, leaving it : {upload_id}")
+                continue
+
+            if not _same_part(uploaded.get(1), first_part):
+                log.info(f"Unfinished upload of {self.key} is of different content, aborting it : {upload_id}")
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+                return
+
+            log.info(
+                f"Resuming multipart upload of {self.key} with {len(uploaded)} parts already uploaded : {upload_id}"
+            )
+            self._upload_id = upload_id
+            self._uploaded = uploaded
+            return
+
+    def _upload_part(self, part_number: int, part: memoryview) -> Dict[str, Any]:
+        start = time.perf_counter()
+        uploaded = self._uploaded.get(part_number)
+        if _same_part(uploaded, part):
+            log.debug(f"Part {part_number} of {self.key} was already uploaded")
+            with self._reused_lock:
+                self.bytes_reused += len(part)
+            return {"ETag": uploaded[0], "PartNumber": part_number}
+
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=_ViewReader(part),
+        )
+
+        stats = PartStats(part_number, (part_number - 1) * self.part_size, len(part), time.perf_counter() - start)
+        log.debug(
+            f"Part {part_number} of {self.key} : {len(part)} bytes in {stats.seconds:.3f}s "
+            f"({stats.throughput:.1f} MiB/s)"
+        )
+        self.part_stats.append(stats)
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    def close(self) -> None:
+        """Upload any remaining data and complete the upload"""
+        if self.closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                # Everything fitted in one part, a single request is cheaper
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self.extra_args)
+                self.part_stats = [PartStats(1, 0, len(self._buffer), time.perf_counter() - self._start)]
+            else:
+                if self._buffer:
+                    self._submit(memoryview(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            self.abort()
+            raise
+
+        self.closed = True
+        self._pool.shutdown()
+        self.part_stats.sort(key=lambda part: part.part_number)
+        log_transfer_summary(f"Uploaded {self.key}", self.part_stats, time.perf_counter() - self._start)
+
+    def abort(self) -> None:
+        """Cancel the upload, discarding any parts already sent unless resuming"""
+        if self.closed:
+            return
+
+        self.closed = True
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+        if self._upload_id is not None and self.resume:
+            log.warning(f"Leaving multipart upload of {self.key} to be resumed : {self._upload_id}")
+        elif self._upload_id is not None:
+            log.warning(f"Aborting multipart upload of {self.key} : {self._upload_id}")
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+def _same_part(uploaded: Optional[Tuple[str, int]], part: memoryview) -> bool:
+    """Whether a part uploaded with ``(ETag, size)`` has the content of ``part``"""
+    if uploaded is None or uploaded[1] != len(part):
+        return False
+    return uploaded[0].strip('"') == hashlib.md5(part).hexdigest()
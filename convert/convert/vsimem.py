@@ -0,0 +1,154 @@
+"""GDAL /vsimem files that share memory with Python instead of copying it
+
+The GDAL Python bindings copy buffers into and out of /vsimem, and files are
+only freed when explicitly unlinked. Here the GDAL C API is called through
+ctypes so that GDAL reads a Python buffer in place and Python reads GDAL's
+buffer in place, and each file is unlinked when its handle is closed.
+"""
+import ctypes
+import logging
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+from uuid import uuid4
+
+if TYPE_CHECKING:
+    from osgeo import gdal
+
+log = logging.getLogger(__name__)
+
+# Bytes held by the open handles of this process
+_held_bytes = 0
+_held_lock = threading.Lock()
+
+
+def held_bytes() -> int:
+    """Buffers allocated by every open ``VsiMemFile``, to spot leaks in long running processes"""
+    return _held_bytes
+
+
+def _track(size: int) -> None:
+    global _held_bytes
+    with _held_lock:
+        _held_bytes += size
+
+
+def declare(lib: ctypes.CDLL) -> ctypes.CDLL:
+    """Set the signatures of the /vsimem functions of a GDAL library"""
+    lib.VSIFileFromMemBuffer.argtypes = [ctypes.c_char_p, ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int]
+    lib.VSIFileFromMemBuffer.restype = ctypes.c_void_p
+    lib.VSIFCloseL.argtypes = [ctypes.c_void_p]
+    lib.VSIFCloseL.restype = ctypes.c_int
+    lib.VSIGetMemFileBuffer.argtypes = [ctypes.c_char_p, ctypes.POINTER(ctypes.c_uint64), ctypes.c_int]
+    lib.VSIGetMemFileBuffer.restype = ctypes.c_void_p
+    lib.VSIUnlink.argtypes = [ctypes.c_char_p]
+    lib.VSIUnlink.restype = ctypes.c_int
+    return lib
+
+
+@lru_cache(maxsize=None)
+def gdal_library() -> ctypes.CDLL:
+    """The GDAL library used by the ``osgeo`` bindings
+
+    Rasterio may load its own copy of GDAL, whose /vsimem is separate, so the
+    library is looked up through the bindings' extension module.
+    """
+    from osgeo import _gdal
+
+    return declare(ctypes.CDLL(_gdal.__file__))
+
+
+class VsiMemFile:
+    """A /vsimem file that is unlinked, and its memory freed, when closed
+
+    The file is either backed by a Python buffer that GDAL reads in place (see
+    ``allocate``), or created by GDAL and read in place with ``view``. Use as
+    a context manager.
+    """
+
+    def __init__(self, path: Optional[str] = None, lib: Optional[ctypes.CDLL] = None):
+        """
+        Parameters
+        ----------
+        path : str, optional
+            Path of the file, a unique /vsimem/ path by default
+        lib : ctypes.CDLL, optional
+            GDAL library the file belongs to, that of ``osgeo`` by default
+        """
+        self.path = path or f"/vsimem/{uuid4().hex}.tif"
+        self.lib = declare(lib) if lib is not None else gdal_library()
+        self.buffer: Optional[bytearray] = None
+        self._pinned: Optional[ctypes.Array] = None
+        self._tracked = 0
+        self._dataset: Optional["gdal.Dataset"] = None
+
+    @classmethod
+    def allocate(cls, size: int, path: Optional[str] = None, lib: Optional[ctypes.CDLL] = None) -> "VsiMemFile":
+        """A file backed by a new ``size`` byte buffer, fill ``buffer`` then ``register``"""
+        mem = cls(path, lib)
+        mem.buffer = bytearray(size)
+        mem._tracked = size
+        _track(size)
+        return mem
+
+    def register(self) -> None:
+        """Make ``buffer`` readable by GDAL at ``path`` without copying it"""
+        if self.buffer is None:
+            raise ValueError("Only allocated files can be registered")
+
+        # GDAL does not take ownership, so the buffer is kept (and cannot be
+        # resized) until the file is closed
+        self._pinned = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        handle = self.lib.VSIFileFromMemBuffer(self.path.encode(), ctypes.addressof(self._pinned), len(self.buffer), 0)
+        if not handle:
+            raise OSError(f"Could not create {self.path}")
+        self.lib.VSIFCloseL(handle)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the file, whether it is owned by Python or GDAL"""
+        if self.buffer is not None:
+            return len(self.buffer)
+        size = ctypes.c_uint64(0)
+        self.lib.VSIGetMemFileBuffer(self.path.encode(), ctypes.byref(size), 0)
+        return size.value
+
+    def view(self) -> memoryview:
+        """Read only view of the file's contents in GDAL's memory
+
+        The view is only valid until the file is closed or written again.
+        """
+        size = ctypes.c_uint64(0)
+        address = self.lib.VSIGetMemFileBuffer(self.path.encode(), ctypes.byref(size), 0)
+        if not address:
+            raise FileNotFoundError(f"{self.path} does not exist")
+        return memoryview((ctypes.c_char * size.value).from_address(address)).cast("B").toreadonly()
+
+    @property
+    def dataset(self) -> "gdal.Dataset":
+        """The file opened as a GDAL dataset, closed along with the file"""
+        if self._dataset is None:
+            from osgeo import gdal
+
+            log.info(f"Opening GDAL file from memory buffer ({self.path})")
+            self._dataset = gdal.Open(self.path)
+            if self._dataset is None:
+                raise OSError(f"GDAL could not open {self.path}")
+        return self._dataset
+
+    def close(self) -> None:
+        """Close the dataset, unlink the file and free its memory"""
+        # The dataset may still read the file, so must be closed first
+        self._dataset = None
+        self.lib.VSIUnlink(self.path.encode())
+        self._pinned = None
+        self.buffer = None
+        if self._tracked:
+            _track(-self._tracked)
+            self._tracked = 0
+
+    def __enter__(self) -> "VsiMemFile":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,136 @@
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence
+
+from convert.manifest import Task, check_task, default_out_key
+from convert.s3 import S3Helper
+
+log = logging.getLogger(__name__)
+
+# Suffixes of keys that are picked up when converting everything under a prefix
+TIFF_SUFFIXES = (".tif", ".tiff")
+
+# COG profile(s) written for each task, see ``convert.cog.output_specs``. The
+# Lambda trigger reads the same $COG_PROFILES to skip outputs that are current
+DEFAULT_PROFILES = ("deflate",)
+
+
+def parse_profiles(values: Iterable[str]) -> List[str]:
+    """Profiles from comma separated values such as ``$COG_PROFILES``, or ``DEFAULT_PROFILES`` if there are none"""
+    profiles = [profile.strip() for value in values for profile in value.split(",") if profile.strip()]
+    return profiles or list(DEFAULT_PROFILES)
+
+
+@dataclass
+class TaskResult:
+    """Outcome of converting a single task"""
+
+    task: Task
+    seconds: float
+    error: Optional[str] = None
+    # False when the output was already up to date so nothing was converted
+    converted: bool = True
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def tasks_from_keys(bucket: str, keys: Iterable[str], out_bucket: str) -> List[Task]:
+    """Build tasks for the given keys using the default output key naming"""
+    return [Task(bucket, key, out_bucket, default_out_key(key)) for key in keys]
+
+
+def tasks_from_prefix(bucket: str, prefix: str, out_bucket: str) -> List[Task]:
+    """Build tasks for every TIFF under ``prefix`` in ``bucket``"""
+    keys = [key for key in S3Helper(bucket).list_keys(prefix) if key.lower().endswith(TIFF_SUFFIXES)]
+    log.info(f"Found {len(keys)} TIFFs under s3://{bucket}/{prefix}")
+    return tasks_from_keys(bucket, keys, out_bucket)
+
+
+def _warm_up() -> None:
+    """Import the conversion stack once per worker so each task starts warm"""
+    import convert.cog  # noqa: F401
+
+
+def run_task(task: Task, profiles: Sequence[str] = DEFAULT_PROFILES) -> TaskResult:
+    """Convert a single task, capturing rather than raising any failure"""
+    from convert.cog import output_specs, to_cog
+
+    start = time.perf_counter()
+    try:
+        check_task(task)
+        converted = to_cog(task.bucket, task.key, task.out_bucket, output_specs(task.out_key, list(profiles)))
+    except Exception:
+        log.exception(f"Failed to convert s3://{task.bucket}/{task.key}")
+        return TaskResult(task, time.perf_counter() - start, traceback.format_exc(limit=1).strip())
+
+    return TaskResult(task, time.perf_counter() - start, converted=converted)
+
+
+def run_tasks(tasks: List[Task], workers: int = 1, profiles: Sequence[str] = DEFAULT_PROFILES) -> List[TaskResult]:
+    """Convert all ``tasks``, continuing past any failures
+
+    Parameters
+    ----------
+    tasks : List[Task]
+        Objects to convert
+    workers : int, optional
+        Number of conversions to run in parallel. With more than one worker a
+        pool of long lived processes is used, each one reusing its S3 session
+        and GDAL state across tasks.
+    profiles : Sequence[str], optional
+        COG profiles to write for each task from a single read of its source
+
+    Returns
+    -------
+    List[TaskResult]
+        Result of each task in order of completion
+    """
+    log.info(f"Converting {len(tasks)} objects with {workers} worker(s)")
+    start = time.perf_counter()
+    results: List[TaskResult] = []
+
+    if workers <= 1:
+        _warm_up()
+        for task in tasks:
+            results.append(_log_result(run_task(task, profiles), len(results) + 1, len(tasks)))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_warm_up) as pool:
+            futures = [pool.submit(run_task, task, profiles) for task in tasks]
+            for future in as_completed(futures):
+                results.append(_log_result(future.result(), len(results) + 1, len(tasks)))
+
+    log_summary(results, time.perf_counter() - start)
+    return results
+
+
+def _log_result(result: TaskResult, number: int, total: int) -> TaskResult:
+    task = result.task
+    if not result.ok:
+        status = f"FAILED ({result.error})"
+    else:
+        status = "OK" if result.converted else "UP TO DATE"
+    log.info(
+        f"[{number}/{total}] {status} s3://{task.bucket}/{task.key} -> "
+        f"s3://{task.out_bucket}/{task.out_key} in {result.seconds:.2f}s"
+    )
+    return result
+
+
+def log_summary(results: List[TaskResult], seconds: float) -> None:
+    """Log the number of successes and failures along with overall timing"""
+    failed = [result for result in results if not result.ok]
+    cached = [result for result in results if result.ok and not result.converted]
+    busy = sum(result.seconds for result in results)
+    log.info(
+        f"Converted {len(results) - len(failed) - len(cached)} of {len(results)} objects "
+        f"({len(cached)} already up to date, {len(failed)} failed) in {seconds:.2f}s "
+        f"({len(results) / seconds if seconds > 0 else 0:.2f} objects/s, "
+        f"mean {busy / len(results) if results else 0:.2f}s per object)"
+    )
+    for result in failed:
+        log.error(f"Failed : s3://{result.task.bucket}/{result.task.key} : {result.error}")
@@ -7,7 +7,7 @@ setup(
     author="Martin Black",
     author_email="mblack@sparkgeo.com",
     description="A simple GDAL converter that pulls from S3",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=["boto3", "rasterio", "rio-cogeo"],
-    scripts=["scripts/s3-to-cog"],
+    scripts=["scripts/s3-to-cog", "scripts/footprints"],
 )
@@ -1,8 +1,55 @@
 import os
+import sys
 
+import boto3
 import pytest
+from moto import mock_aws
+
+from convert import clients
+
+# The benchmarks are not part of the installed package
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture(autouse=True)
+def client_registry():
+    """Fresh boto3 sessions and clients in each test, as tests change the credentials and endpoint"""
+    clients.reset()
+    yield
+    clients.reset()
 
 
 @pytest.fixture
 def test_dir():
     return os.path.abspath(os.path.dirname(__file__))
+
+
+@pytest.fixture
+def aws_credentials(monkeypatch):
+    """Fake credentials so nothing can reach a real AWS account"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture
+def s3_bucket(aws_credentials):
+    """Name of an empty bucket in a mocked S3"""
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket="test-bucket")
+        yield "test-bucket"
+
+
+@pytest.fixture
+def s3_server(aws_credentials, monkeypatch):
+    """Name of an empty bucket in a local S3 compatible server, reachable by GDAL as well as boto3"""
+    server = pytest.importorskip("moto.server").ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    monkeypatch.setenv("AWS_ENDPOINT_URL_S3", f"http://{host}:{port}")
+    try:
+        boto3.client("s3").create_bucket(Bucket="stream-bucket")
+        yield "stream-bucket"
+    finally:
+        server.stop()
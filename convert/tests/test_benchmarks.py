@@ -0,0 +1,125 @@
+from dataclasses import replace
+from pathlib import Path
+
+import pytest
+import rasterio
+
+from benchmarks.clients import run as run_client_benchmark
+from benchmarks.footprints import run as run_footprint_benchmark
+from benchmarks.harness import BenchResult, best_profiles, compare, load_results, run_case, save_results
+from benchmarks.ingest import compare as compare_ingest
+from benchmarks.ingest import load_result, save_result, simulate, synthetic_arrivals
+from benchmarks.synthetic import RasterCase, write_synthetic
+
+
+def test_write_synthetic(tmp_path: Path):
+    case = RasterCase(300, 200, count=3, dtype="uint8", tiled=True, compress="deflate")
+    path = str(tmp_path / "synthetic.tif")
+    write_synthetic(path, case)
+
+    with rasterio.open(path) as src:
+        assert (src.width, src.height, src.count) == (300, 200, 3)
+        assert src.dtypes[0] == "uint8"
+        assert src.profile["tiled"]
+        assert src.compression.value == "DEFLATE"
+        assert src.read().std() > 0
+
+
+@pytest.mark.parametrize("operation", ["to_cog", "download", "upload"])
+def test_run_case(operation: str, tmp_path: Path):
+    result = run_case(RasterCase(256, 256), operation, scratch_dir=str(tmp_path))
+
+    assert result.seconds > 0
+    assert result.peak_rss_mib > 0
+    assert result.output_size > 0
+    if operation == "upload":
+        assert result.bytes_up == result.input_size
+    else:
+        assert result.bytes_down == result.input_size
+    if operation == "to_cog":
+        assert result.bytes_up == result.output_size
+
+
+def test_save_and_compare(tmp_path: Path):
+    baseline = [BenchResult("a", "to_cog", {}, 1.0, 100.0, 10, 8, 10, 8, 4)]
+    path = str(tmp_path / "results" / "baseline.json")
+    save_results(path, baseline)
+    assert load_results(path) == baseline
+
+    assert compare([replace(baseline[0], seconds=1.1)], baseline, tolerance=0.25) == []
+
+    regressions = compare([replace(baseline[0], seconds=1.5, peak_rss_mib=200.0)], baseline, tolerance=0.25)
+    assert len(regressions) == 2
+    assert "seconds" in regressions[0] and "peak_rss_mib" in regressions[1]
+
+    # very short timings are too noisy to compare
+    fast = [replace(baseline[0], seconds=0.01)]
+    assert compare([replace(fast[0], seconds=0.02)], fast) == []
+
+
+def test_run_case_runtime_profile(tmp_path: Path):
+    result = run_case(RasterCase(256, 256), "to_cog", scratch_dir=str(tmp_path), runtime_profile="bounded")
+    assert result.runtime_profile == "bounded"
+    assert result.id == "to_cog/256x256x1-uint16-striped-none/bounded"
+
+
+def test_best_profiles():
+    result = BenchResult("a", "to_cog", {}, 1.0, 100.0, 10, 8, 10, 8, 4)
+    results = [
+        replace(result, runtime_profile="serial", seconds=2.0),
+        replace(result, runtime_profile="parallel", seconds=1.0),
+        replace(result, case="b", runtime_profile="serial", seconds=1.0),
+        replace(result, case="b", runtime_profile="parallel", seconds=3.0),
+        result,
+    ]
+    assert best_profiles(results) == {"to_cog/a": "parallel", "to_cog/b": "serial"}
+
+
+def test_client_benchmark():
+    pytest.importorskip("moto.server")
+    results = {result.operation: result for result in run_client_benchmark(calls=3)}
+
+    assert set(results) == {"construct", "get_bytes", "write_bytes", "head"}
+    assert all(result.fresh_seconds > 0 and result.shared_seconds > 0 for result in results.values())
+    # a new client loads the service model, a shared one does not
+    assert results["construct"].speedup > 1
+
+
+def test_footprint_benchmark():
+    small, large = run_footprint_benchmark(sizes=[100, 3000], queries=3)
+
+    assert (small.records, large.records) == (100, 3000)
+    assert large.shard_bytes > small.shard_bytes
+    assert all(result.load_merged_seconds > 0 and result.bbox_seconds > 0 for result in (small, large))
+    # the synthetic scenes are spread evenly, so larger indexes find more
+    assert large.bbox_matches >= small.bbox_matches
+
+
+def test_synthetic_arrivals():
+    arrivals = synthetic_arrivals(1000, rate=10.0, sizes={256: 3, 1024: 1}, burst=4)
+
+    assert len({arrival.key for arrival in arrivals}) == 1000
+    # objects arrive in bursts at a mean of 10 per second
+    assert len({arrival.at for arrival in arrivals}) == 250
+    assert 80 < arrivals[-1].at < 120
+    assert 650 < sum(arrival.size == 256 for arrival in arrivals) < 850
+
+
+def test_ingest_simulator(tmp_path: Path):
+    pytest.importorskip("moto.server")
+    result = simulate(objects=3, rate=50.0, sizes={256: 1}, burst=3, concurrency=2, sample_interval=0.1)
+
+    assert (result.objects, result.submitted, result.failed) == (3, 3, 0)
+    assert result.objects_per_second > 0
+    assert result.latency_seconds["p50"] <= result.latency_seconds["p90"] <= result.latency_seconds["max"]
+    assert {"trigger", "queue", "startup", "download", "translate", "upload"} <= set(result.stage_seconds)
+    # three objects arrive at once for two jobs at a time
+    assert result.max_queue_depth >= 1
+    assert max(running for _, _, running in result.queue_depth) == 2
+
+    path = str(tmp_path / "ingest.json")
+    save_result(path, result)
+    assert load_result(path) == result
+    assert compare_ingest(result, result) == []
+    slower = replace(result, objects_per_second=result.objects_per_second / 2)
+    assert len(compare_ingest(slower, result, tolerance=0.25)) == 1
@@ -0,0 +1,86 @@
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from moto import mock_aws
+
+from convert import clients
+from convert.s3 import S3Helper
+
+
+def test_get_client_is_shared(aws_credentials):
+    client = clients.get_client("s3")
+
+    assert clients.get_client("s3") is client
+    assert clients.get_client("s3", region="eu-west-1") is not client
+    assert clients.get_client("s3", region="eu-west-1").meta.region_name == "eu-west-1"
+    assert S3Helper("a").client is S3Helper("b").client is client
+
+
+def test_get_client_threads(aws_credentials):
+    barrier = threading.Barrier(8)
+
+    def get(_):
+        barrier.wait()
+        return clients.get_client("s3")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        found = list(pool.map(get, range(8)))
+    assert all(client is found[0] for client in found)
+
+
+def _registry_in_child(parent_client: int, results: "multiprocessing.Queue") -> None:
+    """Put the clients inherited by a forked child, and whether it makes a client of its own"""
+    inherited = len(clients._clients)
+    results.put((inherited, id(clients.get_client("s3")) != parent_client))
+
+
+def test_get_client_after_fork(aws_credentials):
+    client = clients.get_client("s3")
+
+    # fork while another thread holds the lock, as a pool of workers may
+    held, release = threading.Event(), threading.Event()
+
+    def hold():
+        with clients._lock:
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    try:
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        child = context.Process(target=_registry_in_child, args=(id(client), results))
+        child.start()
+        child.join(timeout=60)
+        if child.is_alive():
+            child.terminate()
+        assert child.exitcode == 0
+        assert results.get(timeout=5) == (0, True)
+    finally:
+        release.set()
+        holder.join()
+    assert clients.get_client("s3") is client
+
+
+def test_client_config(aws_credentials):
+    config = clients.get_client("s3").meta.config
+
+    assert config.max_pool_connections == clients.MAX_POOL_CONNECTIONS
+    assert config.retries["mode"] == clients.RETRY_MODE
+    assert config.tcp_keepalive
+
+
+def test_get_client_assumes_role(aws_credentials):
+    role_arn = "arn:aws:iam::123456789012:role/reader"
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket="test-bucket")
+        client = clients.get_client("s3", role_arn=role_arn)
+
+        assert client is not clients.get_client("s3")
+        assert client.list_buckets()["Buckets"][0]["Name"] == "test-bucket"
+        credentials = clients.get_session(role_arn=role_arn).get_credentials().get_frozen_credentials()
+        assert credentials.access_key != "testing"
@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from convert.compression import (
+    Candidate,
+    Selection,
+    Trial,
+    auto_options,
+    candidates,
+    choose,
+    policy_slack,
+    sample_windows,
+    select_compression,
+    trial_encode,
+)
+from convert.fingerprint import COMPRESSION_KEY, COMPRESSION_RATIOS_KEY
+
+
+def test_policy_slack():
+    assert policy_slack("size") == 0
+    assert policy_slack("balanced") < policy_slack("speed")
+    assert policy_slack("0.1") == 0.1
+    assert auto_options("size", True) == {"policy": 0, "lossy": True}
+
+    for policy in ("smallest", "-1"):
+        with pytest.raises(ValueError):
+            policy_slack(policy)
+
+
+def test_candidates():
+    names = [candidate.name for candidate in candidates("uint16", 1)]
+    assert names == ["deflate", "deflate-predictor2", "zstd", "zstd-predictor2", "lzw", "lzw-predictor2"]
+
+    # floats use the floating point predictor and can use LERC
+    names = [candidate.name for candidate in candidates("float32", 1)]
+    assert "zstd-predictor3" in names
+    assert "lerc_deflate" in names
+
+    # WebP is lossy, so only offered for RGB when allowed
+    assert "webp" not in [candidate.name for candidate in candidates("uint8", 3)]
+    assert "webp" in [candidate.name for candidate in candidates("uint8", 3, allow_lossy=True)]
+    assert "webp" not in [candidate.name for candidate in candidates("uint16", 3, allow_lossy=True)]
+
+
+def test_sample_windows():
+    # small rasters are sampled whole
+    assert sample_windows(100, 50, 4, 512) == [Window(0, 0, 100, 50)]
+
+    windows = sample_windows(4096, 2048, 4, 512)
+    assert len(windows) == 4
+    offsets = {(window.col_off, window.row_off) for window in windows}
+    assert offsets == {(768, 256), (2816, 256), (768, 1280), (2816, 1280)}
+    for window in windows:
+        assert (window.width, window.height) == (512, 512)
+
+    # narrow rasters are sampled along their length, within bounds
+    for window in sample_windows(300, 5000, 4, 512):
+        assert window.col_off == 0 and window.width == 300
+        assert 0 <= window.row_off <= 5000 - 512
+
+
+def test_choose():
+    def trial(name: str, size: int, seconds: float) -> Trial:
+        return Trial(Candidate(name), size, seconds, 1000)
+
+    trials = [trial("small", 100, 3.0), trial("close", 104, 1.0), trial("fast", 120, 0.1)]
+    assert choose(trials, policy_slack("size")).candidate.name == "small"
+    assert choose(trials, policy_slack("balanced")).candidate.name == "close"
+    assert choose(trials, policy_slack("speed")).candidate.name == "fast"
+
+    metadata = Selection(trials[0].candidate, trials).metadata()
+    assert metadata[COMPRESSION_KEY] == "small"
+    assert json.loads(metadata[COMPRESSION_RATIOS_KEY]) == {"small": 10.0, "close": 9.62, "fast": 8.33}
+
+
+def test_trial_encode():
+    data = np.zeros((1, 100, 100), dtype="uint8")
+    trial = trial_encode([data, data], Candidate("deflate"))
+    assert trial.raw_size == 2 * data.nbytes
+    assert trial.ratio > 1
+    assert trial.seconds > 0
+
+
+def test_select_compression(tmp_path):
+    # a smooth surface suits the floating point predictor
+    path = str(tmp_path / "dem.tif")
+    y, x = np.mgrid[0:600, 0:700].astype("float32")
+    profile = {"driver": "GTiff", "width": 700, "height": 600, "count": 1, "dtype": "float32"}
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write((np.sin(x / 50) * np.cos(y / 80) * 1000)[np.newaxis])
+
+    selection = select_compression(path, policy="size", samples=4, sample_size=256)
+    names = [trial.candidate.name for trial in selection.trials]
+    assert names == [candidate.name for candidate in candidates("float32", 1)]
+    best = min(selection.trials, key=lambda trial: trial.size)
+    assert selection.candidate == best.candidate
+    assert "predictor" in selection.candidate.name or "lerc" in selection.candidate.name
+
+
+def test_select_compression_rgb(test_dir: str, tmp_path):
+    path = str(tmp_path / "rgb.tif")
+    with rasterio.open(os.path.join(test_dir, "data", "landsat.tif")) as src:
+        band = src.read(1)
+    profile = {"driver": "GTiff", "width": band.shape[1], "height": band.shape[0], "count": 3, "dtype": "uint8"}
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.stack([(band // 256).astype("uint8")] * 3))
+
+    selection = select_compression(path, allow_lossy=True)
+    assert "webp" in [trial.candidate.name for trial in selection.trials]
+    assert selection.candidate.dst_profile()["compress"] == selection.candidate.profile.upper()
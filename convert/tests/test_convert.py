@@ -1,46 +1,473 @@
+import json
 import os
+import shutil
+from functools import partial
 from io import BytesIO
 from pathlib import Path
+from unittest import mock
+from uuid import uuid4
 
+import boto3
+import numpy as np
+import pytest
+import rasterio
+import rasterio.shutil
 from pytest_mock import MockerFixture
+from rasterio.transform import from_origin
 from rio_cogeo.cogeo import cog_validate
 
-from convert.cog import to_cog
+from convert import tiff
+from convert.cog import SOURCE_NAME, OutputSpec, _decoded_source, _work_dir, output_specs, to_cog, to_cogs
+from convert.s3 import S3Helper
+from convert.fingerprint import CACHE_STATS, COMPRESSION_KEY, COMPRESSION_RATIOS_KEY
+from convert.footprints import FootprintIndex
+from convert.metrics import Recorder, capture
+from convert.s3 import ObjectInfo
+from convert.transfer import DownloadCheckpoint, MultipartWriter
 
 
-def test_to_cog(test_dir: str, tmp_path: Path, mocker: MockerFixture):
+@pytest.fixture
+def mock_s3(test_dir: str, tmp_path: Path, mocker: MockerFixture) -> str:
+    """Mock the read/write of the S3 Helper so it does not actually hit S3
+
+    Reads always return ``landsat.tif`` and writes go to the returned path,
+    as well as to ``outputs/<key>`` alongside it for non empty keys, with the
+    metadata of each write returned for its output key
+    """
     image_path = os.path.join(test_dir, "data", "landsat.tif")
     out_path = str(tmp_path / "cog.tif")
+    written_metadata = {}
+
+    def record(path, key, metadata):
+        written_metadata[key] = metadata
+        if key:
+            # outputs are written concurrently so each needs its own file
+            os.makedirs(tmp_path / "outputs", exist_ok=True)
+            shutil.copy(path, tmp_path / "outputs" / key)
+        shutil.copy(path, out_path)
+
+    def mock_head(self, key):
+        return ObjectInfo(os.path.getsize(image_path), '"etag"', None, {})
 
-    # Mock the read/write of the S3 Helper so it does not actually hit S3
-    mocker.patch("convert.s3.S3Helper._init_bucket", lambda _: None)
+    def mock_get_metadata(self, key):
+        return written_metadata.get(key)
 
     def mock_get_bytes(self, key):
         with open(image_path, "rb") as fh:
             buf = BytesIO(fh.read())
         return buf
 
-    def mock_write_bytes(self, content, key):
-        with open(out_path, "wb") as fh:
+    def mock_write_bytes(self, content, key, metadata=None):
+        path = str(tmp_path / f"{uuid4().hex}.tif")
+        with open(path, "wb") as fh:
             fh.write(content.getbuffer())
+        record(path, key, metadata)
+        os.remove(path)
 
-    mocker.patch(
-        "convert.s3.S3Helper.get_bytes",
-        mock_get_bytes,
-    )
+    def mock_write_stream(self, produce, key, metadata=None):
+        path = str(tmp_path / f"{uuid4().hex}.tif")
+        with open(path, "wb") as fh:
+            result = produce(fh)
+        record(path, key, metadata)
+        os.remove(path)
+        return result
 
-    mocker.patch(
-        "convert.s3.S3Helper.write_bytes",
-        mock_write_bytes,
-    )
+    def mock_download_file(self, key, path):
+        shutil.copy(image_path, path)
 
-    # Mocking the call to S3 so the input/output keys do not matter
-    to_cog("", "", "", "")
+    def mock_upload_file(self, path, key, metadata=None):
+        record(path, key, metadata)
+
+    mocker.patch("convert.s3.S3Helper.head", mock_head)
+    mocker.patch("convert.s3.S3Helper.get_metadata", mock_get_metadata)
+    mocker.patch("convert.s3.S3Helper.get_bytes", mock_get_bytes)
+    mocker.patch("convert.s3.S3Helper.write_bytes", mock_write_bytes)
+    mocker.patch("convert.s3.S3Helper.write_stream", mock_write_stream)
+    mocker.patch("convert.s3.S3Helper.download_file", mock_download_file)
+    mocker.patch("convert.s3.S3Helper.upload_file", mock_upload_file)
+
+    return out_path
 
-    # ensure we created a valid COG with no errors or warnings
-    assert os.path.exists(out_path)
 
-    is_valid, errors, warnings = cog_validate(out_path)
+def assert_valid_cog(path: str):
+    """Ensure we created a valid COG with no errors or warnings"""
+    assert os.path.exists(path)
+
+    is_valid, errors, warnings = cog_validate(path)
     assert is_valid
     assert not errors
     assert not warnings
+
+
+def test_to_cog(mock_s3: str):
+    # Mocking the call to S3 so the input/output keys do not matter
+    to_cog("", "", "", "")
+    assert_valid_cog(mock_s3)
+
+
+def test_to_cog_metrics(mock_s3: str):
+    with capture() as sink:
+        to_cog("in", "a.tif", "out", "a.tif")
+        to_cog("in", "a.tif", "out", "a.tif")
+
+    # one record per conversion, the second found the output up to date
+    converted, cached = sink.records
+    assert converted["name"] == "to_cog"
+    assert converted["dimensions"] == {"mode": "memory"}
+    assert converted["properties"] == {"source": "in/a.tif", "outputs": ["out/a.tif"], "runtime_profile": "serial"}
+    for stage in ("check", "download", "translate", "upload"):
+        assert 0 < converted["metrics"][f"{stage}_seconds"] <= converted["metrics"]["total_seconds"]
+    assert converted["metrics"]["converted_count"] == 1
+    assert converted["metrics"]["peak_rss_mib"] > 0
+
+    assert cached["metrics"]["cached_count"] == 1
+    assert "translate_seconds" not in cached["metrics"]
+
+
+def test_to_cog_on_disk(mock_s3: str, tmp_path: Path):
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+
+    # Force the on disk path regardless of the input size
+    to_cog("", "", "", "", in_memory_max_bytes=0, scratch_dir=str(scratch_dir))
+    assert_valid_cog(mock_s3)
+
+    # scratch files are cleaned up once the upload has finished
+    assert not list(scratch_dir.iterdir())
+
+
+def test_to_cog_skips_current_output(mock_s3: str):
+    hits, misses = CACHE_STATS.hits, CACHE_STATS.misses
+
+    # the first conversion records its fingerprint on the output
+    assert to_cog("in", "a.tif", "out", "a.tif")
+    os.remove(mock_s3)
+
+    # the same source and profile is a cache hit, so nothing is written
+    assert not to_cog("in", "a.tif", "out", "a.tif")
+    assert not os.path.exists(mock_s3)
+
+    # a different source is a miss
+    assert to_cog("in", "b.tif", "out", "a.tif")
+    assert os.path.exists(mock_s3)
+
+    # forcing the conversion ignores the cache
+    assert to_cog("in", "b.tif", "out", "a.tif", force=True)
+
+    assert CACHE_STATS.hits - hits == 1
+    assert CACHE_STATS.misses - misses == 2
+
+
+@pytest.mark.parametrize("in_memory_max_bytes", [1024 * 1024, 0], ids=["in-memory", "on-disk"])
+def test_to_cogs(mock_s3: str, tmp_path: Path, mocker: MockerFixture, in_memory_max_bytes: int):
+    get_bytes = mocker.spy(S3Helper, "get_bytes")
+    download_file = mocker.spy(S3Helper, "download_file")
+    outputs = [
+        OutputSpec("a.tif"),
+        OutputSpec("a-lzw.tif", "lzw"),
+        OutputSpec("a-packbits.tif", "packbits", {"blockxsize": 256, "blockysize": 256}),
+    ]
+
+    results = to_cogs("in", "a.tif", "out", outputs, in_memory_max_bytes=in_memory_max_bytes)
+
+    # the source is only read once for all outputs
+    assert get_bytes.call_count + download_file.call_count == 1
+
+    assert [result.spec for result in results] == outputs
+    for result, compression in zip(results, ["deflate", "lzw", "packbits"]):
+        path = str(tmp_path / "outputs" / result.spec.out_key)
+        assert_valid_cog(path)
+        assert result.converted
+        assert result.size == os.path.getsize(path)
+        assert result.seconds > 0
+        with rasterio.open(path) as src:
+            assert src.compression.value.lower() == compression
+
+    # each output is cached independently
+    outputs[1] = OutputSpec("a-lzw.tif", "lzw", {"predictor": 2})
+    results = to_cogs("in", "a.tif", "out", outputs, in_memory_max_bytes=in_memory_max_bytes)
+    assert [result.converted for result in results] == [False, True, False]
+
+
+def test_to_cogs_auto_profile(mock_s3: str, tmp_path: Path):
+    outputs = [OutputSpec("a.tif", "auto"), OutputSpec("a-zstd.tif", "zstd")]
+    with capture() as sink:
+        to_cogs("in", "a.tif", "out", outputs)
+
+    # the chosen codec and the ratio of every candidate are recorded
+    (record,) = sink.records
+    chosen = record["properties"]["compression"]
+    assert record["metrics"]["select_seconds"] > 0
+
+    metadata = S3Helper("out").get_metadata("a.tif")
+    assert metadata[COMPRESSION_KEY] == chosen
+    assert chosen in json.loads(metadata[COMPRESSION_RATIOS_KEY])
+    assert COMPRESSION_KEY not in S3Helper("out").get_metadata("a-zstd.tif")
+
+    path = str(tmp_path / "outputs" / "a.tif")
+    assert_valid_cog(path)
+    with rasterio.open(path) as src:
+        assert src.compression.value.lower() == chosen.split("-")[0]
+
+    # the choice only depends on the source, so the output stays current
+    assert not to_cogs("in", "a.tif", "out", outputs)[0].converted
+
+
+def test_to_cog_resumes(s3_bucket: str, tmp_path: Path, mocker: MockerFixture):
+    MiB = 1024 * 1024
+    scratch_dir = tmp_path / "scratch"
+    scratch_dir.mkdir()
+
+    # random data does not compress, so both the source and the COG are
+    # uploaded in two parts
+    profile = {"driver": "GTiff", "width": 1600, "height": 1600, "count": 3, "dtype": "uint8"}
+    with rasterio.open(tmp_path / "source.tif", "w", **profile) as dst:
+        dst.write(np.random.default_rng(0).integers(0, 255, (3, 1600, 1600), dtype="uint8"))
+    boto3.client("s3").upload_file(str(tmp_path / "source.tif"), s3_bucket, "in.tif")
+    mocker.patch("convert.cog.S3Helper", partial(S3Helper, part_size=5 * MiB, max_concurrency=1))
+    # the retries follow at once, rather than after the upload is left idle
+    mocker.patch("convert.transfer.RESUME_IDLE_SECONDS", 0)
+
+    def convert():
+        to_cog(s3_bucket, "in.tif", s3_bucket, "out.tif", in_memory_max_bytes=0, scratch_dir=str(scratch_dir))
+
+    def fail_on_part_2(method):
+        def interrupted(self, part_number, *args):
+            if part_number == 2:
+                raise ConnectionError("interrupted")
+            return method(self, part_number, *args)
+
+        return interrupted
+
+    # the first attempt is interrupted downloading the source
+    with mock.patch.object(DownloadCheckpoint, "record", fail_on_part_2(DownloadCheckpoint.record)):
+        with pytest.raises(ConnectionError):
+            convert()
+
+    # the second downloads the rest, and is interrupted uploading the COG
+    with mock.patch.object(MultipartWriter, "_upload_part", fail_on_part_2(MultipartWriter._upload_part)):
+        with pytest.raises(ConnectionError):
+            convert()
+    assert len(boto3.client("s3").list_multipart_uploads(Bucket=s3_bucket)["Uploads"]) == 1
+
+    # the third only uploads the rest of the COG
+    with capture() as sink:
+        convert()
+    (record,) = sink.records
+    source_bytes = os.path.getsize(tmp_path / "source.tif")
+    assert record["metrics"]["download_bytes"] == 0
+    assert record["metrics"]["resumed_bytes"] == source_bytes + 5 * MiB
+
+    client = boto3.client("s3")
+    cog_bytes = client.head_object(Bucket=s3_bucket, Key="out.tif")["ContentLength"]
+    assert record["metrics"]["upload_bytes"] == cog_bytes - 5 * MiB
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=s3_bucket)
+    assert not list(scratch_dir.iterdir())
+
+    client.download_file(s3_bucket, "out.tif", str(tmp_path / "out.tif"))
+    assert_valid_cog(str(tmp_path / "out.tif"))
+    with rasterio.open(tmp_path / "source.tif") as src, rasterio.open(tmp_path / "out.tif") as cog:
+        assert np.array_equal(src.read(), cog.read())
+
+
+@pytest.mark.parametrize("in_memory_max_bytes", [256 * 1024 * 1024, 0], ids=["in-memory", "on-disk"])
+def test_to_cog_copies_tiled_source(s3_bucket: str, tmp_path: Path, in_memory_max_bytes: int):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "out.tif")
+    profile = {"driver": "GTiff", "width": 1200, "height": 900, "count": 1, "dtype": "uint16", "nodata": 0}
+    profile.update({"tiled": True, "blockxsize": 512, "blockysize": 512, "compress": "deflate"})
+    with rasterio.open(src_path, "w", **profile) as dst:
+        dst.write(np.random.default_rng(0).integers(0, 1000, (1, 900, 1200), dtype="uint16"))
+    client = boto3.client("s3")
+    client.upload_file(src_path, s3_bucket, "in.tif")
+
+    with capture() as sink:
+        to_cog(s3_bucket, "in.tif", s3_bucket, "out.tif", in_memory_max_bytes, str(tmp_path))
+    (record,) = sink.records
+    assert record["metrics"]["copied_count"] == 1
+
+    client.download_file(s3_bucket, "out.tif", dst_path)
+    assert_valid_cog(dst_path)
+    with open(src_path, "rb") as src_fh, open(dst_path, "rb") as dst_fh:
+        (src_ifd, *_), (dst_ifd, *_) = tiff.read_ifds(src_fh)[1], tiff.read_ifds(dst_fh)[1]
+        for src_offset, dst_offset, count in zip(
+            src_ifd.values(tiff.TILE_OFFSETS), dst_ifd.values(tiff.TILE_OFFSETS), src_ifd.values(tiff.TILE_BYTE_COUNTS)
+        ):
+            src_fh.seek(src_offset)
+            dst_fh.seek(dst_offset)
+            assert src_fh.read(count) == dst_fh.read(count)
+
+
+@pytest.mark.parametrize("in_memory_max_bytes", [0, 256 * 1024 * 1024], ids=["engine", "cog_translate"])
+def test_to_cog_sparse(s3_bucket: str, tmp_path: Path, in_memory_max_bytes: int):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "out.tif")
+    profile = {"driver": "GTiff", "width": 1200, "height": 900, "count": 1, "dtype": "uint16", "nodata": 0}
+    # a scene footprint within the first 512x512 tile
+    data = np.zeros((1, 900, 1200), dtype="uint16")
+    data[:, 50:400, 80:450] = np.random.default_rng(0).integers(1, 1000, (1, 350, 370))
+    with rasterio.open(src_path, "w", **profile) as dst:
+        dst.write(data)
+    client = boto3.client("s3")
+    client.upload_file(src_path, s3_bucket, "in.tif")
+
+    with capture() as sink:
+        to_cog(s3_bucket, "in.tif", s3_bucket, "out.tif", in_memory_max_bytes, str(tmp_path))
+    (record,) = sink.records
+
+    client.download_file(s3_bucket, "out.tif", dst_path)
+    assert_valid_cog(dst_path)
+    # 5 of the 6 full resolution tiles and 1 of the 2 first overview tiles are
+    # sparse, the engine also writes a smaller overview of a single tile
+    with open(dst_path, "rb") as fh:
+        _, ifds = tiff.read_ifds(fh)
+    assert [ifd.values(tiff.TILE_BYTE_COUNTS).count(0) for ifd in ifds[:2]] == [5, 1]
+    if not in_memory_max_bytes:
+        assert record["metrics"]["sparse_tile_count"] == 6
+        assert record["metrics"]["sparse_saved_bytes"] > 0
+    with rasterio.open(dst_path) as dst:
+        assert (dst.read() == data).all()
+
+
+def test_to_cog_streams(s3_server: str, tmp_path: Path):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "out.tif")
+    profile = {"driver": "GTiff", "width": 1200, "height": 900, "count": 1, "dtype": "uint16", "nodata": 0}
+    with rasterio.open(src_path, "w", tiled=True, blockxsize=256, blockysize=256, **profile) as dst:
+        dst.write(np.random.default_rng(0).integers(0, 1000, (1, 900, 1200), dtype="uint16"))
+    client = boto3.client("s3")
+    client.upload_file(src_path, s3_server, "in.tif")
+
+    with capture() as sink:
+        to_cog(s3_server, "in.tif", s3_server, "out.tif", scratch_dir=str(tmp_path), read_mode="stream")
+    (record,) = sink.records
+    assert record["dimensions"] == {"mode": "stream"}
+    assert "download_seconds" not in record["metrics"]
+    assert 0 < record["metrics"]["stream_bytes"] == record["metrics"]["download_bytes"]
+
+    client.download_file(s3_server, "out.tif", dst_path)
+    assert_valid_cog(dst_path)
+    with rasterio.open(src_path) as src, rasterio.open(dst_path) as cog:
+        assert np.array_equal(src.read(), cog.read())
+
+    with pytest.raises(ValueError):
+        to_cog(s3_server, "in.tif", s3_server, "out.tif", read_mode="mmap")
+
+
+def test_to_cog_incremental(s3_bucket: str, tmp_path: Path, mocker: MockerFixture):
+    mocker.patch("convert.cog.INCREMENTAL", "on")
+    src_path, dst_path, full_path = (str(tmp_path / f"{name}.tif") for name in ("source", "out", "full"))
+    profile = {"driver": "GTiff", "width": 1200, "height": 900, "count": 1, "dtype": "uint16", "nodata": 0}
+    data = np.random.default_rng(0).integers(0, 1000, (1, 900, 1200), dtype="uint16")
+    with rasterio.open(src_path, "w", **profile) as dst:
+        dst.write(data)
+    client = boto3.client("s3")
+    client.upload_file(src_path, s3_bucket, "in.tif")
+
+    # the first conversion encodes every tile and records their hashes
+    with capture() as sink:
+        to_cog(s3_bucket, "in.tif", s3_bucket, "out.tif", scratch_dir=str(tmp_path))
+    (record,) = sink.records
+    assert "reused_tile_count" not in record["metrics"]
+    assert S3Helper(s3_bucket).get_metadata("out.tif.tiles.json") is not None
+
+    # a corrected strip within the first 512x512 tile
+    data[:, 100:120, :300] = 7
+    with rasterio.open(src_path, "w", **profile) as dst:
+        dst.write(data)
+    client.upload_file(src_path, s3_bucket, "in.tif")
+
+    with capture() as sink:
+        to_cog(s3_bucket, "in.tif", s3_bucket, "out.tif", scratch_dir=str(tmp_path))
+        to_cog(s3_bucket, "in.tif", s3_bucket, "full.tif", scratch_dir=str(tmp_path))
+    incremental, full = sink.records
+    # 5 of the 6 full resolution tiles and 1 of the 2 overview tiles
+    assert incremental["metrics"]["reused_tile_count"] == 6
+    assert "reused_tile_count" not in full["metrics"]
+
+    client.download_file(s3_bucket, "out.tif", dst_path)
+    client.download_file(s3_bucket, "full.tif", full_path)
+    assert_valid_cog(dst_path)
+    with open(dst_path, "rb") as updated, open(full_path, "rb") as rewritten:
+        assert updated.read() == rewritten.read()
+
+
+@pytest.mark.parametrize("in_memory_max_bytes", [256 * 1024 * 1024, 0], ids=["in-memory", "on-disk"])
+def test_to_cogs_index_footprints(s3_bucket: str, tmp_path: Path, in_memory_max_bytes: int):
+    src_path = str(tmp_path / "source.tif")
+    profile = {"driver": "GTiff", "width": 300, "height": 200, "count": 2, "dtype": "uint16"}
+    with rasterio.open(src_path, "w", crs="EPSG:32630", transform=from_origin(500000, 6000000, 30, 30), **profile):
+        pass
+    boto3.client("s3").upload_file(src_path, s3_bucket, "in.tif")
+
+    outputs = output_specs("scenes/out.tif", ["deflate", "raw"])
+    results = to_cogs(s3_bucket, "in.tif", s3_bucket, outputs, in_memory_max_bytes, str(tmp_path))
+
+    # one shard per conversion, holding a footprint of each output
+    index = FootprintIndex(S3Helper(s3_bucket))
+    assert len(index.shard_keys()) == 1
+    found = index.query(bbox=(-4.0, 53.0, -2.0, 55.0), where={"count": 2})
+    assert [(fp.key, fp.profile, fp.size) for fp in found] == sorted(
+        (result.spec.out_key, result.spec.profile, result.size) for result in results
+    )
+    raw, deflate = found
+    assert (deflate.crs, deflate.width, deflate.res_x, deflate.maxy) == ("EPSG:32630", 300, 30, 6000000)
+    assert (deflate.compression, raw.compression) == ("deflate", "none")
+    assert not index.query(bbox=(10.0, 53.0, 12.0, 55.0))
+
+    # outputs that are up to date are not indexed again
+    to_cogs(s3_bucket, "in.tif", s3_bucket, outputs, in_memory_max_bytes, str(tmp_path))
+    assert len(index.shard_keys()) == 1
+
+    # nor are the outputs described when the index is turned off at run time,
+    # as the benchmarks do
+    with mock.patch("convert.footprints.INDEX", "off"), capture() as sink:
+        to_cogs(s3_bucket, "in.tif", s3_bucket, outputs, in_memory_max_bytes, str(tmp_path), force=True)
+    assert "index_seconds" not in sink.records[0]["metrics"]
+    assert len(index.shard_keys()) == 1
+
+
+def test_output_specs():
+    assert output_specs("a/b-cog.tif", ["deflate", "webp"]) == [
+        OutputSpec("a/b-cog.tif", "deflate"),
+        OutputSpec("a/b-cog-webp.tif", "webp"),
+    ]
+
+
+def test_work_dir(tmp_path: Path):
+    scratch_dir = str(tmp_path)
+
+    # a failed attempt keeps the source for a retry, but nothing else
+    with pytest.raises(RuntimeError), _work_dir(scratch_dir, "a", resume=True) as tmp_dir:
+        Path(tmp_dir, SOURCE_NAME).write_bytes(b"source")
+        Path(tmp_dir, "out.tif").write_bytes(b"out")
+        raise RuntimeError("interrupted")
+
+    with _work_dir(scratch_dir, "a", resume=True) as resumed:
+        assert resumed == tmp_dir
+        assert sorted(os.listdir(resumed)) == ["lock", SOURCE_NAME]
+
+        # another conversion of the same source running at the same time
+        # neither uses the directory nor removes it when it is done
+        with _work_dir(scratch_dir, "a", resume=True) as other:
+            assert other != resumed
+            assert not os.listdir(other)
+        assert os.path.exists(os.path.join(resumed, SOURCE_NAME))
+    assert not os.listdir(scratch_dir)
+
+
+def test_decoded_source(test_dir: str, tmp_path: Path):
+    src_path = str(tmp_path / "deflate.tif")
+    decoded_path = str(tmp_path / "decoded.tif")
+    with rasterio.open(os.path.join(test_dir, "data", "landsat.tif")) as src:
+        rasterio.shutil.copy(src, src_path, compress="deflate")
+        expected = src.read()
+
+    # a single output reads the source directly
+    with _decoded_source(src_path, decoded_path, 1, Recorder("test")) as path:
+        assert path == src_path
+
+    # several outputs share an uncompressed copy that is removed afterwards
+    with _decoded_source(src_path, decoded_path, 2, Recorder("test")) as path:
+        assert path == decoded_path
+        with rasterio.open(path) as src:
+            assert src.compression is None
+            assert (src.read() == expected).all()
+    assert not os.path.exists(decoded_path)
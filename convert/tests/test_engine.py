@@ -0,0 +1,444 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from rio_cogeo.cogeo import cog_translate, cog_validate
+from rio_cogeo.profiles import cog_profiles
+
+from convert import tiff
+from convert.engine import (
+    PreviousCog,
+    copy_plan,
+    downsample_average,
+    downsample_nearest,
+    is_sparse,
+    level_shapes,
+    reuse_plan,
+    unsupported_reason,
+    write_cog,
+)
+from convert.metrics import Recorder
+
+BLOCK_SIZE = {"blockxsize": 128, "blockysize": 128}
+
+
+def write_source(path: str, width: int = 700, height: int = 450, count: int = 1, dtype: str = "uint16", **kwargs):
+    """Write a striped GeoTiff of noisy gradients, returning its pixels"""
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:height, 0:width]
+    data = np.stack([(rows * (band + 1) + cols + rng.integers(0, 50, (height, width))) % 4000 for band in range(count)])
+    data = data.astype(dtype)
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": count,
+        "dtype": dtype,
+        "crs": CRS.from_epsg(32630),
+        "transform": from_origin(500000.0, 6000000.0, 30.0, 30.0),
+    }
+    profile.update(kwargs)
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+        dst.update_tags(source="test")
+    return data
+
+
+def convert(src_path: str, dst_path: str, profile: str = "deflate", resampling: str = "nearest", **options) -> int:
+    dst_profile = cog_profiles.get(profile)
+    dst_profile.update(BLOCK_SIZE)
+    dst_profile.update(options)
+    with rasterio.open(src_path) as src, open(dst_path, "wb") as out:
+        size = write_cog(src, out, dst_profile, workers=4, memory_max_bytes=1024 * 1024, resampling=resampling)
+    assert size == os.path.getsize(dst_path)
+    return size
+
+
+def assert_valid_cog(path: str):
+    is_valid, errors, warnings = cog_validate(path)
+    assert is_valid
+    assert not errors
+    assert not warnings
+
+
+def test_level_shapes():
+    assert level_shapes(700, 450, 128, 128) == [(700, 450), (350, 225), (175, 113), (88, 57)]
+    assert level_shapes(100, 100, 128, 128) == [(100, 100)]
+
+
+def test_downsample_nearest():
+    block = np.arange(6 * 9).reshape(1, 6, 9)
+    # GDAL takes pixel 2i of an even size, and one less over the second half of an odd size
+    assert (downsample_nearest(block) == block[:, [0, 2, 4]][:, :, [0, 2, 4, 5, 7]]).all()
+
+    # a block that starts part way down a level of odd height can take the row above it
+    level = np.arange(9 * 5).reshape(1, 9, 5)
+    rows = [downsample_nearest(level[:, :4]), downsample_nearest(level[:, 4:], 4, 9, level[:, 3:4])]
+    assert (np.concatenate(rows, axis=1) == downsample_nearest(level)).all()
+    assert (downsample_nearest(level) == level[:, [0, 2, 4, 5, 7]][:, :, [0, 2, 3]]).all()
+
+
+def test_downsample_average():
+    block = np.array([[[1, 3, 0, 8, 5], [5, 7, 0, 0, 7]]], dtype="uint16")
+    # nodata pixels are excluded, and an all nodata 2x2 stays nodata
+    assert downsample_average(block, 0).tolist() == [[[4, 8, 6]]]
+    assert downsample_average(block, None).tolist() == [[[4, 2, 6]]]
+
+    nan = np.array([[[1.0, np.nan], [np.nan, np.nan]]], dtype="float32")
+    assert downsample_average(nan, float("nan")).tolist() == [[[1.0]]]
+
+
+@pytest.mark.parametrize("count,dtype", [(1, "uint16"), (3, "uint8"), (2, "float32"), (1, "int16")])
+def test_write_cog(tmp_path: Path, count: int, dtype: str):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    data = write_source(src_path, count=count, dtype=dtype, nodata=0)
+    convert(src_path, dst_path)
+    assert_valid_cog(dst_path)
+
+    with rasterio.open(src_path) as src, rasterio.open(dst_path) as dst:
+        assert dst.profile["blockxsize"] == 128
+        assert dst.compression.value == "DEFLATE"
+        assert dst.crs == src.crs
+        assert dst.transform == src.transform
+        assert dst.nodata == 0
+        assert dst.tags()["source"] == "test"
+        assert dst.overviews(1) == [2, 4, 8]
+        assert (dst.read() == data).all()
+
+        # overviews match GDAL's nearest neighbour sampling of the level below
+        expected = data
+        for width, height in level_shapes(700, 450, 128, 128)[1:]:
+            expected = downsample_nearest(expected)
+            assert (dst.read(out_shape=(count, height, width)) == expected).all()
+
+
+@pytest.mark.parametrize("width,height", [(1024, 1024), (999, 515), (1001, 777)])
+@pytest.mark.parametrize("tiled", [False, True])
+def test_write_cog_overviews_match_rio_cogeo(tmp_path: Path, width: int, height: int, tiled: bool):
+    src_path, dst_path, cogeo_path = (str(tmp_path / name) for name in ("source.tif", "cog.tif", "cogeo.tif"))
+    layout = {"tiled": True, "compress": "deflate", **BLOCK_SIZE} if tiled else {}
+    write_source(src_path, width, height, **layout)
+    convert(src_path, dst_path)
+
+    dst_profile = cog_profiles.get("deflate")
+    dst_profile.update(BLOCK_SIZE)
+    cog_translate(src_path, cogeo_path, dst_profile, overview_resampling="nearest", in_memory=True, quiet=True)
+
+    # every overview is pixel for pixel the one GDAL builds for rio-cogeo, which
+    # can stop a level earlier as it sizes the smallest overview differently
+    with rasterio.open(dst_path) as dst, rasterio.open(cogeo_path) as cogeo:
+        levels = min(len(dst.overviews(1)), len(cogeo.overviews(1)))
+        assert levels >= 2
+    for level in range(levels):
+        with rasterio.open(dst_path, overview_level=level) as dst:
+            with rasterio.open(cogeo_path, overview_level=level) as cogeo:
+                assert dst.shape == cogeo.shape
+                assert (dst.read() == cogeo.read()).all()
+
+
+def test_write_cog_layout(tmp_path: Path):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    write_source(src_path)
+    convert(src_path, dst_path, predictor=2, zlevel=9)
+
+    with open(dst_path, "rb") as fh:
+        bigtiff, ifds = tiff.read_ifds(fh)
+
+    # every IFD comes before the tile data, which is stored smallest overview first
+    assert not bigtiff
+    first_tiles = [min(ifd.values(tiff.TILE_OFFSETS)) for ifd in ifds]
+    assert max(ifd.offset for ifd in ifds) < min(first_tiles)
+    assert first_tiles == sorted(first_tiles, reverse=True)
+    assert [ifd.get(tiff.NEW_SUBFILE_TYPE) for ifd in ifds] == [0, 1, 1, 1]
+    assert all(ifd.get(tiff.PREDICTOR) == 2 for ifd in ifds)
+    assert tiff.GEO_KEY_DIRECTORY in ifds[0].tags
+    assert tiff.GEO_KEY_DIRECTORY not in ifds[1].tags
+
+    with rasterio.open(dst_path) as dst:
+        assert dst.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+
+
+def test_write_cog_average(tmp_path: Path):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    data = write_source(src_path, nodata=0)
+    convert(src_path, dst_path, resampling="average", profile="raw")
+    assert_valid_cog(dst_path)
+
+    with rasterio.open(dst_path) as dst:
+        assert dst.compression is None
+        assert (dst.read() == data).all()
+        assert (dst.read(out_shape=(1, 225, 350)) == downsample_average(data, 0)).all()
+
+
+def test_write_cog_bigtiff(tmp_path: Path):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    data = write_source(src_path)
+    convert(src_path, dst_path, BIGTIFF="YES")
+    assert_valid_cog(dst_path)
+
+    with open(dst_path, "rb") as fh:
+        assert tiff.read_ifds(fh)[0]
+    with rasterio.open(dst_path) as dst:
+        assert (dst.read() == data).all()
+
+
+def test_write_cog_records_stages(tmp_path: Path):
+    src_path = str(tmp_path / "source.tif")
+    write_source(src_path)
+    recorder = Recorder("test")
+    with rasterio.open(src_path) as src, open(tmp_path / "cog.tif", "wb") as out:
+        write_cog(src, out, dict(cog_profiles.get("deflate"), **BLOCK_SIZE), recorder=recorder)
+
+    for stage in ("read", "overviews", "compress", "assemble"):
+        assert recorder.metrics[f"{stage}_seconds"] > 0
+
+
+@pytest.mark.parametrize(
+    "profile,options,reason",
+    [
+        ("deflate", {}, None),
+        ("raw", {}, None),
+        ("lzw", {}, "lzw compression is not supported"),
+        ("jpeg", {}, "jpeg compression is not supported"),
+        ("deflate", {"interleave": "band"}, "only pixel interleaving is supported"),
+        ("deflate", {"predictor": 3}, "predictor 3 is not supported for uint16 data"),
+        ("deflate", {"blockxsize": 100}, "block size 100 is not a multiple of 16"),
+    ],
+)
+def test_unsupported_reason(tmp_path: Path, profile: str, options: dict, reason: str):
+    src_path = str(tmp_path / "source.tif")
+    write_source(src_path, width=32, height=32)
+    with rasterio.open(src_path) as src:
+        assert unsupported_reason(src, dict(cog_profiles.get(profile), **options)) == reason
+
+
+def test_unsupported_reason_mask(tmp_path: Path):
+    src_path = str(tmp_path / "source.tif")
+    write_source(src_path, width=32, height=32)
+    with rasterio.open(src_path, "r+") as dst:
+        dst.write_mask(np.full((32, 32), 255, dtype="uint8"))
+
+    with rasterio.open(src_path) as src, open(os.devnull, "wb") as out:
+        assert unsupported_reason(src, cog_profiles.get("deflate")) == "the source has an internal mask"
+        with pytest.raises(ValueError, match="internal mask"):
+            write_cog(src, out, cog_profiles.get("deflate"))
+
+
+def tiles(path: str, index: int = 0) -> list:
+    """Compressed bytes of each tile of an IFD of a TIFF"""
+    with open(path, "rb") as fh:
+        _, ifds = tiff.read_ifds(fh)
+        ifd = [ifd for ifd in ifds if ifd.get(tiff.NEW_SUBFILE_TYPE, 0) in (0, 1)][index]
+        found = []
+        for offset, count in zip(ifd.values(tiff.TILE_OFFSETS), ifd.values(tiff.TILE_BYTE_COUNTS)):
+            fh.seek(offset)
+            found.append(fh.read(count))
+        return found
+
+
+@pytest.mark.parametrize(
+    "options,reason",
+    [
+        ({}, "not tiled"),
+        ({"tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "lzw"}, "TIFF compression 5"),
+        ({"tiled": True, "blockxsize": 64, "blockysize": 64, "compress": "deflate"}, "outside 128-2048"),
+        ({"tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate", "predictor": 3}, "predictor 3"),
+    ],
+)
+def test_copy_plan_reason(tmp_path: Path, options: dict, reason: str):
+    src_path = str(tmp_path / "source.tif")
+    write_source(src_path, dtype="float32" if options.get("predictor") == 3 else "uint16", **options)
+    with rasterio.open(src_path) as src, open(src_path, "rb") as fh:
+        plan, found = copy_plan(src, cog_profiles.get("deflate"), fh)
+    assert plan is None
+    assert reason in found
+
+
+@pytest.mark.parametrize("count,dtype", [(1, "uint16"), (3, "uint8")])
+def test_write_cog_copies_tiles(tmp_path: Path, count: int, dtype: str):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    options = {"tiled": True, "blockxsize": 256, "blockysize": 256, "compress": "deflate", "predictor": 2}
+    data = write_source(src_path, width=1100, height=600, count=count, dtype=dtype, nodata=0, **options)
+
+    recorder = Recorder("test")
+    with rasterio.open(src_path) as src, open(src_path, "rb") as fh, open(dst_path, "wb") as out:
+        plan, _ = copy_plan(src, cog_profiles.get("deflate"), fh)
+        assert (plan.block_width, plan.predictor, len(plan.levels)) == (256, 2, 1)
+        write_cog(src, out, cog_profiles.get("deflate"), workers=2, recorder=recorder, source=fh)
+    assert_valid_cog(dst_path)
+
+    # the full resolution tiles are those of the source, byte for byte
+    assert tiles(dst_path) == tiles(src_path)
+    assert recorder.metrics["copy_seconds"] > 0
+
+    # and only the overviews were computed, from the source's block size
+    with rasterio.open(dst_path) as dst:
+        assert dst.profile["blockxsize"] == 256
+        assert dst.overviews(1) == [2, 4, 8]
+        assert (dst.read() == data).all()
+        expected = data
+        for width, height in level_shapes(1100, 600, 256, 256)[1:]:
+            expected = downsample_nearest(expected)
+            assert (dst.read(out_shape=(count, height, width)) == expected).all()
+
+
+def test_write_cog_copies_overviews(tmp_path: Path):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    options = {"tiled": True, "blockxsize": 128, "blockysize": 128, "compress": "deflate"}
+    write_source(src_path, **options)
+
+    # a source with only the first overview, in the order GDAL writes them
+    with rasterio.Env(GDAL_TIFF_OVR_BLOCKSIZE=128), rasterio.open(src_path, "r+") as src:
+        src.build_overviews([2])
+
+    recorder = Recorder("test")
+    with rasterio.open(src_path) as src, open(src_path, "rb") as fh, open(dst_path, "wb") as out:
+        plan, _ = copy_plan(src, cog_profiles.get("deflate"), fh)
+        assert len(plan.levels) == 2
+        write_cog(src, out, cog_profiles.get("deflate"), recorder=recorder, source=fh)
+    assert_valid_cog(dst_path)
+
+    assert tiles(dst_path, 0) == tiles(src_path, 0)
+    assert tiles(dst_path, 1) == tiles(src_path, 1)
+    with rasterio.open(src_path, overview_level=0) as overview, rasterio.open(dst_path) as dst:
+        assert dst.overviews(1) == [2, 4, 8]
+        # the missing levels are computed from the copied overview
+        expected = downsample_nearest(overview.read())
+        assert (dst.read(out_shape=(1, 113, 175)) == expected).all()
+
+
+def test_write_cog_reuses_unchanged_tiles(tmp_path: Path):
+    src_path = str(tmp_path / "source.tif")
+    old_path, new_path, full_path = (str(tmp_path / f"{name}.tif") for name in ("old", "new", "full"))
+    data = write_source(src_path)
+    dst_profile = dict(cog_profiles.get("deflate"), **BLOCK_SIZE)
+
+    hashes = []
+    with rasterio.open(src_path) as src, open(old_path, "wb") as out:
+        write_cog(src, out, dst_profile, tile_hashes=hashes)
+    assert len(hashes) == 6 * 4
+
+    # a new version of the source with a change inside the first tile
+    with rasterio.open(src_path, "r+") as dst:
+        dst.write(data[:, :10, :10] + 1, window=Window(0, 0, 10, 10))
+
+    new_hashes = []
+    recorder = Recorder("test")
+    with rasterio.open(src_path) as src, open(old_path, "rb") as fh, open(new_path, "wb") as out:
+        write_cog(src, out, dst_profile, recorder=recorder, previous=PreviousCog(fh, hashes), tile_hashes=new_hashes)
+    with rasterio.open(src_path) as src, open(full_path, "wb") as out:
+        write_cog(src, out, dst_profile)
+    assert_valid_cog(new_path)
+
+    assert new_hashes[0] != hashes[0]
+    assert new_hashes[1:] == hashes[1:]
+    # the other 23 full resolution tiles and the overview tiles not above the
+    # first tile (5 of 6, 1 of 2 and none of 1) are reused
+    assert recorder.metrics["reused_tile_count"] == 23 + 5 + 1
+    with open(new_path, "rb") as new, open(full_path, "rb") as full:
+        assert new.read() == full.read()
+
+
+def test_reuse_plan_reason(tmp_path: Path):
+    src_path, old_path = str(tmp_path / "source.tif"), str(tmp_path / "old.tif")
+    write_source(src_path)
+    convert(src_path, old_path)
+
+    shapes = level_shapes(700, 450, 128, 128)
+    with open(old_path, "rb") as fh:
+        previous = PreviousCog(fh, ["0" * 32] * 24)
+        levels, reason = reuse_plan(previous, shapes, 128, 128, tiff.COMPRESSION_DEFLATE, 1, np.dtype("uint16"), 1)
+        assert len(levels) == 4 and reason is None
+
+        _, reason = reuse_plan(previous, shapes, 128, 128, tiff.COMPRESSION_DEFLATE, 2, np.dtype("uint16"), 1)
+        assert "encoding" in reason
+        _, reason = reuse_plan(previous, level_shapes(700, 450, 256, 256), 256, 256, 8, 1, np.dtype("uint16"), 1)
+        assert "levels" in reason
+        _, reason = reuse_plan(PreviousCog(fh, []), shapes, 128, 128, 8, 1, np.dtype("uint16"), 1)
+        assert "tile hashes" in reason
+
+
+def test_is_sparse():
+    tile = np.zeros((2, 4, 4), dtype="uint16")
+    assert is_sparse(tile, 0)
+    assert not is_sparse(tile, None)
+    assert not is_sparse(tile, 1)
+    tile[1, 3, 3] = 1
+    # a valid pixel in any band makes the tile one with data
+    assert not is_sparse(tile, 0)
+
+    nan = np.full((1, 4, 4), np.nan, dtype="float32")
+    assert is_sparse(nan, float("nan"))
+    nan[0, 2, 2] = 0
+    assert not is_sparse(nan, float("nan"))
+
+
+def write_footprint(path: str, dtype: str, nodata: float, **kwargs):
+    """Write a source with data in a footprint and nodata around it, returning its pixels"""
+    data = np.full((2, 450, 700), nodata, dtype=dtype)
+    data[:, 100:300, 100:400] = np.random.default_rng(0).integers(1, 1000, (2, 200, 300))
+    profile = {"driver": "GTiff", "width": 700, "height": 450, "count": 2, "dtype": dtype, "nodata": nodata}
+    with rasterio.open(path, "w", **dict(profile, **kwargs)) as dst:
+        dst.write(data)
+    return data
+
+
+@pytest.mark.parametrize("dtype,nodata", [("uint16", 0), ("float32", float("nan"))])
+def test_write_cog_sparse(tmp_path: Path, dtype: str, nodata: float):
+    src_path, sparse_path, dense_path = (str(tmp_path / f"{name}.tif") for name in ("source", "sparse", "dense"))
+    data = write_footprint(src_path, dtype, nodata)
+
+    recorder = Recorder("test")
+    dst_profile = dict(cog_profiles.get("deflate"), **BLOCK_SIZE)
+    with rasterio.open(src_path) as src, open(sparse_path, "wb") as out:
+        write_cog(src, out, dict(dst_profile, SPARSE_OK="TRUE"), recorder=recorder)
+    convert(src_path, dense_path)
+    assert_valid_cog(sparse_path)
+
+    # the footprint covers 2x3 of the 4x6 full resolution tiles, 2x2 of the
+    # 2x3 first overview tiles and all the smaller overview tiles
+    with open(sparse_path, "rb") as fh:
+        _, ifds = tiff.read_ifds(fh)
+    sparse = [[offset == 0 for offset in ifd.values(tiff.TILE_OFFSETS)] for ifd in ifds]
+    assert [sum(level) for level in sparse] == [24 - 12, 6 - 4, 1, 0]
+    for ifd in ifds:
+        for offset, count in zip(ifd.values(tiff.TILE_OFFSETS), ifd.values(tiff.TILE_BYTE_COUNTS)):
+            assert (offset == 0) == (count == 0)
+
+    assert recorder.metrics["sparse_tile_count"] == 15
+    assert recorder.metrics["sparse_saved_bytes"] > 0
+    assert os.path.getsize(sparse_path) < os.path.getsize(dense_path)
+
+    # every level reads the same as the COG with every tile stored
+    with rasterio.open(sparse_path) as sparse_cog, rasterio.open(dense_path) as dense_cog:
+        np.testing.assert_array_equal(sparse_cog.read(), data)
+        for width, height in level_shapes(700, 450, 128, 128)[1:]:
+            shape = (2, height, width)
+            np.testing.assert_array_equal(sparse_cog.read(out_shape=shape), dense_cog.read(out_shape=shape))
+
+
+def test_write_cog_copies_sparse_tiles(tmp_path: Path):
+    src_path, dst_path = str(tmp_path / "source.tif"), str(tmp_path / "cog.tif")
+    options = {"tiled": True, "blockxsize": 128, "blockysize": 128, "compress": "deflate", "sparse_ok": True}
+    data = write_footprint(src_path, "uint16", 0, **options)
+    assert tiles(src_path).count(b"") == 12
+
+    recorder = Recorder("test")
+    dst_profile = dict(cog_profiles.get("deflate"), SPARSE_OK="TRUE")
+    with rasterio.open(src_path) as src, open(src_path, "rb") as fh, open(dst_path, "wb") as out:
+        plan, _ = copy_plan(src, dst_profile, fh)
+        assert plan is not None
+        write_cog(src, out, dst_profile, recorder=recorder, source=fh)
+    assert_valid_cog(dst_path)
+
+    # the source's sparse tiles stay sparse, and its empty overview tiles are too
+    assert tiles(dst_path) == tiles(src_path)
+    assert recorder.metrics["sparse_tile_count"] == 15
+    with rasterio.open(dst_path) as dst:
+        np.testing.assert_array_equal(dst.read(), data)
@@ -0,0 +1,188 @@
+import math
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+from pytest_mock import MockerFixture
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+
+from convert import footprints
+from convert.footprints import Footprint, FootprintIndex, FootprintTable, record_outputs
+from convert.s3 import S3Helper
+
+
+def footprint(key: str, west: float, south: float, east: float, north: float, **kwargs) -> Footprint:
+    values = {
+        "crs": "EPSG:32630",
+        "minx": 0.0,
+        "miny": 0.0,
+        "maxx": 1.0,
+        "maxy": 1.0,
+        "res_x": 30.0,
+        "res_y": 30.0,
+        "width": 100,
+        "height": 100,
+        "count": 1,
+        "dtype": "uint16",
+        "profile": "deflate",
+        "compression": "deflate",
+        "size": 1024,
+        "written": 1.0,
+    }
+    values.update(kwargs)
+    return Footprint(key, west=west, south=south, east=east, north=north, **values)
+
+
+FOOTPRINTS = [
+    footprint("a/london.tif", -1.0, 51.0, 0.5, 52.0),
+    footprint("a/paris.tif", 2.0, 48.5, 3.0, 49.0, crs="EPSG:32631", res_x=10.0, count=3),
+    footprint("b/fiji.tif", 177.0, -19.0, -179.0, -16.0, crs="EPSG:32760", dtype="float32", profile="webp"),
+]
+
+
+def test_table_round_trip():
+    table = FootprintTable.from_footprints(FOOTPRINTS)
+    loaded, replaces = FootprintTable.loads(table.dumps(replaces=["old.fpx"]))
+
+    assert replaces == ["old.fpx"]
+    assert len(loaded) == 3
+    assert loaded.select() == FOOTPRINTS
+
+    with pytest.raises(ValueError, match="Not a footprint index shard"):
+        FootprintTable.loads(b"GIF89a" + bytes(16))
+
+
+def test_table_latest():
+    newer = footprint("a/london.tif", -1.0, 51.0, 0.5, 52.0, size=2048, written=2.0)
+    table = FootprintTable.concat(
+        [FootprintTable.from_footprints([newer]), FootprintTable.from_footprints(FOOTPRINTS)]
+    ).latest()
+
+    # one footprint per key, the most recently written, in key order
+    assert table.keys() == ["a/london.tif", "a/paris.tif", "b/fiji.tif"]
+    assert table.footprint(0).size == 2048
+    assert table.select()[1:] == FOOTPRINTS[1:]
+
+
+@pytest.mark.parametrize(
+    "bbox,where,prefix,expected",
+    [
+        ((-2.0, 48.0, 2.5, 53.0), None, None, ["a/london.tif", "a/paris.tif"]),
+        ((-2.0, 50.0, -1.5, 53.0), None, None, []),
+        # boxes and footprints crossing the antimeridian
+        ((179.0, -20.0, 180.0, -15.0), None, None, ["b/fiji.tif"]),
+        ((-179.5, -20.0, -179.2, -15.0), None, None, ["b/fiji.tif"]),
+        ((170.0, -20.0, -175.0, 60.0), None, None, ["b/fiji.tif"]),
+        ((170.0, 40.0, 10.0, 60.0), None, None, ["a/london.tif", "a/paris.tif"]),
+        (None, {"crs": "EPSG:32631"}, None, ["a/paris.tif"]),
+        (None, {"crs": "EPSG:4326"}, None, []),
+        (None, {"profile": ["deflate", "webp"], "count": 1}, None, ["a/london.tif", "b/fiji.tif"]),
+        (None, {"res_x": (None, 20.0)}, None, ["a/paris.tif"]),
+        (None, {"res_x": (20.0, None), "dtype": "uint16"}, None, ["a/london.tif"]),
+        ((-180.0, -90.0, 180.0, 90.0), None, "a/", ["a/london.tif", "a/paris.tif"]),
+    ],
+)
+def test_table_select(bbox, where, prefix, expected):
+    table = FootprintTable.from_footprints(FOOTPRINTS)
+    assert [found.key for found in table.select(bbox, where, prefix)] == expected
+
+
+def test_table_select_unknown_attribute():
+    with pytest.raises(ValueError, match="Unknown footprint attribute"):
+        FootprintTable.from_footprints(FOOTPRINTS).select(where={"colour": "red"})
+
+
+def test_footprint_from_dataset(tmp_path: Path):
+    path = str(tmp_path / "source.tif")
+    profile = {"driver": "GTiff", "width": 200, "height": 100, "count": 2, "dtype": "uint8"}
+    with rasterio.open(path, "w", crs=CRS.from_epsg(32630), transform=from_origin(500000, 6000000, 30, 30), **profile):
+        pass
+
+    with rasterio.open(path) as src:
+        found = Footprint.from_dataset("out.tif", src, "deflate", "DEFLATE")
+    assert (found.minx, found.miny, found.maxx, found.maxy) == (500000, 5997000, 506000, 6000000)
+    assert (found.crs, found.res_x, found.width, found.height, found.count) == ("EPSG:32630", 30, 200, 100, 2)
+    assert found.compression == "deflate"
+    assert -3.1 < found.west < found.east < -2.9
+    assert 54.0 < found.south < found.north < 54.2
+
+    with rasterio.open(path, "w", **profile):
+        pass
+    with rasterio.open(path) as src:
+        assert math.isnan(Footprint.from_dataset("out.tif", src).west)
+
+
+def test_index_append_query_compact(s3_bucket: str):
+    s3 = S3Helper(s3_bucket)
+    jobs = [FootprintIndex(s3) for _ in range(3)]
+    for job, found in zip(jobs, FOOTPRINTS):
+        job.append([found])
+    # an output converted again since
+    jobs[0].append([footprint("a/london.tif", -1.0, 51.0, 0.5, 52.0, size=4096, written=5.0)])
+
+    reader = FootprintIndex(s3)
+    assert len(reader.shard_keys()) == 4
+    found = reader.query((-2.0, 48.0, 2.5, 53.0))
+    assert [(fp.key, fp.size) for fp in found] == [("a/london.tif", 4096), ("a/paris.tif", 1024)]
+
+    merged = FootprintIndex(s3).compact()
+    assert reader.shard_keys() == [merged]
+    assert reader.query() == FootprintIndex(s3).query()
+    assert [fp.key for fp in reader.query()] == ["a/london.tif", "a/paris.tif", "b/fiji.tif"]
+
+    # nothing left to merge
+    assert FootprintIndex(s3).compact() is None
+
+
+def test_index_concurrent_compaction(s3_bucket: str, mocker: MockerFixture):
+    s3 = S3Helper(s3_bucket)
+    index = FootprintIndex(s3)
+    for found in FOOTPRINTS:
+        index.append([found])
+
+    # two merges of the same shards, both listing them before either deletes them
+    deleted = []
+    mocker.patch.object(s3, "delete_keys", side_effect=deleted.extend)
+    first, second = FootprintIndex(s3), FootprintIndex(s3)
+    mocker.patch.object(second, "shard_keys", return_value=index.shard_keys())
+    first.compact()
+    second.compact()
+    assert len(index.shard_keys()) == 5
+    assert [fp.key for fp in index.query()] == [fp.key for fp in FOOTPRINTS]
+
+    # once the shards are deleted, both merged shards remain until merged again
+    other = S3Helper(s3_bucket)
+    other.delete_keys(deleted)
+    assert len(index.shard_keys()) == 2
+    assert [fp.key for fp in index.query()] == [fp.key for fp in FOOTPRINTS]
+    FootprintIndex(other).compact()
+    assert len(index.shard_keys()) == 1
+    assert [fp.key for fp in index.query()] == [fp.key for fp in FOOTPRINTS]
+
+
+def test_record_outputs(s3_bucket: str, mocker: MockerFixture):
+    s3 = S3Helper(s3_bucket)
+    mocker.patch("convert.footprints.COMPACT_EVERY", 1)
+    compact = mocker.spy(footprints, "compact_in_background")
+    record_outputs(s3, FOOTPRINTS[:1])
+    compact.spy_return.join()
+    record_outputs(s3, FOOTPRINTS[1:])
+    compact.spy_return.join()
+
+    # every append starts a merge in the background, the first has nothing to merge
+    assert compact.call_count == 2
+    index = FootprintIndex(s3)
+    assert len(index.shard_keys()) == 1
+    assert [fp.key for fp in index.query()] == [fp.key for fp in FOOTPRINTS]
+
+    mocker.patch("convert.footprints.INDEX", "off")
+    assert record_outputs(s3, FOOTPRINTS) is None
+
+
+def test_table_take_keys():
+    table = FootprintTable.from_footprints(FOOTPRINTS)
+    taken = table.take(np.array([2, 0]))
+    assert taken.keys() == ["b/fiji.tif", "a/london.tif"]
+    assert taken.footprint(0) == FOOTPRINTS[2]
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import boto3
+import pytest
+
+from convert.manifest import Task, dump_manifest, load_manifest, task_for_array_index
+
+TASKS = [
+    Task("in", "a.tif", "out", "a.tif"),
+    Task("in", "dir/b.tif", "out", "dir/b-cog.tif"),
+]
+
+
+def test_load_inline_manifest():
+    assert load_manifest(dump_manifest(TASKS)) == TASKS
+
+
+def test_load_file_manifest(tmp_path: Path):
+    path = tmp_path / "manifest.json"
+    path.write_text(dump_manifest(TASKS))
+    assert load_manifest(str(path)) == TASKS
+
+
+def test_load_s3_manifest(s3_bucket: str):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="manifests/job.json", Body=dump_manifest(TASKS))
+    assert load_manifest(f"s3://{s3_bucket}/manifests/job.json") == TASKS
+
+
+@pytest.mark.parametrize("index, expected", [(None, 0), ("0", 0), ("1", 1)])
+def test_task_for_array_index(monkeypatch, index, expected):
+    if index is None:
+        monkeypatch.delenv("AWS_BATCH_JOB_ARRAY_INDEX", raising=False)
+    else:
+        monkeypatch.setenv("AWS_BATCH_JOB_ARRAY_INDEX", index)
+
+    assert task_for_array_index(TASKS) == TASKS[expected]
@@ -0,0 +1,95 @@
+import io
+import json
+import logging
+
+import pytest
+
+from convert.metrics import CaptureSink, EmfSink, LogSink, Recorder, Sink, capture, get_sinks, sinks_from_names
+
+
+def test_recorder_stages():
+    recorder = Recorder("op", {"profile": "deflate"})
+    with recorder.stage("read"):
+        pass
+    with recorder.stage("read"):
+        pass
+    recorder.add("read_bytes", 10)
+    recorder.add("read_bytes", 5)
+    recorder.set_property("key", "a.tif")
+
+    sink = CaptureSink()
+    record = recorder.emit([sink])
+
+    assert sink.records == [record]
+    assert record["name"] == "op"
+    assert record["dimensions"] == {"profile": "deflate"}
+    assert record["properties"] == {"key": "a.tif"}
+    assert record["metrics"]["read_bytes"] == 15
+    assert 0 < record["metrics"]["read_seconds"] <= record["metrics"]["total_seconds"]
+    assert record["metrics"]["peak_rss_mib"] > 0
+
+
+def test_recorder_stage_records_failures():
+    recorder = Recorder("op")
+    with pytest.raises(ValueError):
+        with recorder.stage("broken"):
+            raise ValueError
+    assert "broken_seconds" in recorder.record()["metrics"]
+
+
+def test_gdal_cache_usage():
+    # the library is found from the rasterio import on Linux
+    metrics = Recorder("op").record()["metrics"]
+    assert metrics["gdal_cache_max_mib"] > 0
+    assert metrics["gdal_cache_used_mib"] >= 0
+
+
+def test_emf_sink():
+    stream = io.StringIO()
+    recorder = Recorder("op", {"mode": "disk"})
+    recorder.add("upload_bytes", 100)
+    recorder.set_property("key", "a.tif")
+    recorder.emit([EmfSink(namespace="test", stream=stream)])
+
+    document = json.loads(stream.getvalue())
+    (directive,) = document["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "test"
+    assert directive["Dimensions"] == [["name", "mode"]]
+    units = {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]}
+    assert units["upload_bytes"] == "Bytes"
+    assert units["total_seconds"] == "Seconds"
+    assert units["peak_rss_mib"] == "Megabytes"
+    assert document["upload_bytes"] == 100
+    assert (document["name"], document["mode"], document["key"]) == ("op", "disk", "a.tif")
+
+
+def test_log_sink(caplog):
+    with caplog.at_level(logging.INFO, logger="convert.metrics"):
+        Recorder("op").emit([LogSink()])
+    assert json.loads(caplog.records[-1].getMessage())["name"] == "op"
+
+
+def test_capture_and_failing_sinks():
+    class BrokenSink(CaptureSink):
+        def emit(self, record):
+            raise RuntimeError
+
+    sinks = get_sinks()
+    with capture() as sink:
+        # a failing sink does not stop the others or raise
+        Recorder("op").emit([BrokenSink(), sink])
+        Recorder("op").emit()
+    assert len(sink.records) == 2
+    assert get_sinks() == sinks
+
+    assert [type(sink) for sink in sinks_from_names("log, emf")] == [LogSink, EmfSink]
+    assert sinks_from_names("") == []
+
+
+def test_incomplete_sink():
+    class IncompleteSink(Sink):
+        pass
+
+    # a sink without emit fails when it is created rather than when a record is emitted
+    with pytest.raises(TypeError, match="emit"):
+        IncompleteSink()
@@ -0,0 +1,78 @@
+import pytest
+from pytest_mock import MockerFixture
+
+from convert import runtime
+from convert.runtime import PROFILES, Resources, container_resources, select_profile
+
+MiB = 1024 * 1024
+FARGATE = Resources(cpus=4, memory_bytes=8192 * MiB)
+
+
+@pytest.mark.parametrize(
+    "source_bytes,dtype,resources,expected",
+    [
+        (10 * MiB, "uint8", FARGATE, "serial"),
+        (10 * MiB, "float64", FARGATE, "parallel"),
+        (500 * MiB, "uint16", FARGATE, "parallel"),
+        (500 * MiB, "uint16", Resources(cpus=1, memory_bytes=8192 * MiB), "serial"),
+        (4096 * MiB, "uint16", FARGATE, "bounded"),
+    ],
+)
+def test_select_profile(source_bytes: int, dtype: str, resources: Resources, expected: str):
+    assert select_profile(source_bytes, dtype, resources).name == expected
+
+
+def test_select_profile_by_name(monkeypatch: pytest.MonkeyPatch):
+    assert select_profile(1, "uint8", FARGATE, name="bounded").name == "bounded"
+
+    monkeypatch.setattr(runtime, "RUNTIME_PROFILE", "parallel")
+    assert select_profile(1, "uint8", FARGATE).name == "parallel"
+
+    with pytest.raises(ValueError, match="Unknown runtime profile"):
+        select_profile(1, "uint8", FARGATE, name="fast")
+
+
+def test_profile_config():
+    config = PROFILES["parallel"].config(FARGATE)
+    assert config["GDAL_CACHEMAX"] == 2048
+    assert config["GDAL_NUM_THREADS"] == 4
+    assert config["GDAL_DISABLE_READDIR_ON_OPEN"] == "EMPTY_DIR"
+
+    # outputs written in parallel share the CPUs
+    assert PROFILES["parallel"].creation_options(FARGATE, outputs=2) == {"NUM_THREADS": 2}
+    assert PROFILES["parallel"].creation_options(FARGATE, outputs=8) == {"NUM_THREADS": 1}
+
+    config = PROFILES["bounded"].config(Resources(cpus=2, memory_bytes=1024 * MiB))
+    assert config["GDAL_CACHEMAX"] == 102
+    assert config["CPL_VSIL_USE_TEMP_FILE_FOR_RANDOM_WRITE"] == "YES"
+
+    assert PROFILES["serial"].config(FARGATE)["GDAL_NUM_THREADS"] == 1
+
+
+@pytest.mark.parametrize(
+    "files,expected",
+    [
+        ({"/sys/fs/cgroup/cpu.max": "200000 100000", "/sys/fs/cgroup/memory.max": str(2048 * MiB)}, (2, 2048 * MiB)),
+        ({"/sys/fs/cgroup/cpu.max": "max 100000", "/sys/fs/cgroup/memory.max": "max"}, (64, 65536 * MiB)),
+        (
+            {
+                "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "50000",
+                "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000",
+                "/sys/fs/cgroup/memory/memory.limit_in_bytes": str(2**63 - 4096),
+            },
+            (0.5, 65536 * MiB),
+        ),
+    ],
+    ids=["cgroup-v2", "cgroup-v2-unlimited", "cgroup-v1"],
+)
+def test_container_resources(mocker: MockerFixture, files: dict, expected: tuple):
+    mocker.patch("convert.runtime._read_first_line", files.get)
+    mocker.patch("os.cpu_count", return_value=64)
+    mocker.patch("os.sysconf", side_effect=lambda name: 4096 if name == "SC_PAGE_SIZE" else 65536 * MiB // 4096)
+
+    container_resources.cache_clear()
+    try:
+        resources = container_resources()
+    finally:
+        container_resources.cache_clear()
+    assert (resources.cpus, resources.memory_bytes) == expected
@@ -1 +1,268 @@
-# TODO use moto for mocking S3? http://docs.getmoto.org/en/latest/docs/getting_started.html
+import json
+import os
+from io import BytesIO
+from unittest import mock
+
+import boto3
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+
+from convert.s3 import S3Helper
+from convert.transfer import DownloadCheckpoint, MultipartWriter, byte_ranges
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def payload() -> bytes:
+    # deliberately not a multiple of the part size
+    return os.urandom(5 * MiB + 12345)
+
+
+def test_byte_ranges():
+    assert byte_ranges(10, 4) == [(0, 4), (4, 4), (8, 2)]
+    assert byte_ranges(8, 4) == [(0, 4), (4, 4)]
+    assert byte_ranges(0, 4) == []
+
+    with pytest.raises(ValueError):
+        byte_ranges(10, 0)
+
+
+def test_get_bytes_ranged(s3_bucket: str, payload: bytes):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="in.tif", Body=payload)
+
+    helper = S3Helper(s3_bucket, part_size=1 * MiB, max_concurrency=4)
+    assert helper.get_bytes("/in.tif").getvalue() == payload
+
+    # one part per MiB, with the last part holding the remainder
+    assert len(helper.part_stats) == 6
+    assert [part.offset for part in helper.part_stats] == [ix * MiB for ix in range(6)]
+    assert helper.part_stats[-1].size == 12345
+    assert all(part.throughput > 0 for part in helper.part_stats)
+
+
+def test_get_bytes_empty_object(s3_bucket: str, payload: bytes):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="empty", Body=b"")
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="in.tif", Body=payload)
+
+    helper = S3Helper(s3_bucket)
+    assert helper.get_bytes("empty").getvalue() == b""
+    assert helper.part_stats == []
+
+    # the stats of an earlier transfer are not reported for the empty object
+    helper.get_bytes("in.tif")
+    assert helper.part_stats
+    helper.get_bytes("empty")
+    assert helper.part_stats == []
+
+
+def test_download_file_ranged(s3_bucket: str, payload: bytes, tmp_path):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="in.tif", Body=payload)
+    out_path = tmp_path / "in.tif"
+
+    helper = S3Helper(s3_bucket, part_size=2 * MiB, max_concurrency=2)
+    helper.download_file("in.tif", str(out_path))
+
+    assert out_path.read_bytes() == payload
+    assert len(helper.part_stats) == 3
+
+
+def test_write_bytes_small_object_single_put(s3_bucket: str):
+    helper = S3Helper(s3_bucket)
+    helper.write_bytes(BytesIO(b"small"), "/out.tif")
+
+    client = boto3.client("s3")
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == b"small"
+    assert len(helper.part_stats) == 1
+
+
+@pytest.mark.parametrize("wrap", [BytesIO, memoryview, bytes])
+def test_write_bytes_multipart(s3_bucket: str, payload: bytes, wrap):
+    helper = S3Helper(s3_bucket, part_size=2 * MiB, max_concurrency=2)
+
+    # part size is raised to the S3 minimum of 5 MiB
+    helper.write_bytes(wrap(payload), "out.tif")
+
+    client = boto3.client("s3")
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == payload
+    assert [part.size for part in helper.part_stats] == [5 * MiB, 12345]
+
+
+def test_write_bytes_from_file(s3_bucket: str, payload: bytes, tmp_path):
+    path = tmp_path / "cog.tif"
+    path.write_bytes(payload * 2)
+
+    helper = S3Helper(s3_bucket, part_size=5 * MiB)
+    helper.upload_file(str(path), "out.tif")
+
+    client = boto3.client("s3")
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == payload * 2
+    assert [part.size for part in helper.part_stats] == [5 * MiB, 5 * MiB, 24690]
+
+
+def test_multipart_writer_streaming_writes(s3_bucket: str, payload: bytes):
+    helper = S3Helper(s3_bucket, part_size=5 * MiB)
+
+    # many small writes that do not line up with the part boundaries
+    with helper.open_writer("out.tif") as writer:
+        for offset in range(0, len(payload), 300 * 1024):
+            writer.write(payload[offset : offset + 300 * 1024])
+
+    client = boto3.client("s3")
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == payload
+    assert writer.bytes_written == len(payload)
+
+
+def test_multipart_writer_aborts_on_error(s3_bucket: str, payload: bytes):
+    helper = S3Helper(s3_bucket, part_size=5 * MiB)
+
+    with pytest.raises(RuntimeError):
+        with helper.open_writer("out.tif") as writer:
+            writer.write(payload)
+            raise RuntimeError("conversion failed")
+
+    # nothing was written and the multipart upload was cleaned up
+    client = boto3.client("s3")
+    assert "Contents" not in client.list_objects_v2(Bucket=s3_bucket)
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=s3_bucket)
+
+
+@pytest.mark.parametrize("size", [10, 6 * MiB])
+def test_write_bytes_metadata(s3_bucket: str, size: int):
+    helper = S3Helper(s3_bucket, part_size=5 * MiB)
+    assert helper.get_metadata("out.tif") is None
+
+    helper.write_bytes(bytes(size), "out.tif", metadata={"cog-fingerprint": "abc"})
+    assert helper.get_metadata("out.tif") == {"cog-fingerprint": "abc"}
+
+    info = helper.head("out.tif")
+    assert info.size == size
+    assert info.metadata == {"cog-fingerprint": "abc"}
+
+
+def test_download_file_resumes(s3_bucket: str, payload: bytes, tmp_path):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="in.tif", Body=payload)
+    out_path = str(tmp_path / "in.tif")
+    record = DownloadCheckpoint.record
+
+    def interrupt(self, part_number):
+        if part_number == 3:
+            raise ConnectionError("interrupted")
+        record(self, part_number)
+
+    # the first attempt fails on the third of six parts
+    helper = S3Helper(s3_bucket, part_size=1 * MiB, max_concurrency=1, resume=True)
+    with mock.patch.object(DownloadCheckpoint, "record", interrupt), pytest.raises(ConnectionError):
+        helper.download_file("in.tif", out_path)
+    with open(f"{out_path}.checkpoint") as fh:
+        done = json.load(fh)["parts"]
+    assert done[:2] == [1, 2] and 3 not in done
+
+    # the retry only fetches the rest
+    helper = S3Helper(s3_bucket, part_size=1 * MiB, max_concurrency=2, resume=True)
+    helper.download_file("in.tif", out_path)
+    with open(out_path, "rb") as fh:
+        assert fh.read() == payload
+    assert [part.part_number for part in helper.part_stats] == [n for n in range(1, 7) if n not in done]
+    assert helper.bytes_resumed == len(done) * MiB
+    assert helper.bytes_in == len(payload) - helper.bytes_resumed
+
+    # a checkpoint for another version of the object is ignored
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="in.tif", Body=payload[::-1])
+    helper.download_file("in.tif", out_path)
+    with open(out_path, "rb") as fh:
+        assert fh.read() == payload[::-1]
+    assert len(helper.part_stats) == 6
+
+
+def test_multipart_writer_resumes(s3_bucket: str, payload: bytes):
+    client = boto3.client("s3")
+    payload = payload * 3
+    upload_part = MultipartWriter._upload_part
+
+    def interrupt(self, part_number, part):
+        if part_number == 3:
+            raise ConnectionError("interrupted")
+        return upload_part(self, part_number, part)
+
+    # the failed upload is left in place for the retry
+    helper = S3Helper(s3_bucket, part_size=5 * MiB, max_concurrency=1, resume=True)
+    with mock.patch.object(MultipartWriter, "_upload_part", interrupt), pytest.raises(ConnectionError):
+        helper.write_bytes(payload, "out.tif", metadata={"cog-fingerprint": "abc"})
+    (upload,) = client.list_multipart_uploads(Bucket=s3_bucket)["Uploads"]
+    parts = client.list_parts(Bucket=s3_bucket, Key="out.tif", UploadId=upload["UploadId"])["Parts"]
+    assert [part["PartNumber"] for part in parts][:2] == [1, 2]
+    uploaded = sum(part["Size"] for part in parts if part["PartNumber"] != 3)
+
+    # the retry continues it once it is idle, only sending the remaining parts
+    helper = S3Helper(s3_bucket, part_size=5 * MiB, resume=True)
+    with mock.patch("convert.transfer.RESUME_IDLE_SECONDS", 0):
+        helper.write_bytes(payload, "out.tif", metadata={"cog-fingerprint": "abc"})
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == payload
+    assert helper.get_metadata("out.tif") == {"cog-fingerprint": "abc"}
+    assert helper.bytes_resumed == uploaded
+    assert helper.bytes_out == len(payload) - uploaded
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=s3_bucket)
+
+
+def test_multipart_writer_restarts_different_content(s3_bucket: str, payload: bytes):
+    client = boto3.client("s3")
+    helper = S3Helper(s3_bucket, part_size=5 * MiB, resume=True)
+
+    with pytest.raises(RuntimeError):
+        with helper.open_writer("out.tif") as writer:
+            writer.write(payload)
+            raise RuntimeError("conversion failed")
+    assert len(client.list_multipart_uploads(Bucket=s3_bucket)["Uploads"]) == 1
+
+    # the unfinished upload has another first part, so it is replaced
+    with mock.patch("convert.transfer.RESUME_IDLE_SECONDS", 0):
+        helper.write_bytes(payload[::-1], "out.tif")
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == payload[::-1]
+    assert helper.bytes_resumed == 0
+    assert "Uploads" not in client.list_multipart_uploads(Bucket=s3_bucket)
+
+
+def test_multipart_writer_leaves_recent_upload(s3_bucket: str, payload: bytes):
+    client = boto3.client("s3")
+    helper = S3Helper(s3_bucket, part_size=5 * MiB, resume=True)
+
+    with helper.open_writer("out.tif") as running:
+        running.write(payload)
+        # moto reports a fixed Initiated time, the upload is recent by its part
+        running._futures[0].result()
+        (upload,) = client.list_multipart_uploads(Bucket=s3_bucket)["Uploads"]
+
+        # an upload of the key that is still in use, e.g. by a conversion of a
+        # duplicate notification, is neither resumed nor aborted
+        helper.write_bytes(payload[::-1], "out.tif")
+        assert helper.bytes_resumed == 0
+        assert [upload["UploadId"] for upload in client.list_multipart_uploads(Bucket=s3_bucket)["Uploads"]] == [
+            upload["UploadId"]
+        ]
+    assert client.get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read() == payload
+
+
+def test_stream_reads_ranges(s3_server: str, tmp_path):
+    path = str(tmp_path / "source.tif")
+    profile = {"driver": "GTiff", "width": 2048, "height": 2048, "count": 1, "dtype": "uint16"}
+    with rasterio.open(path, "w", tiled=True, blockxsize=256, blockysize=256, **profile) as dst:
+        dst.write(np.random.default_rng(0).integers(0, 1000, (1, 2048, 2048), dtype="uint16"))
+    boto3.client("s3").upload_file(path, s3_server, "source.tif")
+
+    s3 = S3Helper(s3_server)
+    window = Window(1024, 1024, 256, 256)
+    with s3.stream("source.tif") as (vsis3_path, env):
+        assert vsis3_path == f"/vsis3/{s3_server}/source.tif"
+        assert env["AWS_HTTPS"] == "NO"
+        with rasterio.Env(**env), rasterio.open(vsis3_path) as src:
+            data = src.read(1, window=window)
+
+    with rasterio.open(path) as src:
+        assert np.array_equal(data, src.read(1, window=window))
+
+    # only the header and the ranges around the window are fetched
+    assert 0 < s3.bytes_streamed < os.path.getsize(path) / 2
+    assert s3.bytes_in == s3.bytes_streamed
@@ -0,0 +1,35 @@
+import pytest
+
+from benchmarks.startup import BUDGETS, Budget, check, parse_importtime
+
+IMPORTTIME = """\
+import time: self [us] | cumulative | imported package
+import time:       120 |        120 | _io
+import time:       300 |        500 |   json.decoder
+import time:       200 |        700 | json
+some other output
+"""
+
+
+def test_parse_importtime():
+    profile = parse_importtime(IMPORTTIME)
+
+    assert profile.cumulative_us == {"_io": 120, "json.decoder": 500, "json": 700}
+    assert profile.top_level == ["_io", "json"]
+    assert profile.seconds == pytest.approx(820e-6)
+    assert profile.loaded("json")
+    assert not profile.loaded("js")
+
+
+def test_check_forbidden_module():
+    _, problems = check(Budget("json", ("-c", "import json"), 10.0, ("json",)), repeat=1)
+    assert problems == ["json imports json"]
+
+
+@pytest.mark.parametrize("budget", BUDGETS, ids=[budget.name for budget in BUDGETS])
+def test_startup_imports(budget: Budget):
+    # only what is imported, the time budgets vary with the machine and are
+    # checked with python -m benchmarks.startup
+    seconds, problems = check(budget, repeat=1, scale=float("inf"))
+    assert not problems
+    assert seconds >= 0
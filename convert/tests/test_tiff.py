@@ -0,0 +1,63 @@
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+import rasterio
+
+from convert import tiff
+from convert.tiff import Tag, TiffFormatError
+
+
+@pytest.mark.parametrize("bigtiff", [False, True])
+def test_encode_read_round_trip(bigtiff: bool):
+    ifds = [
+        {
+            tiff.IMAGE_WIDTH: Tag(tiff.LONG, (100,)),
+            tiff.BITS_PER_SAMPLE: Tag(tiff.SHORT, (8, 8, 8)),
+            tiff.TILE_OFFSETS: Tag(tiff.LONG8 if bigtiff else tiff.LONG, (1000, 2000, 3000)),
+            tiff.MODEL_PIXEL_SCALE: Tag(tiff.DOUBLE, (30.0, 30.0, 0.0)),
+            tiff.GDAL_NODATA: Tag(tiff.ASCII, b"0\0"),
+            tiff.GEO_ASCII_PARAMS: Tag(tiff.ASCII, b"WGS 84 / UTM zone 30N|\0"),
+        },
+        {tiff.IMAGE_WIDTH: Tag(tiff.LONG, (50,)), tiff.NEW_SUBFILE_TYPE: Tag(tiff.LONG, (1,))},
+    ]
+    start = len(tiff.header(bigtiff, 0))
+    encoded = tiff.encode_ifds(ifds, start, bigtiff)
+    assert len(encoded) == sum(tiff.ifd_size(tags, bigtiff) for tags in ifds)
+
+    is_bigtiff, read = tiff.read_ifds(BytesIO(tiff.header(bigtiff, start) + encoded))
+    assert is_bigtiff == bigtiff
+    assert [ifd.tags for ifd in read] == ifds
+    assert read[0].offset == start
+    assert read[1].get(tiff.NEW_SUBFILE_TYPE) == 1
+    assert read[0].values(tiff.BITS_PER_SAMPLE) == (8, 8, 8)
+    assert read[1].values(tiff.BITS_PER_SAMPLE) == ()
+
+
+def test_read_gdal_tiff(tmp_path: Path):
+    path = str(tmp_path / "tiled.tif")
+    profile = {"driver": "GTiff", "width": 64, "height": 32, "count": 2, "dtype": "int16"}
+    with rasterio.open(path, "w", tiled=True, blockxsize=32, blockysize=16, **profile) as dst:
+        dst.write(np.ones((2, 32, 64), dtype="int16"))
+
+    with open(path, "rb") as fh:
+        bigtiff, ifds = tiff.read_ifds(fh)
+    assert not bigtiff
+    assert len(ifds) == 1
+    assert ifds[0].get(tiff.IMAGE_WIDTH) == 64
+    assert ifds[0].get(tiff.TILE_LENGTH) == 16
+    assert ifds[0].values(tiff.SAMPLE_FORMAT) == (2, 2)
+    assert len(ifds[0].values(tiff.TILE_BYTE_COUNTS)) == 4
+
+
+def test_ghost_header():
+    header = tiff.ghost_header()
+    assert header.startswith(b"GDAL_STRUCTURAL_METADATA_SIZE=000140 bytes\n")
+    assert header.endswith(tiff.GHOST_HEADER.encode("ascii"))
+
+
+@pytest.mark.parametrize("data", [b"", b"PK\x03\x04 not a tiff", b"II\x2b\x00\x08\x00\x00\x00"])
+def test_read_ifds_rejects_invalid(data: bytes):
+    with pytest.raises(TiffFormatError):
+        tiff.read_ifds(BytesIO(data))
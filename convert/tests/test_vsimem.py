@@ -0,0 +1,87 @@
+import os
+
+import boto3
+import numpy as np
+import pytest
+import rasterio
+from rasterio.errors import RasterioIOError
+
+from convert.metrics import _libgdal
+from convert.s3 import S3Helper
+from convert.vsimem import VsiMemFile, held_bytes
+
+
+@pytest.fixture
+def libgdal():
+    """The GDAL library of rasterio, so files can be checked with rasterio"""
+    lib = _libgdal()
+    if lib is None:
+        pytest.skip("GDAL library not found")
+    return lib
+
+
+@pytest.fixture
+def landsat(test_dir: str) -> bytes:
+    with open(os.path.join(test_dir, "data", "landsat.tif"), "rb") as fh:
+        return fh.read()
+
+
+def test_allocated_file(libgdal, landsat: bytes):
+    before = held_bytes()
+    with VsiMemFile.allocate(len(landsat), lib=libgdal) as mem:
+        memoryview(mem.buffer)[:] = landsat
+        mem.register()
+        assert mem.nbytes == len(landsat)
+        assert held_bytes() - before == len(landsat)
+
+        # GDAL reads the buffer in place
+        with rasterio.open(mem.path) as src:
+            assert src.shape == (18, 32)
+        with mem.view() as view:
+            assert view == landsat
+
+    # the file is unlinked and the buffer released
+    assert held_bytes() == before
+    assert mem.buffer is None
+    with pytest.raises(RasterioIOError):
+        rasterio.open(mem.path)
+
+
+def test_gdal_written_file(libgdal):
+    with VsiMemFile(lib=libgdal) as mem:
+        with pytest.raises(FileNotFoundError):
+            mem.view()
+
+        profile = {"driver": "GTiff", "width": 16, "height": 16, "count": 1, "dtype": "uint8"}
+        with rasterio.open(mem.path, "w", **profile) as dst:
+            dst.write(np.full((1, 16, 16), 7, dtype="uint8"))
+
+        with mem.view() as view:
+            assert view.readonly
+            assert view[:4] == b"II*\x00"
+            assert mem.nbytes == len(view)
+
+    assert mem.nbytes == 0
+
+
+def test_register_requires_buffer(libgdal):
+    with pytest.raises(ValueError):
+        VsiMemFile(lib=libgdal).register()
+
+
+def test_gdal_dataset_round_trip(s3_bucket: str, landsat: bytes):
+    gdal = pytest.importorskip("osgeo.gdal", minversion="3.0")
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="in.tif", Body=landsat)
+    helper = S3Helper(s3_bucket)
+
+    before = held_bytes()
+    with helper.get_gdal_dataset("in.tif") as mem:
+        assert mem.nbytes == len(landsat)
+        assert (mem.dataset.RasterXSize, mem.dataset.RasterYSize) == (32, 18)
+        size = helper.write_gdal_dataset(mem.dataset, "out.tif", options=["COMPRESS=DEFLATE"])
+    assert held_bytes() == before
+    assert gdal.ReadDir("/vsimem/") in (None, [])
+
+    body = boto3.client("s3").get_object(Bucket=s3_bucket, Key="out.tif")["Body"].read()
+    assert len(body) == size
+    assert body[:4] == b"II*\x00"
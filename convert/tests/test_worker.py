@@ -0,0 +1,85 @@
+import os
+
+import boto3
+import pytest
+from rio_cogeo.cogeo import cog_validate
+
+from convert import direct
+from convert.manifest import Task
+from convert.worker import run_tasks, tasks_from_keys, tasks_from_prefix
+
+
+@pytest.fixture
+def inputs(s3_bucket: str, test_dir: str) -> str:
+    s3 = boto3.client("s3")
+    with open(os.path.join(test_dir, "data", "landsat.tif"), "rb") as fh:
+        landsat = fh.read()
+
+    s3.put_object(Bucket=s3_bucket, Key="scenes/a.tif", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="scenes/b.TIF", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="scenes/broken.tif", Body=b"not a tiff")
+    s3.put_object(Bucket=s3_bucket, Key="scenes/readme.txt", Body=b"ignored")
+    s3.create_bucket(Bucket="out-bucket")
+    return s3_bucket
+
+
+def test_tasks_from_keys():
+    assert tasks_from_keys("in", ["a.tif"], "out") == [Task("in", "a.tif", "out", "a-cog.tif")]
+    # extensions are matched in any case
+    assert [task.out_key for task in tasks_from_keys("in", ["b.TIF", "c.tiff", "d.Tiff"], "in")] == [
+        "b-cog.TIF",
+        "c-cog.tiff",
+        "d-cog.Tiff",
+    ]
+
+
+def test_run_tasks_refuses_to_overwrite_sources(inputs: str):
+    tasks = tasks_from_prefix(inputs, "scenes/", inputs)
+    assert [task.out_key for task in tasks] == ["scenes/a-cog.tif", "scenes/b-cog.TIF", "scenes/broken-cog.tif"]
+
+    source = Task(inputs, "scenes/b.TIF", inputs, "scenes/b.TIF")
+    (result,) = run_tasks([source])
+    assert not result.ok and "refusing to overwrite" in result.error
+    assert boto3.client("s3").head_object(Bucket=inputs, Key="scenes/b.TIF")["Metadata"] == {}
+
+
+def test_tasks_from_prefix(inputs: str):
+    tasks = tasks_from_prefix(inputs, "scenes/", "out-bucket")
+    assert [task.key for task in tasks] == ["scenes/a.tif", "scenes/b.TIF", "scenes/broken.tif"]
+
+
+def test_run_tasks_continues_past_failures(inputs: str, tmp_path):
+    tasks = tasks_from_prefix(inputs, "scenes/", "out-bucket")
+    results = run_tasks(tasks, workers=1)
+
+    assert [result.ok for result in results] == [True, True, False]
+    assert all(result.seconds > 0 for result in results)
+    assert "broken.tif" in results[2].task.key and results[2].error
+
+    # running again finds the outputs up to date
+    results = run_tasks(tasks, workers=1)
+    assert [(result.ok, result.converted) for result in results] == [(True, False), (True, False), (False, True)]
+
+    # the successful conversions were uploaded
+    out_path = tmp_path / "a-cog.tif"
+    boto3.client("s3").download_file("out-bucket", "scenes/a-cog.tif", str(out_path))
+    assert cog_validate(str(out_path))[0]
+
+
+def test_run_tasks_process_pool(inputs: str):
+    tasks = tasks_from_prefix(inputs, "scenes/", "out-bucket")
+    results = run_tasks(tasks, workers=2)
+
+    # results arrive in order of completion
+    assert len(results) == 3
+    assert sorted(result.task.key for result in results if result.ok) == ["scenes/a.tif", "scenes/b.TIF"]
+
+
+def test_direct_handler(inputs: str):
+    task = {"bucket": inputs, "key": "scenes/a.tif", "out_bucket": "out-bucket", "out_key": "a.tif"}
+    assert direct.handler({"tasks": [task]}, None) == {"converted": 1, "skipped": 0}
+    assert direct.handler({"tasks": [task]}, None) == {"converted": 0, "skipped": 1}
+
+    # failures are raised so that Lambda retries the invocation
+    with pytest.raises(RuntimeError, match="1 of 2 conversions failed"):
+        direct.handler({"tasks": [task, dict(task, key="scenes/broken.tif")]}, None)
@@ -0,0 +1,7 @@
+import os
+
+# Directories of the convert package and the Lambda handler, resolved from this
+# file so that the stacks synthesise from any working directory
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CONVERT_DIR = os.path.join(REPO_DIR, "convert")
+LAMBDA_DIR = os.path.join(REPO_DIR, "lambda")
@@ -1,3 +1,5 @@
+from typing import Dict
+
 from aws_cdk import Stack
 from aws_cdk import aws_batch_alpha as batch
 from aws_cdk import aws_ec2 as ec2
@@ -7,6 +9,9 @@ from aws_cdk import aws_s3 as s3
 from aws_cdk import aws_ssm as ssm
 from constructs import Construct
 
+from stacks import CONVERT_DIR
+from stacks.tiers import COG_PROFILES, TIERS, MiB
+
 
 class BatchStack(Stack):
     def __init__(
@@ -50,20 +55,6 @@ class BatchStack(Stack):
             else:
                 bucket.grant_read_write(job_role)
 
-        # Create the job definition for the container that will do the conversion
-        self.batch_job_definition = batch.JobDefinition(
-            self,
-            f"{construct_id}-job-definition",
-            container=batch.JobDefinitionContainer(
-                image=ecs.ContainerImage.from_asset("../convert"),
-                vcpus=1,
-                memory_limit_mib=2048,
-                execution_role=execution_role,
-                job_role=job_role,
-            ),
-            platform_capabilities=[batch.PlatformCapabilities.FARGATE],
-        )
-
         # Create a Fargate backed compute environment for AWS Batch
         self.compute_environment = batch.ComputeEnvironment(
             self,
@@ -74,15 +65,47 @@ class BatchStack(Stack):
             ),
         )
 
-        # Create the Job Queue for Batch
-        self.job_queue = batch.JobQueue(
-            self,
-            f"{construct_id}-job-queue",
-            priority=1,
-            compute_environments=[
-                batch.JobQueueComputeEnvironment(compute_environment=self.compute_environment, order=1)
-            ],
-        )
+        # Create a job definition and queue for each size tier, so that small
+        # objects do not reserve the resources that large ones need
+        image = ecs.ContainerImage.from_asset(CONVERT_DIR)
+        self.job_definitions: Dict[str, batch.JobDefinition] = {}
+        self.job_queues: Dict[str, batch.JobQueue] = {}
+        for tier in TIERS:
+            self.job_definitions[tier.name] = batch.JobDefinition(
+                self,
+                f"{construct_id}-job-definition-{tier.name}",
+                job_definition_name=tier.job_definition_name,
+                container=batch.JobDefinitionContainer(
+                    image=image,
+                    vcpus=tier.vcpus,
+                    memory_limit_mib=tier.memory_mib,
+                    execution_role=execution_role,
+                    job_role=job_role,
+                    environment={
+                        # Per conversion stage timings are published as CloudWatch
+                        # metrics through the embedded metric format in the job logs
+                        "METRICS_SINKS": "emf",
+                        # Convert in memory while the input is under an eighth of
+                        # the container memory
+                        "COG_IN_MEMORY_MAX_BYTES": str(tier.memory_mib * MiB // 8),
+                        "COG_PROFILES": COG_PROFILES,
+                    },
+                ),
+                platform_capabilities=[batch.PlatformCapabilities.FARGATE],
+            )
+
+            self.job_queues[tier.name] = batch.JobQueue(
+                self,
+                f"{construct_id}-job-queue-{tier.name}",
+                priority=tier.priority,
+                compute_environments=[
+                    batch.JobQueueComputeEnvironment(compute_environment=self.compute_environment, order=1)
+                ],
+            )
+
+        # The largest tier can convert anything, so is the default
+        self.batch_job_definition = self.job_definitions[TIERS[-1].name]
+        self.job_queue = self.job_queues[TIERS[-1].name]
 
         # Use AWS Systems Manager to store the Job Queue and Job Definition names
         # These are then resolved by the S3 Trigger Stack so the Lambda trigger
@@ -102,3 +125,22 @@ class BatchStack(Stack):
             string_value=self.batch_job_definition.job_definition_name,
             description="AWS Batch Job Definition Name",
         )
+
+        # The Lambda trigger picks the tier of each object from its size
+        ssm.StringParameter(
+            self,
+            f"{construct_id}-tiers-ref",
+            parameter_name="batch-tiers",
+            string_value=self.to_json_string(
+                [
+                    {
+                        "name": tier.name,
+                        "max_bytes": tier.max_bytes,
+                        "job_definition": self.job_definitions[tier.name].job_definition_name,
+                        "job_queue": self.job_queues[tier.name].job_queue_name,
+                    }
+                    for tier in TIERS
+                ]
+            ),
+            description="AWS Batch size tiers, JSON list of name, max_bytes, job_definition and job_queue",
+        )
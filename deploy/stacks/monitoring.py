@@ -1,11 +1,12 @@
-from aws_cdk import Stack
+from aws_cdk import Aws, Stack
 from aws_cdk import aws_events as events
 from aws_cdk import aws_events_targets as events_targets
 from aws_cdk import aws_sns as sns
 from aws_cdk import aws_sns_subscriptions as subscriptions
-from aws_cdk import aws_ssm as ssm
 from constructs import Construct
 
+from stacks.tiers import JOB_DEFINITION_PREFIX
+
 
 class MonitoringStack(Stack):
     def __init__(
@@ -28,11 +29,12 @@ class MonitoringStack(Stack):
             subscriptions.EmailSubscription("mblack@sparkgeo.com")
         )  # TODO move email address to config
 
-        # Create a pattern that will match AWS Batch failures
-        job_defn_name = ssm.StringParameter.value_for_string_parameter(self, "batch-job-definition")
+        # Create a pattern that will match AWS Batch failures of any size tier,
+        # the events name the job definition by its ARN
+        job_defn_arn = f"arn:{Aws.PARTITION}:batch:{Aws.REGION}:{Aws.ACCOUNT_ID}:job-definition/{JOB_DEFINITION_PREFIX}"
         pattern = events.EventPattern(
             source=["aws.batch"],
-            detail={"status": ["FAILED"], "jobDefinition": [job_defn_name]},
+            detail={"status": ["FAILED"], "jobDefinition": [{"prefix": job_defn_arn}]},
             detail_type=["Batch Job State Change"],
         )
 
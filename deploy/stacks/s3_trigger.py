@@ -1,4 +1,4 @@
-from aws_cdk import Stack
+from aws_cdk import Duration, Stack
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as lambda_
 from aws_cdk import aws_s3 as s3
@@ -6,6 +6,9 @@ from aws_cdk import aws_s3_notifications as s3n
 from aws_cdk import aws_ssm as ssm
 from constructs import Construct
 
+from stacks import CONVERT_DIR, LAMBDA_DIR
+from stacks.tiers import COG_PROFILES, DIRECT_CONVERT_MAX_BYTES, DIRECT_CONVERT_MEMORY_MIB, DIRECT_CONVERT_TIMEOUT
+
 
 class S3TriggerStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -29,6 +32,21 @@ class S3TriggerStack(Stack):
         # These are needed by the lambda function to send the AWS Batch job
         job_defn_name = ssm.StringParameter.value_for_string_parameter(self, "batch-job-definition")
         job_queue_name = ssm.StringParameter.value_for_string_parameter(self, "batch-job-queue")
+        tiers = ssm.StringParameter.value_for_string_parameter(self, "batch-tiers")
+
+        # Objects that are small enough are converted by this function instead
+        # of a Batch job, it runs the convert package from a Lambda image
+        self.direct_function = lambda_.DockerImageFunction(
+            self,
+            f"{construct_id}-lambda-direct-convert",
+            code=lambda_.DockerImageCode.from_image_asset(CONVERT_DIR, file="Dockerfile.lambda"),
+            memory_size=DIRECT_CONVERT_MEMORY_MIB,
+            timeout=Duration.seconds(DIRECT_CONVERT_TIMEOUT),
+            environment={"SCRATCH_DIR": "/tmp", "METRICS_SINKS": "emf", "COG_PROFILES": COG_PROFILES},
+            description="Convert a small GTiff to COG without AWS Batch",
+        )
+        bucket.grant_read(self.direct_function)
+        out_bucket.grant_read_write(self.direct_function)
 
         # create lambda function that uses the python handler
         # this will trigger the AWS Batch job
@@ -37,10 +55,14 @@ class S3TriggerStack(Stack):
             f"{construct_id}-lambda-batch-trigger",
             runtime=lambda_.Runtime.PYTHON_3_8,
             handler="handler.main",
-            code=lambda_.Code.from_asset("../lambda"),
+            code=lambda_.Code.from_asset(LAMBDA_DIR),
             environment={
                 "BATCH_JOB_DEFINITION": job_defn_name,
                 "BATCH_JOB_QUEUE": job_queue_name,
+                "BATCH_TIERS": tiers,
+                "COG_PROFILES": COG_PROFILES,
+                "DIRECT_CONVERT_FUNCTION": self.direct_function.function_name,
+                "DIRECT_CONVERT_MAX_BYTES": str(DIRECT_CONVERT_MAX_BYTES),
                 "OUTPUT_S3_BUCKET": out_bucket.bucket_name,
             },
             description="Trigger to submit a new AWS Batch job to convert a GTiff to COG",
@@ -55,12 +77,21 @@ class S3TriggerStack(Stack):
             )
         )
 
+        self.direct_function.grant_invoke(self.function)
+
+        # The Lambda reads the header of each new object to check that it is a
+        # TIFF which is not already a Cloud Optimised GeoTiff
+        bucket.grant_read(self.function)
+
+        # Manifests for large array jobs are written to the output bucket, and
+        # existing outputs are checked to skip objects that are already converted
+        out_bucket.grant_put(self.function)
+        out_bucket.grant_read(self.function)
+
         # Create the notification trigger on the S3 bucket that will trigger
         # Lambda when an object is created
-        # Trigger only on specific file suffixes for tiff images
-        # NOTE: this is not really a great approach for determining the file is
-        # actually a tif, but there is no lightweight solution shy of getting
-        # GDAL to try and open the file
+        # Trigger only on specific file suffixes for tiff images, the Lambda
+        # then probes the header to reject anything that is not really a TIFF
         suffixes = [".tif", ".TIF", ".tiff", ".TIFF"]
         for suffix in suffixes:
             bucket.add_event_notification(
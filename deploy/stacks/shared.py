@@ -1,4 +1,4 @@
-from aws_cdk import Stack
+from aws_cdk import Duration, Stack
 from aws_cdk import aws_ec2 as ec2
 from aws_cdk import aws_s3 as s3
 from aws_cdk import aws_ssm as ssm
@@ -54,6 +54,9 @@ class SharedStack(Stack):
                 f"{construct_id}-s3-{btype}-bucket",
                 public_read_access=False,
                 block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
+                # Failed conversions leave their multipart uploads in place so
+                # a retried job can resume them, clean up any never retried
+                lifecycle_rules=[s3.LifecycleRule(abort_incomplete_multipart_upload_after=Duration.days(7))],
             )
 
             # Store the bucket in Session Manager for other stacks to use
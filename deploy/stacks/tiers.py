@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+from typing import List, Optional
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# Prefix of the name of every tier's job definition, e.g. s3-to-cog-small
+JOB_DEFINITION_PREFIX = "s3-to-cog-"
+
+# Objects up to this size are converted by a Lambda function rather than a
+# Batch job, which saves the time and cost of starting a Fargate task
+DIRECT_CONVERT_MAX_BYTES = 16 * MiB
+
+# COG profiles written for each object, passed to the Batch jobs and the Lambda
+# that converts small objects, and to the trigger so that it skips objects
+# whose outputs are already current with the same profiles
+COG_PROFILES = "deflate"
+
+# Memory (MiB) and timeout (seconds) of the Lambda that converts small objects
+DIRECT_CONVERT_MEMORY_MIB = 2048
+DIRECT_CONVERT_TIMEOUT = 300
+
+
+@dataclass(frozen=True)
+class Tier:
+    """Resources of the Batch job definition and queue for a range of object sizes"""
+
+    name: str
+    # Largest object in the tier, None for no limit
+    max_bytes: Optional[int]
+    vcpus: int
+    memory_mib: int
+    # Priority of the tier's job queue, higher runs first
+    priority: int
+
+    @property
+    def job_definition_name(self) -> str:
+        return f"{JOB_DEFINITION_PREFIX}{self.name}"
+
+
+# Tiers in order of size, each must be a valid Fargate vCPU/memory combination
+# https://docs.aws.amazon.com/batch/latest/userguide/fargate.html
+TIERS: List[Tier] = [
+    Tier("small", max_bytes=256 * MiB, vcpus=1, memory_mib=2048, priority=10),
+    Tier("medium", max_bytes=2 * GiB, vcpus=2, memory_mib=8192, priority=5),
+    Tier("large", max_bytes=None, vcpus=4, memory_mib=16384, priority=1),
+]
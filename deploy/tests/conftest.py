@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+DEPLOY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# The stacks are imported as the cdk CLI runs app.py, from the deploy directory
+sys.path.insert(0, DEPLOY_DIR)
+
+
+@pytest.fixture(scope="session")
+def stacks():
+    """Templates of the batch and trigger stacks, synthesised once as app.py creates them"""
+    cdk = pytest.importorskip("aws_cdk")
+    from aws_cdk.assertions import Template
+
+    from stacks.batch import BatchStack
+    from stacks.s3_trigger import S3TriggerStack
+    from stacks.shared import SharedStack
+
+    app = cdk.App()
+    shared = SharedStack(app, "shared")
+    batch_stack = BatchStack(app, "batch", vpc=shared.vpc)
+    trigger = S3TriggerStack(app, "s3")
+    return {"batch": Template.from_stack(batch_stack), "s3": Template.from_stack(trigger)}
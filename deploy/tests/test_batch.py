@@ -0,0 +1,117 @@
+import json
+from typing import Any, Dict
+
+import pytest
+
+from stacks.tiers import COG_PROFILES, DIRECT_CONVERT_MAX_BYTES, MiB, TIERS
+
+# The stacks are only synthesised where the CDK is installed, see deploy/requirements.txt
+assertions = pytest.importorskip("aws_cdk.assertions")
+Match, Template = assertions.Match, assertions.Template
+
+
+def resolve(value: Any) -> str:
+    """A string from an Fn::Join, with each Ref replaced by the logical id it refers to"""
+    if isinstance(value, str):
+        return value
+    if "Ref" in value:
+        return value["Ref"]
+    separator, parts = value["Fn::Join"]
+    return separator.join(resolve(part) for part in parts)
+
+
+def logical_id(template: Template, resource_type: str, properties: Dict[str, Any]) -> str:
+    """Logical id of the only resource of a type with these properties"""
+    (found,) = template.find_resources(resource_type, {"Properties": properties})
+    return found
+
+
+def parameter_value(template: Template, name: str) -> Any:
+    """Value of the SSM parameter ``name``"""
+    (parameter,) = template.find_resources("AWS::SSM::Parameter", {"Properties": {"Name": name}}).values()
+    return parameter["Properties"]["Value"]
+
+
+def test_job_definition_and_queue_per_tier(stacks):
+    template = stacks["batch"]
+    template.resource_count_is("AWS::Batch::JobDefinition", len(TIERS))
+    template.resource_count_is("AWS::Batch::JobQueue", len(TIERS))
+
+    for tier in TIERS:
+        template.has_resource_properties(
+            "AWS::Batch::JobDefinition",
+            {
+                "JobDefinitionName": tier.job_definition_name,
+                "PlatformCapabilities": ["FARGATE"],
+                "ContainerProperties": Match.object_like(
+                    {
+                        "ResourceRequirements": [
+                            {"Type": "VCPU", "Value": str(tier.vcpus)},
+                            {"Type": "MEMORY", "Value": str(tier.memory_mib)},
+                        ],
+                        "Environment": Match.array_with(
+                            [
+                                {"Name": "COG_IN_MEMORY_MAX_BYTES", "Value": str(tier.memory_mib * MiB // 8)},
+                                {"Name": "COG_PROFILES", "Value": COG_PROFILES},
+                            ]
+                        ),
+                    }
+                ),
+            },
+        )
+    queues = template.find_resources("AWS::Batch::JobQueue").values()
+    assert sorted(queue["Properties"]["Priority"] for queue in queues) == sorted(tier.priority for tier in TIERS)
+
+
+def test_tiers_parameter(stacks):
+    template = stacks["batch"]
+    tiers = json.loads(resolve(parameter_value(template, "batch-tiers")))
+
+    assert [(tier["name"], tier.get("max_bytes")) for tier in tiers] == [(tier.name, tier.max_bytes) for tier in TIERS]
+    for tier, expected in zip(tiers, TIERS):
+        name = expected.job_definition_name
+        assert tier["job_definition"] == logical_id(template, "AWS::Batch::JobDefinition", {"JobDefinitionName": name})
+        assert tier["job_queue"] == logical_id(template, "AWS::Batch::JobQueue", {"Priority": expected.priority})
+
+    # the largest tier is also the default job definition and queue
+    assert parameter_value(template, "batch-job-definition") == {"Ref": tiers[-1]["job_definition"]}
+    assert parameter_value(template, "batch-job-queue") == {"Ref": tiers[-1]["job_queue"]}
+
+
+def test_trigger_environment(stacks):
+    template = stacks["s3"]
+    # SSM parameters resolved at deployment, by parameter name
+    parameters = {
+        parameter["Default"]: name
+        for name, parameter in template.to_json()["Parameters"].items()
+        if parameter["Type"].startswith("AWS::SSM::Parameter")
+    }
+    direct = logical_id(template, "AWS::Lambda::Function", {"PackageType": "Image"})
+
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "handler.main",
+            "Environment": {
+                "Variables": Match.object_like(
+                    {
+                        "BATCH_TIERS": {"Ref": parameters["batch-tiers"]},
+                        "BATCH_JOB_DEFINITION": {"Ref": parameters["batch-job-definition"]},
+                        "BATCH_JOB_QUEUE": {"Ref": parameters["batch-job-queue"]},
+                        "DIRECT_CONVERT_FUNCTION": {"Ref": direct},
+                        "DIRECT_CONVERT_MAX_BYTES": str(DIRECT_CONVERT_MAX_BYTES),
+                        "COG_PROFILES": COG_PROFILES,
+                    }
+                )
+            },
+        },
+    )
+
+    # the trigger skips outputs by the profiles that both ways of converting write
+    template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "PackageType": "Image",
+            "Environment": {"Variables": Match.object_like({"COG_PROFILES": COG_PROFILES})},
+        },
+    )
@@ -0,0 +1,81 @@
+"""Fingerprints of conversions, to skip objects whose outputs are already current
+
+A copy of ``convert.fingerprint.fingerprint`` and of the settings ``to_cog``
+fingerprints for each profile, as the handler is deployed without the convert
+package. ``tests/test_fingerprint.py`` checks that they stay the same.
+"""
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Mapping, Optional
+
+# S3 user metadata key holding the fingerprint of each output COG
+FINGERPRINT_KEY = "cog-fingerprint"
+
+# Profiles written for each object when COG_PROFILES is not set, see convert.worker
+DEFAULT_PROFILES = ("deflate",)
+
+# Profile choosing the compression from each source, see convert.compression
+AUTO = "auto"
+POLICIES = {"size": 0.0, "balanced": 0.05, "speed": 0.25}
+
+# Creation options of the rio-cogeo profiles, which convert fingerprints
+_BASE_OPTIONS = {"driver": "GTiff", "interleave": "pixel", "tiled": True, "blockxsize": 512, "blockysize": 512}
+PROFILE_OPTIONS: Dict[str, Dict[str, Any]] = {
+    "raw": dict(_BASE_OPTIONS),
+    "jpeg": {**_BASE_OPTIONS, "compress": "JPEG", "photometric": "YCbCr"},
+    **{
+        name: {**_BASE_OPTIONS, "compress": name.upper()}
+        for name in ("webp", "zstd", "lzw", "deflate", "packbits", "lzma", "lerc", "lerc_deflate", "lerc_zstd")
+    },
+}
+
+
+def load_profiles(environ: Mapping[str, str]) -> List[str]:
+    """Profiles written for each object, from the comma separated ``COG_PROFILES``"""
+    profiles = [profile.strip() for profile in environ.get("COG_PROFILES", "").split(",") if profile.strip()]
+    return profiles or list(DEFAULT_PROFILES)
+
+
+def output_keys(out_key: str, profiles: List[str]) -> List[str]:
+    """Key written with each profile, as ``convert.cog.output_specs`` names them"""
+    root, ext = os.path.splitext(out_key)
+    return [out_key if ix == 0 else f"{root}-{profile}{ext}" for ix, profile in enumerate(profiles)]
+
+
+def profile_options(profile: str, environ: Mapping[str, str]) -> Optional[Dict[str, Any]]:
+    """Settings fingerprinted for a profile, None for a profile this copy does not know"""
+    if profile == AUTO:
+        policy = environ.get("COG_AUTO_POLICY", "balanced")
+        try:
+            slack = POLICIES[policy] if policy in POLICIES else float(policy)
+        except ValueError:
+            return None
+        return {"policy": slack, "lossy": environ.get("COG_AUTO_LOSSY", "off") == "on"}
+
+    options = PROFILE_OPTIONS.get(profile)
+    return dict(options) if options is not None else None
+
+
+def fingerprint(
+    bucket: str,
+    key: str,
+    etag: str,
+    version_id: Optional[str],
+    profile: str,
+    options: Dict[str, Any],
+) -> str:
+    """Fingerprint a conversion of a source object with a given COG profile, see ``convert.fingerprint``"""
+    payload = json.dumps(
+        {
+            "bucket": bucket,
+            "key": key.lstrip("/"),
+            "etag": etag.strip('"'),
+            "version_id": version_id,
+            "profile": profile,
+            "options": options,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -1,58 +1,211 @@
 import json
 import os
+import time
 import urllib.parse
 from datetime import datetime
 from uuid import uuid4
 
 import boto3
 
+from fingerprint import FINGERPRINT_KEY, fingerprint, load_profiles, output_keys, profile_options
+from probe import CONVERT, PROBE_BYTES, probe_tiff
+from routing import DIRECT, load_tiers, route
 
-def main(event, context):
-    print(f"Context : {context}")
-    print(f"Event : {json.dumps(event, indent=2)}")
+# AWS Batch array jobs must have between 2 and 10,000 child jobs
+MAX_ARRAY_SIZE = 10000
 
-    # Get the object from the event and show its content type
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    key = urllib.parse.unquote_plus(event["Records"][0]["s3"]["object"]["key"], encoding="utf-8")
+# Manifests larger than this are written to S3 rather than passed inline in
+# the container overrides, which have a limited size
+MAX_INLINE_MANIFEST = 4096
+MANIFEST_PREFIX = os.environ.get("MANIFEST_PREFIX", "manifests/")
 
-    job_defn = os.environ["BATCH_JOB_DEFINITION"]
-    job_queue = os.environ["BATCH_JOB_QUEUE"]
-    out_bucket = os.environ["OUTPUT_S3_BUCKET"]
+# Conversions skipped (hits) or routed to be converted (misses) over the life of the container
+cache_stats = {"hits": 0, "misses": 0}
+
+# Boto3 clients are created once per container and reused by warm invocations
+_clients = {}
+
+
+def get_client(service):
+    """Get a cached boto3 client for ``service``"""
+    if service not in _clients:
+        _clients[service] = boto3.client(service)
+    return _clients[service]
+
+
+def output_is_current(bucket, key, etag, version_id, out_bucket, out_key, profiles):
+    """Check whether every output was already converted from this exact source
+
+    Each output written with ``profiles`` must hold the fingerprint that
+    ``convert.cog.to_cog`` would give it, so both skip the same objects. A
+    missing output (or source ETag) or an unknown profile is never current.
+    """
+    if not etag:
+        return False
+
+    s3 = get_client("s3")
+    for profile, output_key in zip(profiles, output_keys(out_key, profiles)):
+        options = profile_options(profile, os.environ)
+        if options is None:
+            return False
+
+        try:
+            metadata = s3.head_object(Bucket=out_bucket, Key=output_key)["Metadata"]
+        except s3.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+        if metadata.get(FINGERPRINT_KEY) != fingerprint(bucket, key, etag, version_id, profile, options):
+            return False
+    return True
+
+
+def probe_object(bucket, key):
+    """Probe the header of an S3 object to decide whether to convert it"""
+    s3 = get_client("s3")
+
+    def read(offset, size):
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={offset}-{offset + size - 1}")
+        return response["Body"].read()
+
+    start = time.perf_counter()
+    try:
+        result = probe_tiff(read)
+    except s3.exceptions.ClientError as e:
+        # An empty object cannot satisfy any range. Any other error (throttling,
+        # access or KMS errors, ...) fails the invocation so Lambda retries it
+        if e.response["Error"]["Code"] != "InvalidRange":
+            raise
+        print(f"Unable to read header of {bucket}/{key} : {e}")
+        return False
+
+    elapsed = (time.perf_counter() - start) * 1000
+    print(
+        f"Probe decision for {bucket}/{key} : {result.decision} ({result.reason}) "
+        f"in {elapsed:.1f} ms using {result.reads} ranged read(s) of up to {PROBE_BYTES} bytes"
+    )
+    return result.decision == CONVERT
+
+
+def submit_job(tasks, job_defn, job_queue, out_bucket):
+    """Submit a Batch job converting each of ``tasks``
+
+    A single task is submitted as a plain job configured by environment
+    variables. Multiple tasks are submitted as one array job with a manifest
+    of the tasks, which each child job indexes with AWS_BATCH_JOB_ARRAY_INDEX.
+    """
     job_name = f"convert-{int(datetime.utcnow().timestamp())}-{uuid4()}"
+    print(f"Submitting job : {job_name} ({len(tasks)} object(s))")
 
-    print(f"Submitting batch job to convert : {bucket}/{key}")
-    print(f"Outputting to : {out_bucket}/{key}")
-    print(f"Using batch job defn : {job_defn}")
-    print(f"Using batch job queue : {job_queue}")
-    print(f"Submitting job : {job_name}")
+    if len(tasks) == 1:
+        task = tasks[0]
+        environment = {
+            "INPUT_S3_BUCKET": task["bucket"],
+            "INPUT_S3_KEY": task["key"],
+            "OUTPUT_S3_BUCKET": task["out_bucket"],
+            "OUTPUT_S3_KEY": task["out_key"],
+        }
+        array_properties = {}
+    else:
+        manifest = json.dumps(tasks)
+        if len(manifest) > MAX_INLINE_MANIFEST:
+            manifest_key = f"{MANIFEST_PREFIX}{job_name}.json"
+            get_client("s3").put_object(Bucket=out_bucket, Key=manifest_key, Body=manifest.encode("utf-8"))
+            manifest = f"s3://{out_bucket}/{manifest_key}"
+            print(f"Written manifest to : {manifest}")
+
+        environment = {"INPUT_MANIFEST": manifest}
+        array_properties = {"arrayProperties": {"size": len(tasks)}}
 
-    # TODO check if the file is convertable, only submit if it is
     # submit the s3 bucket and key to the AWS Batch job queue
-    response = boto3.client("batch").submit_job(
+    response = get_client("batch").submit_job(
         jobName=job_name,
         jobDefinition=job_defn,
         jobQueue=job_queue,
-        containerOverrides={
-            "environment": [
-                {
-                    "name": "INPUT_S3_BUCKET",
-                    "value": bucket,
-                },
-                {
-                    "name": "INPUT_S3_KEY",
-                    "value": key,
-                },
-                {
-                    "name": "OUTPUT_S3_BUCKET",
-                    "value": out_bucket,
-                },
-                {
-                    "name": "OUTPUT_S3_KEY",
-                    "value": key,
-                },
-            ]
-        },
+        containerOverrides={"environment": [{"name": name, "value": value} for name, value in environment.items()]},
+        **array_properties,
     )
 
     print(response)
-    return {"statusCode": 200}
+    return response
+
+
+def convert_directly(task, function_name):
+    """Invoke the direct conversion Lambda for a small object, without waiting for it"""
+    print(f"Converting directly with {function_name} : {task['bucket']}/{task['key']}")
+    get_client("lambda").invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps({"tasks": [task]}).encode("utf-8"),
+    )
+
+
+def main(event, context):
+    print(f"Context : {context}")
+    print(f"Event : {json.dumps(event, indent=2)}")
+
+    out_bucket = os.environ["OUTPUT_S3_BUCKET"]
+    tiers = load_tiers(os.environ)
+    direct_function = os.environ.get("DIRECT_CONVERT_FUNCTION")
+    direct_max_bytes = int(os.environ.get("DIRECT_CONVERT_MAX_BYTES", 0)) if direct_function else 0
+    profiles = load_profiles(os.environ)
+
+    for tier in tiers:
+        print(f"Tier {tier.name} (up to {tier.max_bytes} bytes) : {tier.job_definition} on {tier.job_queue}")
+    print(f"Converting objects up to {direct_max_bytes} bytes directly with : {direct_function}")
+    print(f"Outputs are written with the profiles : {profiles}")
+
+    # Gather every object in the event, only keeping TIFFs which are not
+    # already optimised or converted, grouped by where they are converted
+    routed = {}
+    hits = 0
+    for record in event.get("Records", []):
+        bucket = record["s3"]["bucket"]["name"]
+        key = urllib.parse.unquote_plus(record["s3"]["object"]["key"], encoding="utf-8")
+        etag = record["s3"]["object"].get("eTag")
+        size = record["s3"]["object"].get("size")
+        version_id = record["s3"]["object"].get("versionId")
+
+        # S3 retries notifications and identical files are often re-uploaded
+        if output_is_current(bucket, key, etag, version_id, out_bucket, key, profiles):
+            print(f"Output is already up to date for : {bucket}/{key}")
+            hits += 1
+            continue
+
+        if not probe_object(bucket, key):
+            print(f"Not submitting a batch job for : {bucket}/{key}")
+            continue
+
+        name = route(size, tiers, direct_max_bytes)
+        print(f"Converting : {bucket}/{key} ({size} bytes) to {out_bucket}/{key} with {name}")
+        routed.setdefault(name, []).append({"bucket": bucket, "key": key, "out_bucket": out_bucket, "out_key": key})
+
+    cache_stats["hits"] += hits
+    cache_stats["misses"] += sum(len(tasks) for tasks in routed.values())
+    print(
+        f"Conversion cache : {hits} hit(s) this invocation, "
+        f"{cache_stats['hits']} hits / {cache_stats['misses']} misses since cold start"
+    )
+
+    # Small objects are converted in parallel by one invocation each
+    direct = routed.pop(DIRECT, [])
+    for task in direct:
+        convert_directly(task, direct_function)
+
+    # Submit each tier as one array job (or as few as the size limit allows)
+    job_ids = []
+    for tier in tiers:
+        tasks = routed.get(tier.name, [])
+        for ix in range(0, len(tasks), MAX_ARRAY_SIZE):
+            response = submit_job(tasks[ix : ix + MAX_ARRAY_SIZE], tier.job_definition, tier.job_queue, out_bucket)
+            job_ids.append(response["jobId"])
+
+    return {
+        "statusCode": 200,
+        "submitted": sum(len(tasks) for tasks in routed.values()),
+        "direct": len(direct),
+        "tiers": {name: len(tasks) for name, tasks in routed.items()},
+        "cacheHits": hits,
+        "jobIds": job_ids,
+    }
@@ -0,0 +1,231 @@
+"""Header-only probe of TIFF objects in S3
+
+Reads the first few KB of an object with a ranged GET and parses the
+TIFF/BigTIFF header and IFDs to decide whether the object should be
+converted, skipped because it is already a Cloud Optimised GeoTiff, or
+rejected as not being a TIFF at all. Only the standard library is used so
+that the Lambda cold start stays small (no GDAL).
+"""
+import struct
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+CONVERT = "convert"
+SKIP = "skip"
+REJECT = "reject"
+
+# Bytes fetched by the first ranged GET, enough for the header and the IFDs
+# of most GeoTIFFs. IFDs outside this range are fetched with further reads.
+PROBE_BYTES = 16 * 1024
+
+# Limits so a corrupt or hostile file cannot make the probe loop forever
+MAX_IFDS = 64
+MAX_READS = 8
+
+# TIFF tags used by the probe
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+COMPRESSION = 259
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+
+# Size in bytes of each TIFF field type
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TYPE_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "l", 16: "Q", 17: "q", 18: "Q"}
+
+# Images no larger than this do not need overviews to be a valid COG
+MAX_SIZE_WITHOUT_OVERVIEWS = 512
+
+GHOST_HEADER_PREFIX = b"GDAL_STRUCTURAL_METADATA_SIZE="
+
+
+class TiffError(Exception):
+    """Raised when the object is not a readable TIFF"""
+
+
+@dataclass
+class Ifd:
+    """The parts of an Image File Directory that the probe needs"""
+
+    offset: int
+    width: Optional[int]
+    height: Optional[int]
+    compression: Optional[int]
+    tiled: bool
+    reduced_resolution: bool
+    first_data_offset: Optional[int]
+
+
+@dataclass
+class ProbeResult:
+    """Decision made by ``probe_tiff``"""
+
+    decision: str
+    reason: str
+    ifds: Tuple[Ifd, ...] = ()
+    bigtiff: bool = False
+    reads: int = 0
+
+
+class _RangeCache:
+    """Serve small reads from as few ranged requests as possible"""
+
+    def __init__(self, read: Callable[[int, int], bytes]):
+        self._read = read
+        self._chunks: Dict[int, bytes] = {}
+        self.reads = 0
+
+    def get(self, offset: int, size: int) -> bytes:
+        for start, chunk in self._chunks.items():
+            if start <= offset and offset + size <= start + len(chunk):
+                return chunk[offset - start : offset - start + size]
+
+        if self.reads >= MAX_READS:
+            raise TiffError(f"Header needs more than {MAX_READS} reads")
+
+        self.reads += 1
+        chunk = self._read(offset, max(size, PROBE_BYTES))
+        if len(chunk) < size:
+            raise TiffError(f"Truncated file, wanted {size} bytes at {offset} but got {len(chunk)}")
+
+        self._chunks[offset] = chunk
+        return chunk[:size]
+
+
+def _parse_ifd(cache: _RangeCache, endian: str, offset: int, bigtiff: bool) -> Tuple[Ifd, int]:
+    """Parse the IFD at ``offset`` returning it and the offset of the next IFD"""
+    count_fmt, entry_size, value_size, value_fmt = ("Q", 20, 8, "Q") if bigtiff else ("H", 12, 4, "I")
+    count_size = struct.calcsize(count_fmt)
+
+    (count,) = struct.unpack(endian + count_fmt, cache.get(offset, count_size))
+    entries = cache.get(offset + count_size, count * entry_size + value_size)
+
+    tags: Dict[int, Tuple[int, int, bytes]] = {}
+    for ix in range(count):
+        entry = entries[ix * entry_size : (ix + 1) * entry_size]
+        tag, dtype = struct.unpack(endian + "HH", entry[:4])
+        (num,) = struct.unpack(endian + value_fmt, entry[4 : 4 + value_size])
+        tags[tag] = (dtype, num, entry[4 + value_size :])
+
+    def first_value(tag: int) -> Optional[int]:
+        if tag not in tags:
+            return None
+        dtype, num, raw = tags[tag]
+        fmt = TYPE_FORMATS.get(dtype)
+        if fmt is None or num == 0:
+            return None
+        size = TYPE_SIZES[dtype]
+        if num * size > value_size:
+            # the values do not fit in the entry, which holds a pointer to them
+            (pointer,) = struct.unpack(endian + value_fmt, raw)
+            raw = cache.get(pointer, size)
+        return struct.unpack(endian + fmt, raw[:size])[0]
+
+    (next_offset,) = struct.unpack(endian + value_fmt, entries[count * entry_size :])
+    ifd = Ifd(
+        offset=offset,
+        width=first_value(IMAGE_WIDTH),
+        height=first_value(IMAGE_LENGTH),
+        compression=first_value(COMPRESSION),
+        tiled=TILE_WIDTH in tags and TILE_LENGTH in tags,
+        reduced_resolution=bool((first_value(NEW_SUBFILE_TYPE) or 0) & 1),
+        first_data_offset=first_value(TILE_OFFSETS),
+    )
+    return ifd, next_offset
+
+
+def _ghost_header(cache: _RangeCache, offset: int) -> Optional[str]:
+    """Read GDAL's structural metadata block that follows the header, if any"""
+    try:
+        prefix = cache.get(offset, len(GHOST_HEADER_PREFIX) + 6)
+    except TiffError:
+        return None
+    if not prefix.startswith(GHOST_HEADER_PREFIX):
+        return None
+
+    try:
+        size = int(prefix[len(GHOST_HEADER_PREFIX) :])
+    except ValueError:
+        return None
+    # the size is followed by " bytes\n" and then the metadata itself
+    start = offset + len(prefix) + len(" bytes\n")
+    return cache.get(start, size).decode("ascii", errors="replace")
+
+
+def probe_tiff(read: Callable[[int, int], bytes]) -> ProbeResult:
+    """Decide whether the object behind ``read`` should be converted
+
+    Parameters
+    ----------
+    read : Callable[[int, int], bytes]
+        Function returning up to ``size`` bytes from ``offset`` of the object,
+        e.g. a ranged S3 GET
+
+    Returns
+    -------
+    ProbeResult
+        ``CONVERT``, ``SKIP`` (already a COG) or ``REJECT`` (not a TIFF)
+    """
+    cache = _RangeCache(read)
+    try:
+        header = cache.get(0, 16)
+    except TiffError as e:
+        return ProbeResult(REJECT, str(e), reads=cache.reads)
+
+    if header[:2] not in (b"II", b"MM"):
+        return ProbeResult(REJECT, "Not a TIFF (bad byte order mark)", reads=cache.reads)
+
+    endian = "<" if header[:2] == b"II" else ">"
+    (magic,) = struct.unpack(endian + "H", header[2:4])
+    if magic == 42:
+        bigtiff = False
+        (offset,) = struct.unpack(endian + "I", header[4:8])
+        ghost_offset = 8
+    elif magic == 43:
+        bigtiff = True
+        (offset,) = struct.unpack(endian + "Q", header[8:16])
+        ghost_offset = 16
+    else:
+        return ProbeResult(REJECT, f"Not a TIFF (magic number {magic})", reads=cache.reads)
+
+    # Walk the chain of IFDs (full resolution image, overviews and masks)
+    ifds: List[Ifd] = []
+    try:
+        while offset and len(ifds) < MAX_IFDS:
+            if any(ifd.offset == offset for ifd in ifds):
+                raise TiffError("IFD chain contains a loop")
+            ifd, offset = _parse_ifd(cache, endian, offset, bigtiff)
+            ifds.append(ifd)
+        ghost = _ghost_header(cache, ghost_offset)
+    except (TiffError, struct.error) as e:
+        return ProbeResult(REJECT, f"Corrupt TIFF : {e}", tuple(ifds), bigtiff, cache.reads)
+
+    def result(decision: str, reason: str) -> ProbeResult:
+        return ProbeResult(decision, reason, tuple(ifds), bigtiff, cache.reads)
+
+    if not ifds or not ifds[0].width or not ifds[0].height:
+        return result(REJECT, "TIFF has no image")
+
+    main = ifds[0]
+    if not main.tiled:
+        return result(CONVERT, "Image is not tiled")
+
+    needs_overviews = main.width > MAX_SIZE_WITHOUT_OVERVIEWS or main.height > MAX_SIZE_WITHOUT_OVERVIEWS
+    if needs_overviews and not any(ifd.reduced_resolution for ifd in ifds):
+        return result(CONVERT, "Image has no internal overviews")
+
+    if ghost is not None and "KNOWN_INCOMPATIBLE_EDITION=YES" in ghost:
+        return result(CONVERT, "COG layout was invalidated by a later edit")
+
+    # All IFDs must come before the image data for a reader to get every
+    # header in one request
+    last_ifd = max(ifd.offset for ifd in ifds)
+    data_offsets = [ifd.first_data_offset for ifd in ifds if ifd.first_data_offset]
+    if any(data_offset < last_ifd for data_offset in data_offsets):
+        return result(CONVERT, "Image data is interleaved with the IFDs")
+
+    if ghost is not None and "LAYOUT=IFDS_BEFORE_DATA" in ghost:
+        return result(SKIP, "Already a Cloud Optimised GeoTiff (GDAL layout)")
+    return result(SKIP, "Already a Cloud Optimised GeoTiff")
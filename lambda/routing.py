@@ -0,0 +1,70 @@
+"""Route each object to a conversion tier from its size
+
+The tiers are generated by the Batch stack from ``deploy/stacks/tiers.py`` and
+passed to the Lambda as JSON in ``BATCH_TIERS``. Objects up to
+``DIRECT_CONVERT_MAX_BYTES`` are converted by a Lambda function instead.
+"""
+import json
+from dataclasses import dataclass
+from typing import List, Mapping, Optional
+
+# Route of objects converted by the direct Lambda function rather than Batch
+DIRECT = "direct"
+
+
+@dataclass(frozen=True)
+class Tier:
+    """A Batch job definition and queue for objects up to ``max_bytes``"""
+
+    name: str
+    max_bytes: Optional[int]
+    job_definition: str
+    job_queue: str
+
+
+def load_tiers(environ: Mapping[str, str]) -> List[Tier]:
+    """Tiers from ``BATCH_TIERS``, in order of size
+
+    Without ``BATCH_TIERS`` every object goes to the single job definition and
+    queue in ``BATCH_JOB_DEFINITION`` and ``BATCH_JOB_QUEUE``.
+    """
+    if not environ.get("BATCH_TIERS"):
+        return [Tier("default", None, environ["BATCH_JOB_DEFINITION"], environ["BATCH_JOB_QUEUE"])]
+
+    tiers = [Tier(**tier) for tier in json.loads(environ["BATCH_TIERS"])]
+    if not tiers:
+        raise ValueError("BATCH_TIERS has no tiers")
+
+    # Unbounded tiers sort last
+    return sorted(tiers, key=lambda tier: float("inf") if tier.max_bytes is None else tier.max_bytes)
+
+
+def choose_tier(size: Optional[int], tiers: List[Tier]) -> Tier:
+    """Smallest tier that fits ``size``, or the largest if none do or the size is unknown"""
+    if size is not None:
+        for tier in tiers:
+            if tier.max_bytes is None or size <= tier.max_bytes:
+                return tier
+    return tiers[-1]
+
+
+def route(size: Optional[int], tiers: List[Tier], direct_max_bytes: int = 0) -> str:
+    """Name of the tier to convert an object of ``size`` bytes with, or ``DIRECT``
+
+    Parameters
+    ----------
+    size : int, optional
+        Size of the object from the S3 event, None if it is not known
+    tiers : List[Tier]
+        Batch tiers in order of size, see ``load_tiers``
+    direct_max_bytes : int, optional
+        Largest object converted directly by Lambda, 0 to always use Batch
+
+    Returns
+    -------
+    str
+        ``DIRECT`` or the name of a tier
+    """
+    if size is not None and 0 < size <= direct_max_bytes:
+        return DIRECT
+    return choose_tier(size, tiers).name
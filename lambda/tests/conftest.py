@@ -0,0 +1,31 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# The handler is deployed as a flat directory, so import its modules directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+@pytest.fixture
+def test_data_dir():
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "convert", "tests", "data"))
+
+
+@pytest.fixture
+def aws_credentials(monkeypatch):
+    """Fake credentials so nothing can reach a real AWS account"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture
+def s3_bucket(aws_credentials):
+    """Name of an empty bucket in a mocked S3"""
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket="input-bucket")
+        yield "input-bucket"
@@ -0,0 +1,43 @@
+import pytest
+
+from fingerprint import (
+    AUTO,
+    DEFAULT_PROFILES,
+    PROFILE_OPTIONS,
+    fingerprint,
+    load_profiles,
+    output_keys,
+    profile_options,
+)
+
+# The copies in the handler are checked against the convert package where it is installed
+cog_profiles = pytest.importorskip("rio_cogeo.profiles").cog_profiles
+compression = pytest.importorskip("convert.compression")
+convert_fingerprint = pytest.importorskip("convert.fingerprint")
+cog = pytest.importorskip("convert.cog")
+worker = pytest.importorskip("convert.worker")
+
+
+def test_profile_options():
+    assert sorted(PROFILE_OPTIONS) == sorted(cog_profiles)
+    for profile in cog_profiles:
+        assert profile_options(profile, {}) == dict(cog_profiles.get(profile))
+    assert profile_options("unknown", {}) is None
+
+    assert profile_options(AUTO, {}) == compression.auto_options()
+    environ = {"COG_AUTO_POLICY": "0.1", "COG_AUTO_LOSSY": "on"}
+    assert profile_options(AUTO, environ) == compression.auto_options("0.1", True)
+
+
+def test_fingerprint():
+    options = profile_options("deflate", {})
+    args = ("bucket", "/a.tif", '"etag"', "version", "deflate")
+    assert fingerprint(*args, options) == convert_fingerprint.fingerprint(*args, options)
+
+
+def test_profiles_and_output_keys():
+    assert tuple(load_profiles({})) == worker.DEFAULT_PROFILES == DEFAULT_PROFILES
+    assert load_profiles({"COG_PROFILES": "deflate, webp"}) == worker.parse_profiles(["deflate, webp"])
+
+    profiles = ["deflate", "webp", "auto"]
+    assert output_keys("a/b.tif", profiles) == [spec.out_key for spec in cog.output_specs("a/b.tif", profiles)]
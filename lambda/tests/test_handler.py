@@ -0,0 +1,262 @@
+import json
+import os
+from typing import Dict, List
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+import handler
+from fingerprint import fingerprint, profile_options
+
+
+class FakeLambda:
+    """Records asynchronous invocations instead of calling AWS Lambda"""
+
+    def __init__(self):
+        self.invocations: List[Dict] = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {"StatusCode": 202}
+
+
+class FakeBatch:
+    """Records submitted jobs instead of calling AWS Batch"""
+
+    def __init__(self):
+        self.jobs: List[Dict] = []
+
+    def submit_job(self, **kwargs):
+        self.jobs.append(kwargs)
+        return {"jobId": f"job-{len(self.jobs)}", "jobName": kwargs["jobName"]}
+
+
+@pytest.fixture
+def batch(s3_bucket: str, monkeypatch) -> FakeBatch:
+    monkeypatch.setenv("BATCH_JOB_DEFINITION", "job-defn")
+    monkeypatch.setenv("BATCH_JOB_QUEUE", "job-queue")
+    monkeypatch.setenv("OUTPUT_S3_BUCKET", "output-bucket")
+    boto3.client("s3").create_bucket(Bucket="output-bucket")
+
+    fake = FakeBatch()
+    monkeypatch.setattr(handler, "_clients", {"batch": fake})
+    return fake
+
+
+@pytest.fixture
+def landsat(s3_bucket: str, test_data_dir: str) -> bytes:
+    with open(os.path.join(test_data_dir, "landsat.tif"), "rb") as fh:
+        return fh.read()
+
+
+def s3_event(bucket: str, keys: List[str]) -> Dict:
+    records = []
+    for key in keys:
+        head = boto3.client("s3").head_object(Bucket=bucket, Key=key.replace("+", " "))
+        obj = {"key": key, "eTag": head["ETag"].strip('"'), "size": head["ContentLength"]}
+        records.append({"s3": {"bucket": {"name": bucket}, "object": obj}})
+    return {"Records": records}
+
+
+def environment(job: Dict) -> Dict[str, str]:
+    return {env["name"]: env["value"] for env in job["containerOverrides"]["environment"]}
+
+
+def test_probe_object(s3_bucket: str, landsat: bytes, monkeypatch):
+    monkeypatch.setattr(handler, "_clients", {})
+
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=s3_bucket, Key="landsat.tif", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="fake.tif", Body=b"this is not a tiff")
+    s3.put_object(Bucket=s3_bucket, Key="empty.tif", Body=b"")
+
+    assert handler.probe_object(s3_bucket, "landsat.tif")
+    assert not handler.probe_object(s3_bucket, "fake.tif")
+    assert not handler.probe_object(s3_bucket, "empty.tif")
+
+
+def test_probe_object_raises_other_errors(s3_bucket: str, monkeypatch):
+    monkeypatch.setattr(handler, "_clients", {})
+
+    # a missing object stands in for any error other than an unsatisfiable range
+    with pytest.raises(ClientError, match="NoSuchKey"):
+        handler.probe_object(s3_bucket, "missing.tif")
+
+
+def test_main_single_record(s3_bucket: str, landsat: bytes, batch: FakeBatch):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="dir/my image.tif", Body=landsat)
+
+    response = handler.main(s3_event(s3_bucket, ["dir/my+image.tif"]), None)
+    assert response["submitted"] == 1
+
+    # a single object is submitted as a plain job
+    (job,) = batch.jobs
+    assert "arrayProperties" not in job
+    assert environment(job) == {
+        "INPUT_S3_BUCKET": s3_bucket,
+        "INPUT_S3_KEY": "dir/my image.tif",
+        "OUTPUT_S3_BUCKET": "output-bucket",
+        "OUTPUT_S3_KEY": "dir/my image.tif",
+    }
+
+
+def test_main_array_job_inline_manifest(s3_bucket: str, landsat: bytes, batch: FakeBatch):
+    s3 = boto3.client("s3")
+    for key in ["a.tif", "b.tif", "c.tif"]:
+        s3.put_object(Bucket=s3_bucket, Key=key, Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="fake.tif", Body=b"not a tiff")
+
+    response = handler.main(s3_event(s3_bucket, ["a.tif", "fake.tif", "b.tif", "c.tif"]), None)
+    assert response == {
+        "statusCode": 200,
+        "submitted": 3,
+        "direct": 0,
+        "tiers": {"default": 3},
+        "cacheHits": 0,
+        "jobIds": ["job-1"],
+    }
+
+    # every convertible record goes in one array job
+    (job,) = batch.jobs
+    assert job["arrayProperties"] == {"size": 3}
+    manifest = json.loads(environment(job)["INPUT_MANIFEST"])
+    assert [task["key"] for task in manifest] == ["a.tif", "b.tif", "c.tif"]
+    assert all(task["out_bucket"] == "output-bucket" for task in manifest)
+
+
+def test_main_array_job_s3_manifest(s3_bucket: str, landsat: bytes, batch: FakeBatch, monkeypatch):
+    monkeypatch.setattr(handler, "MAX_INLINE_MANIFEST", 10)
+
+    s3 = boto3.client("s3")
+    for key in ["a.tif", "b.tif"]:
+        s3.put_object(Bucket=s3_bucket, Key=key, Body=landsat)
+
+    handler.main(s3_event(s3_bucket, ["a.tif", "b.tif"]), None)
+
+    # large manifests are written to the output bucket and passed by URI
+    (job,) = batch.jobs
+    uri = environment(job)["INPUT_MANIFEST"]
+    assert uri.startswith("s3://output-bucket/manifests/convert-")
+
+    manifest_key = uri[len("s3://output-bucket/") :]
+    manifest = json.loads(s3.get_object(Bucket="output-bucket", Key=manifest_key)["Body"].read())
+    assert [task["key"] for task in manifest] == ["a.tif", "b.tif"]
+
+
+def test_main_no_convertible_records(s3_bucket: str, batch: FakeBatch):
+    boto3.client("s3").put_object(Bucket=s3_bucket, Key="fake.tif", Body=b"not a tiff")
+
+    assert handler.main(s3_event(s3_bucket, ["fake.tif"]), None)["submitted"] == 0
+    assert not batch.jobs
+
+
+def test_clients_are_reused(aws_credentials, monkeypatch):
+    monkeypatch.setattr(handler, "_clients", {})
+    assert handler.get_client("s3") is handler.get_client("s3")
+
+
+def put_output(bucket: str, key: str, out_key: str, etag: str, profile: str = "deflate"):
+    """Write an output as converted from ``bucket/key`` with ``etag`` and ``profile``"""
+    options = profile_options(profile, os.environ)
+    metadata = {"cog-fingerprint": fingerprint(bucket, key, etag, None, profile, options)}
+    boto3.client("s3").put_object(Bucket="output-bucket", Key=out_key, Body=b"cog", Metadata=metadata)
+
+
+def test_main_skips_current_outputs(s3_bucket: str, landsat: bytes, batch: FakeBatch):
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=s3_bucket, Key="a.tif", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="b.tif", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="c.tif", Body=b"not a tiff")
+    etag = s3.head_object(Bucket=s3_bucket, Key="a.tif")["ETag"].strip('"')
+
+    # a.tif was converted from the same source with the same profile, b.tif
+    # from an older version of the source
+    put_output(s3_bucket, "a.tif", "a.tif", etag)
+    put_output(s3_bucket, "b.tif", "b.tif", "old")
+
+    hits, misses = handler.cache_stats["hits"], handler.cache_stats["misses"]
+    response = handler.main(s3_event(s3_bucket, ["a.tif", "b.tif", "c.tif"]), None)
+
+    assert response["cacheHits"] == 1
+    assert response["submitted"] == 1
+    assert environment(batch.jobs[0])["INPUT_S3_KEY"] == "b.tif"
+    assert handler.cache_stats["hits"] - hits == 1
+    # the rejected c.tif is not counted as a miss
+    assert handler.cache_stats["misses"] - misses == 1
+
+
+def test_output_is_current_every_profile(s3_bucket: str, batch: FakeBatch, monkeypatch):
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=s3_bucket, Key="a.tif", Body=b"source")
+    etag = s3.head_object(Bucket=s3_bucket, Key="a.tif")["ETag"]
+    profiles = ["deflate", "webp", "auto"]
+
+    def is_current():
+        return handler.output_is_current(s3_bucket, "a.tif", etag, None, "output-bucket", "a.tif", profiles)
+
+    # each profile is written to its own key, see convert.cog.output_specs
+    put_output(s3_bucket, "a.tif", "a.tif", etag)
+    put_output(s3_bucket, "a.tif", "a-webp.tif", etag, "webp")
+    assert not is_current()
+    put_output(s3_bucket, "a.tif", "a-auto.tif", etag, "auto")
+    assert is_current()
+
+    # the settings of a profile are part of its fingerprint
+    monkeypatch.setenv("COG_AUTO_POLICY", "size")
+    assert not is_current()
+    assert not handler.output_is_current(s3_bucket, "a.tif", etag, None, "output-bucket", "a.tif", ["unknown"])
+
+
+@pytest.fixture
+def tiers(monkeypatch) -> List[Dict]:
+    tiers = [
+        {"name": "large", "max_bytes": None, "job_definition": "defn-large", "job_queue": "queue-large"},
+        {"name": "small", "max_bytes": 2000, "job_definition": "defn-small", "job_queue": "queue-small"},
+    ]
+    monkeypatch.setenv("BATCH_TIERS", json.dumps(tiers))
+    return tiers
+
+
+def test_main_routes_by_size(s3_bucket: str, landsat: bytes, batch: FakeBatch, tiers: List[Dict]):
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=s3_bucket, Key="a.tif", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="b.tif", Body=landsat + b"\0" * 1000)
+    s3.put_object(Bucket=s3_bucket, Key="c.tif", Body=landsat)
+
+    response = handler.main(s3_event(s3_bucket, ["a.tif", "b.tif", "c.tif"]), None)
+    assert response["tiers"] == {"small": 2, "large": 1}
+
+    # each tier is submitted to its own job definition and queue
+    small, large = batch.jobs
+    assert (small["jobDefinition"], small["jobQueue"]) == ("defn-small", "queue-small")
+    assert [task["key"] for task in json.loads(environment(small)["INPUT_MANIFEST"])] == ["a.tif", "c.tif"]
+    assert (large["jobDefinition"], large["jobQueue"]) == ("defn-large", "queue-large")
+    assert environment(large)["INPUT_S3_KEY"] == "b.tif"
+
+
+def test_main_converts_small_objects_directly(
+    s3_bucket: str, landsat: bytes, batch: FakeBatch, tiers: List[Dict], monkeypatch
+):
+    monkeypatch.setenv("DIRECT_CONVERT_FUNCTION", "direct-convert")
+    monkeypatch.setenv("DIRECT_CONVERT_MAX_BYTES", "2000")
+    fake_lambda = FakeLambda()
+    handler._clients["lambda"] = fake_lambda
+
+    s3 = boto3.client("s3")
+    s3.put_object(Bucket=s3_bucket, Key="a.tif", Body=landsat)
+    s3.put_object(Bucket=s3_bucket, Key="b.tif", Body=landsat + b"\0" * 1000)
+
+    response = handler.main(s3_event(s3_bucket, ["a.tif", "b.tif"]), None)
+    assert response["direct"] == 1
+    assert response["submitted"] == 1
+
+    # the small object skips Batch
+    (invocation,) = fake_lambda.invocations
+    assert invocation["FunctionName"] == "direct-convert"
+    assert invocation["InvocationType"] == "Event"
+    (task,) = json.loads(invocation["Payload"])["tasks"]
+    assert task == {"bucket": s3_bucket, "key": "a.tif", "out_bucket": "output-bucket", "out_key": "a.tif"}
+
+    (job,) = batch.jobs
+    assert environment(job)["INPUT_S3_KEY"] == "b.tif"
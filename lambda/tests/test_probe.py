@@ -0,0 +1,104 @@
+import os
+import struct
+from pathlib import Path
+
+import pytest
+
+import probe
+from probe import CONVERT, REJECT, SKIP, probe_tiff
+
+rasterio = pytest.importorskip("rasterio")
+cog_translate = pytest.importorskip("rio_cogeo.cogeo").cog_translate
+cog_profiles = pytest.importorskip("rio_cogeo.profiles").cog_profiles
+
+
+def reader(data: bytes):
+    """Ranged reads from an in-memory object"""
+
+    def read(offset, size):
+        return data[offset : offset + size]
+
+    return read
+
+
+def write_tiff(path: Path, width: int, height: int, **profile) -> Path:
+    import numpy as np
+
+    profile = dict(driver="GTiff", width=width, height=height, count=1, dtype="uint8", **profile)
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.arange(width * height, dtype="uint8").reshape(1, height, width))
+    return path
+
+
+def write_cog(path: Path, width: int, height: int, **options) -> Path:
+    src_path = write_tiff(path.with_suffix(".src.tif"), width, height)
+    cog_translate(str(src_path), str(path), dict(cog_profiles.get("deflate"), **options), quiet=True)
+    return path
+
+
+def test_probe_striped_tiff(test_data_dir: str):
+    with open(os.path.join(test_data_dir, "landsat.tif"), "rb") as fh:
+        result = probe_tiff(reader(fh.read()))
+
+    assert result.decision == CONVERT
+    assert result.reason == "Image is not tiled"
+    assert result.ifds[0].width == 32 and result.ifds[0].height == 18
+    assert result.reads == 1
+
+
+def test_probe_tiled_without_overviews(tmp_path: Path):
+    path = write_tiff(tmp_path / "tiled.tif", 1024, 1024, tiled=True, blockxsize=256, blockysize=256)
+    result = probe_tiff(reader(path.read_bytes()))
+
+    assert result.decision == CONVERT
+    assert result.reason == "Image has no internal overviews"
+
+
+@pytest.mark.parametrize("bigtiff", [False, True])
+def test_probe_cog(tmp_path: Path, bigtiff: bool):
+    options = {"BIGTIFF": "YES"} if bigtiff else {}
+    path = write_cog(tmp_path / "cog.tif", 2048, 1024, **options)
+    result = probe_tiff(reader(path.read_bytes()))
+
+    assert result.decision == SKIP
+    assert result.bigtiff == bigtiff
+    assert len(result.ifds) > 1
+    assert all(ifd.reduced_resolution for ifd in result.ifds[1:])
+
+
+def test_probe_small_tiled_image_needs_no_overviews(tmp_path: Path):
+    path = write_tiff(tmp_path / "small.tif", 256, 256, tiled=True, blockxsize=256, blockysize=256)
+    assert probe_tiff(reader(path.read_bytes())).decision == SKIP
+
+
+def test_probe_ifds_outside_first_read(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(probe, "PROBE_BYTES", 64)
+    monkeypatch.setattr(probe, "MAX_READS", 1000)
+
+    path = write_cog(tmp_path / "cog.tif", 2048, 1024)
+    result = probe_tiff(reader(path.read_bytes()))
+
+    assert result.decision == SKIP
+    assert result.reads > 1
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"not a tiff at all, just some text",
+        b"II" + struct.pack("<H", 99) + bytes(12),
+        # valid header pointing at an IFD beyond the end of the file
+        b"II" + struct.pack("<HI", 42, 4096) + bytes(8),
+    ],
+)
+def test_probe_rejects_non_tiffs(data: bytes):
+    assert probe_tiff(reader(data)).decision == REJECT
+
+
+def test_probe_rejects_truncated_tiff(tmp_path: Path):
+    path = write_cog(tmp_path / "cog.tif", 2048, 1024)
+    result = probe_tiff(reader(path.read_bytes()[:200]))
+
+    assert result.decision == REJECT
+    assert result.reason.startswith("Corrupt TIFF")
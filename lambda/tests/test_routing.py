@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from routing import DIRECT, Tier, choose_tier, load_tiers, route
+
+TIERS = [
+    Tier("small", 100, "defn-small", "queue-small"),
+    Tier("medium", 1000, "defn-medium", "queue-medium"),
+    Tier("large", None, "defn-large", "queue-large"),
+]
+
+
+def test_load_tiers():
+    environ = {"BATCH_TIERS": json.dumps([tier.__dict__ for tier in reversed(TIERS)])}
+    assert load_tiers(environ) == TIERS
+
+
+def test_load_tiers_default():
+    environ = {"BATCH_JOB_DEFINITION": "defn", "BATCH_JOB_QUEUE": "queue"}
+    assert load_tiers(environ) == [Tier("default", None, "defn", "queue")]
+
+    with pytest.raises(ValueError):
+        load_tiers({"BATCH_TIERS": "[]"})
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [(0, "small"), (100, "small"), (101, "medium"), (1000, "medium"), (10**12, "large"), (None, "large")],
+)
+def test_choose_tier(size, expected):
+    assert choose_tier(size, TIERS).name == expected
+
+
+def test_choose_tier_bounded():
+    # objects larger than every tier go to the largest
+    assert choose_tier(5000, TIERS[:2]).name == "medium"
+
+
+@pytest.mark.parametrize(
+    "size,direct_max_bytes,expected",
+    [(50, 64, DIRECT), (64, 64, DIRECT), (65, 64, "medium"), (50, 0, "small"), (None, 64, "large"), (0, 64, "small")],
+)
+def test_route(size, direct_max_bytes, expected):
+    if expected == "medium":
+        assert route(size, TIERS[1:], direct_max_bytes) == expected
+    else:
+        assert route(size, TIERS, direct_max_bytes) == expected